@@ -0,0 +1,98 @@
+"""Choose which replica of a mirrored chunk to read.
+
+"least_outstanding" picks the disk with the fewest reads in flight,
+"round_robin" takes turns, and "latency" picks the disk whose recent reads
+were fastest, trying the others now and then so a disk that got faster is
+noticed. Ties go round-robin. The order is only a preference: when a
+replica cannot be read the next one is tried.
+"""
+import time
+import threading
+import itertools
+from contextlib import contextmanager
+
+READ_POLICIES = ("least_outstanding", "round_robin", "latency")
+READ_POLICY = "least_outstanding"
+LATENCY_WEIGHT = 0.2  # share of the newest read in a disk's average latency
+EXPLORE_EVERY = 16    # the latency policy goes round-robin once every this many picks
+
+class ReplicaBalancer:
+    """Order replicas by a policy and keep the per-disk numbers it needs."""
+
+    def __init__(self, policy=READ_POLICY):
+        if policy not in READ_POLICIES:
+            raise ValueError(f"Unknown read policy: {policy}")
+        self.policy = policy
+        self._lock = threading.Lock()
+        self._turns = itertools.count()
+        self._outstanding = {}
+        self._latency = {}  # disk -> moving average of seconds per read
+        self._reads = {}
+        self._errors = {}
+
+    def order(self, disk_names):
+        """Return the disks holding a chunk, the preferred one first."""
+        if len(disk_names) < 2:
+            return list(disk_names)
+        turn = next(self._turns)
+        start = turn % len(disk_names)
+        rotated = list(disk_names[start:]) + list(disk_names[:start])
+        with self._lock:
+            if self.policy == "least_outstanding":
+                return sorted(rotated, key=lambda disk: self._outstanding.get(disk, 0))
+            if self.policy == "latency" and turn % EXPLORE_EVERY:
+                # Disks never read from yet count as fastest, so each gets measured
+                return sorted(rotated, key=lambda disk: self._latency.get(disk, 0.0))
+        return rotated
+
+    @contextmanager
+    def reading(self, disk_name):
+        """Count a read from a disk as outstanding while it runs and time it."""
+        with self._lock:
+            self._outstanding[disk_name] = self._outstanding.get(disk_name, 0) + 1
+        start = time.perf_counter()
+        outcome = "read"
+        try:
+            yield
+        except FileNotFoundError:
+            # A replica that is not there says nothing about the disk
+            outcome = "missing"
+            raise
+        except OSError:
+            outcome = "failed"
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self._outstanding[disk_name] -= 1
+                if outcome != "missing":
+                    self._record(disk_name, elapsed, outcome == "failed")
+
+    def _record(self, disk_name, elapsed, failed):
+        if failed:
+            self._errors[disk_name] = self._errors.get(disk_name, 0) + 1
+            # A failing disk sorts last until it answers well again
+            elapsed = max(elapsed, 1.0)
+        self._reads[disk_name] = self._reads.get(disk_name, 0) + 1
+        average = self._latency.get(disk_name)
+        self._latency[disk_name] = elapsed if average is None else average + LATENCY_WEIGHT * (elapsed - average)
+
+    def stats(self):
+        """Return {disk: {"reads", "outstanding", "latency_ms", "errors"}}."""
+        with self._lock:
+            return {disk: {"reads": self._reads.get(disk, 0),
+                           "outstanding": self._outstanding.get(disk, 0),
+                           "latency_ms": self._latency.get(disk, 0.0) * 1000,
+                           "errors": self._errors.get(disk, 0)}
+                    for disk in sorted(set(self._reads) | set(self._outstanding))}
+
+# Shared by every read in the process, so concurrent retrieves see each other's load
+_balancer = ReplicaBalancer()
+
+def get_balancer():
+    return _balancer
+
+def set_read_policy(policy):
+    """Choose how replicas are picked from now on, one of READ_POLICIES."""
+    global _balancer
+    _balancer = ReplicaBalancer(policy)
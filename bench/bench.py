@@ -0,0 +1,292 @@
+"""Benchmarks for ingest, retrieve, rebuild and catalog loading.
+
+    python bench/bench.py
+    python bench/bench.py --datasets huge --methods mirror,parity --disks 3,5 --block-sizes 1M,4M
+    python bench/compare.py bench/results/old.json bench/results/new.json
+
+Each case runs in its own process on a fresh storage folder, so peak RSS
+and in-process caches belong to that case alone. Datasets are generated
+from fixed seeds and reused between cases. Results are written as JSON,
+tagged with the git commit they were measured on.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+BENCH_FOLDER = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_FOLDER))
+
+import datasets  # noqa: E402
+
+DISK_SIZE = 1 << 40  # large enough that placement never runs out of room
+CATALOG_SIZES = (1000, 10000, 100000)
+CATALOG_CHUNKS = 16  # chunks per synthetic catalog entry
+CDC_MEAN_RANGE = (0.75, 1.5)  # mean cdc chunk size, as a multiple of the average asked for, that is expected
+
+def _percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def _latency(samples):
+    """Summarize per-chunk latencies in milliseconds."""
+    if not samples:
+        return {"count": 0, "p50_ms": None, "p99_ms": None}
+    return {"count": len(samples),
+            "p50_ms": _percentile(samples, 0.50) * 1000,
+            "p99_ms": _percentile(samples, 0.99) * 1000}
+
+def _chunk_sizes(san, block_size):
+    """Summarize the sizes chunks were cut to, each file's last chunk left out as it is only what remained."""
+    sizes = [size for file_metadata in san.files() for size in file_metadata["sizes"][:-1]]
+    if not sizes:
+        return {"count": 0, "mean": None, "p10": None, "p50": None, "p90": None, "mean_ratio": None}
+    mean = sum(sizes) / len(sizes)
+    return {"count": len(sizes), "mean": mean, "p10": _percentile(sizes, 0.10), "p50": _percentile(sizes, 0.50),
+            "p90": _percentile(sizes, 0.90), "mean_ratio": mean / block_size}
+
+def _peak_rss():
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def _mb_per_s(size, seconds):
+    return size / seconds / 1e6 if seconds else None
+
+class _Timed:
+    """Replace a module function with one that records how long each call takes."""
+
+    def __init__(self, module, name):
+        self.module, self.name = module, name
+        self.samples = []
+
+    def __enter__(self):
+        function = self.original = getattr(self.module, self.name)
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.samples.append(time.perf_counter() - start)
+
+        setattr(self.module, self.name, timed)
+        return self
+
+    def __exit__(self, *exc_info):
+        setattr(self.module, self.name, self.original)
+
+def run_io_case(case, root):
+    """Store a dataset, read it back, then rebuild after losing a disk."""
+    from virtual_san import VirtualSAN
+    import file_operations
+
+    san = VirtualSAN(root)
+    disk_names = [f"disk{index}" for index in range(case["disks"])]
+    for disk_name in disk_names:
+        san.add_disk(disk_name, DISK_SIZE)
+    if case["chunker"] == "cdc":
+        san.set_chunker("cdc", avg_size=case["block_size"])
+    else:
+        san.set_chunker("fixed", avg_size=case["block_size"])
+
+    paths = case["files"]
+    total = sum(os.path.getsize(path) for path in paths)
+    result = {"bytes": total, "files": len(paths)}
+
+    with _Timed(file_operations, "save_chunk") as writes:
+        start = time.perf_counter()
+        for path in paths:
+            san.put(path, case["method"], parity=case.get("parity", 1))
+        elapsed = time.perf_counter() - start
+    result["store"] = {"seconds": elapsed, "mb_per_s": _mb_per_s(total, elapsed), "write": _latency(writes.samples)}
+    result["dedup"] = san.dedup_stats()
+    result["chunk_sizes"] = _chunk_sizes(san, case["block_size"])
+
+    output_path = os.path.join(root, "retrieved")
+
+    def retrieve_all():
+        with _Timed(file_operations, "read_chunk") as reads, _Timed(file_operations, "open_chunk") as opens:
+            start = time.perf_counter()
+            for path in paths:
+                with open(output_path, "wb") as output:
+                    san.get_to(os.path.basename(path), output, missing_ok=False)
+            elapsed = time.perf_counter() - start
+        return {"seconds": elapsed, "mb_per_s": _mb_per_s(total, elapsed),
+                "read": _latency(reads.samples + opens.samples)}
+
+    result["retrieve"] = retrieve_all()
+
+    # Losing a disk: parity files are read degraded, then the disk is drained onto the others
+    lost = disk_names[-1]
+    if case["method"] == "parity":
+        shutil.move(os.path.join(root, lost), os.path.join(root, "lost"))
+        os.makedirs(os.path.join(root, lost))
+        result["degraded_retrieve"] = retrieve_all()
+        shutil.rmtree(os.path.join(root, lost))
+        shutil.move(os.path.join(root, "lost"), os.path.join(root, lost))
+    if case["disks"] > 1:
+        start = time.perf_counter()
+        san.remove_disk(lost)
+        elapsed = time.perf_counter() - start
+        result["rebuild"] = {"seconds": elapsed}
+    return result
+
+def run_catalog_case(case, root):
+    """Time loading a catalog of `entries` files from its snapshot and from its log."""
+    import metadata_handler
+    import durability
+
+    metadata_handler.set_storage_root(root)
+    os.makedirs(root, exist_ok=True)
+    entries = [{"name": f"file-{index}", "method": "stripe", "disks": ["disk0", "disk1"],
+                "chunks": [[f"{index:016x}{chunk:016x}", f"disk{chunk % 2}"] for chunk in range(CATALOG_CHUNKS)],
+                "sizes": [1024 * 1024] * CATALOG_CHUNKS, "size": CATALOG_CHUNKS * 1024 * 1024}
+               for index in range(case["entries"])]
+    result = {"entries": case["entries"]}
+
+    start = time.perf_counter()
+    metadata_handler.save_file_metadata(entries, overwrite=True)
+    result["snapshot_write_seconds"] = time.perf_counter() - start
+    metadata_handler._catalog = None
+    start = time.perf_counter()
+    metadata_handler.load_files_metadata()
+    result["snapshot_load_seconds"] = time.perf_counter() - start
+
+    # The same entries as log records, as they are before a compaction
+    metadata_handler.COMPACT_THRESHOLD = float("inf")
+    durability.SYNC_WRITES = False
+    metadata_handler.save_file_metadata([], overwrite=True)
+    for entry in entries:
+        metadata_handler.save_file_metadata(entry)
+    metadata_handler._catalog = None
+    start = time.perf_counter()
+    metadata_handler.load_files_metadata()
+    result["log_load_seconds"] = time.perf_counter() - start
+    return result
+
+def run_case(case):
+    root = tempfile.mkdtemp(prefix="volume-", dir=case["workdir"])
+    try:
+        if case["kind"] == "catalog":
+            result = run_catalog_case(case, root)
+        else:
+            result = run_io_case(case, root)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    result["peak_rss_bytes"] = _peak_rss()
+    return result
+
+def _parse_size(text):
+    units = {"K": 1024, "M": 1024 * 1024, "G": 1024 * 1024 * 1024}
+    text = text.strip().upper()
+    if text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_FOLDER,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def build_cases(args, dataset_files):
+    cases = []
+    for dataset in args.datasets.split(","):
+        for method in args.methods.split(","):
+            for disks in (int(count) for count in args.disks.split(",")):
+                if method == "parity" and disks < 3:
+                    continue
+                for block_size in (_parse_size(size) for size in args.block_sizes.split(",")):
+                    cases.append({"kind": "io", "dataset": dataset, "method": method, "disks": disks,
+                                  "block_size": block_size, "chunker": args.chunker,
+                                  "files": dataset_files[dataset]})
+    if args.catalog_sizes:
+        for entries in (int(count) for count in args.catalog_sizes.split(",")):
+            cases.append({"kind": "catalog", "entries": entries})
+    return cases
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the storage system and write the results as JSON.")
+    parser.add_argument("--datasets", default="small,huge,dedup")
+    parser.add_argument("--methods", default="stripe,mirror,parity")
+    parser.add_argument("--disks", default="3", help="comma separated disk counts")
+    parser.add_argument("--block-sizes", default="1M", help="comma separated chunk sizes, e.g. 256K,1M,4M")
+    parser.add_argument("--chunker", choices=["fixed", "cdc"], default="fixed")
+    parser.add_argument("--scale", type=float, default=1.0, help="grow or shrink every dataset")
+    parser.add_argument("--catalog-sizes", default=",".join(str(size) for size in CATALOG_SIZES),
+                        help="catalog entry counts to time loading, empty to skip")
+    parser.add_argument("--workdir", help="where datasets and volumes go (default: a temporary folder)")
+    parser.add_argument("--output", help="result file (default: bench/results/<time>-<commit>.json)")
+    parser.add_argument("--run-case", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_case:
+        print(json.dumps(run_case(json.loads(args.run_case))))
+        return 0
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="bench-")
+    os.makedirs(workdir, exist_ok=True)
+    dataset_files = {}
+    for dataset in args.datasets.split(","):
+        folder = os.path.join(workdir, f"dataset-{dataset}-{args.scale}")
+        if os.path.isdir(folder):
+            dataset_files[dataset] = sorted(os.path.join(folder, name) for name in os.listdir(folder))
+        else:
+            dataset_files[dataset] = datasets.build(dataset, folder, args.scale)
+
+    commit = _git_commit()
+    report = {"commit": commit, "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "python": platform.python_version(), "platform": platform.platform(),
+              "cpus": os.cpu_count(), "arguments": vars(args), "results": []}
+    try:
+        for case in build_cases(args, dataset_files):
+            case["workdir"] = workdir
+            completed = subprocess.run([sys.executable, __file__, "--run-case", json.dumps(case)],
+                                       capture_output=True, text=True)
+            label = {key: value for key, value in case.items() if key not in ("files", "workdir")}
+            if completed.returncode:
+                print(f"FAILED {label}\n{completed.stderr}", file=sys.stderr)
+                report["results"].append({"case": label, "error": completed.stderr.strip().splitlines()[-1:]})
+                continue
+            result = json.loads(completed.stdout.strip().splitlines()[-1])
+            report["results"].append({"case": label, **result})
+            print(_summary(label, result))
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = args.output or os.path.join(BENCH_FOLDER, "results", f"{time.strftime('%Y%m%d-%H%M%S')}-{commit}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"Results written to {output}")
+    return 0
+
+def _summary(case, result):
+    if case["kind"] == "catalog":
+        return (f"catalog {case['entries']:>7} entries: snapshot load {result['snapshot_load_seconds']:.3f}s, "
+                f"log load {result['log_load_seconds']:.3f}s")
+    line = (f"{case['dataset']:>5} {case['method']:>6} {case['disks']} disks {case['block_size'] >> 10}K: "
+            f"store {result['store']['mb_per_s']:.1f} MB/s, retrieve {result['retrieve']['mb_per_s']:.1f} MB/s")
+    if "rebuild" in result:
+        line += f", rebuild {result['rebuild']['seconds']:.2f}s"
+    line += f", peak RSS {result['peak_rss_bytes'] >> 20} MiB"
+    ratio = result["chunk_sizes"]["mean_ratio"]
+    if case["chunker"] == "cdc" and ratio is not None:
+        line += f", chunks {ratio:.2f}x the average"
+        # Too few chunks to tell on small datasets
+        low, high = CDC_MEAN_RANGE
+        if result["chunk_sizes"]["count"] >= 100 and not low <= ratio <= high:
+            line += " (OUT OF RANGE)"
+    return line
+
+if __name__ == "__main__":
+    sys.exit(main())
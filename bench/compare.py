@@ -0,0 +1,69 @@
+"""Compare two benchmark result files case by case.
+
+    python bench/compare.py bench/results/before.json bench/results/after.json
+"""
+import sys
+import json
+
+# (path into a result, True when bigger is better)
+METRICS = [
+    (("store", "mb_per_s"), True),
+    (("retrieve", "mb_per_s"), True),
+    (("degraded_retrieve", "mb_per_s"), True),
+    (("rebuild", "seconds"), False),
+    (("store", "write", "p99_ms"), False),
+    (("retrieve", "read", "p99_ms"), False),
+    (("peak_rss_bytes",), False),
+    (("snapshot_load_seconds",), False),
+    (("log_load_seconds",), False),
+]
+THRESHOLD = 0.10  # changes smaller than this are noise
+
+def _get(result, path):
+    for key in path:
+        if not isinstance(result, dict) or key not in result:
+            return None
+        result = result[key]
+    return result
+
+def _key(case):
+    return json.dumps(case, sort_keys=True)
+
+def compare(before, after):
+    """Return (case, metric, old, new, change) rows and the number of regressions."""
+    old_results = {_key(result["case"]): result for result in before["results"]}
+    rows, regressions = [], 0
+    for result in after["results"]:
+        old = old_results.get(_key(result["case"]))
+        if old is None:
+            continue
+        for path, higher_is_better in METRICS:
+            old_value, new_value = _get(old, path), _get(result, path)
+            if not old_value or new_value is None:
+                continue
+            change = (new_value - old_value) / old_value
+            worse = change < -THRESHOLD if higher_is_better else change > THRESHOLD
+            regressions += worse
+            rows.append((result["case"], ".".join(path), old_value, new_value, change, worse))
+    return rows, regressions
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 2:
+        print("usage: compare.py BEFORE.json AFTER.json", file=sys.stderr)
+        return 2
+    with open(argv[0]) as file:
+        before = json.load(file)
+    with open(argv[1]) as file:
+        after = json.load(file)
+    print(f"{before.get('commit')} -> {after.get('commit')}")
+    rows, regressions = compare(before, after)
+    for case, metric, old_value, new_value, change, worse in rows:
+        label = " ".join(str(value) for key, value in sorted(case.items()) if key != "kind")
+        flag = "  REGRESSION" if worse else ""
+        print(f"{label:<40} {metric:<28} {old_value:>12.3f} {new_value:>12.3f} {change:+7.1%}{flag}")
+    print(f"{regressions} regressions beyond {THRESHOLD:.0%}")
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
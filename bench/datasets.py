@@ -0,0 +1,71 @@
+"""Synthetic datasets for the benchmarks, the same bytes for the same seed."""
+import os
+import random
+
+def _random_bytes(rng, size):
+    return rng.getrandbits(size * 8).to_bytes(size, "little") if size else b""
+
+def _write(folder, name, data):
+    path = os.path.join(folder, name)
+    with open(path, "wb") as file:
+        file.write(data)
+    return path
+
+def small_files(folder, count=200, size=16 * 1024, seed=1):
+    """Many small files of random data."""
+    rng = random.Random(seed)
+    return [_write(folder, f"small-{index:05d}", _random_bytes(rng, size)) for index in range(count)]
+
+def huge_files(folder, count=2, size=64 * 1024 * 1024, seed=2):
+    """A few large files of random data, written a MiB at a time."""
+    rng = random.Random(seed)
+    paths = []
+    for index in range(count):
+        path = os.path.join(folder, f"huge-{index:02d}")
+        with open(path, "wb") as file:
+            for offset in range(0, size, 1024 * 1024):
+                file.write(_random_bytes(rng, min(1024 * 1024, size - offset)))
+        paths.append(path)
+    return paths
+
+def dedup_files(folder, count=20, size=4 * 1024 * 1024, shared=0.75, block=64 * 1024, seed=3):
+    """Files built from blocks, `shared` of them drawn from a pool common to every file.
+
+    The blocks are smaller than chunks and land at varying offsets, so
+    fixed-size chunking finds less of the repetition than content-defined
+    chunking does.
+    """
+    rng = random.Random(seed)
+    pool = [_random_bytes(rng, block) for _ in range(16)]
+    paths = []
+    for index in range(count):
+        parts = []
+        # A short random prefix shifts the blocks differently in every file
+        length = rng.randrange(block)
+        parts.append(_random_bytes(rng, length))
+        while length < size:
+            part = rng.choice(pool) if rng.random() < shared else _random_bytes(rng, block)
+            parts.append(part)
+            length += len(part)
+        paths.append(_write(folder, f"dedup-{index:03d}", b"".join(parts)[:size]))
+    return paths
+
+DATASETS = {
+    "small": small_files,
+    "huge": huge_files,
+    "dedup": dedup_files,
+}
+
+def build(name, folder, scale=1.0):
+    """Write dataset `name` into `folder` and return its file paths.
+
+    `scale` multiplies the number of small files and the size of the others.
+    """
+    os.makedirs(folder, exist_ok=True)
+    if name == "small":
+        return small_files(folder, count=max(1, int(200 * scale)))
+    if name == "huge":
+        return huge_files(folder, size=max(1024 * 1024, int(64 * 1024 * 1024 * scale)))
+    if name == "dedup":
+        return dedup_files(folder, size=max(64 * 1024, int(4 * 1024 * 1024 * scale)))
+    raise ValueError(f"Unknown dataset: {name}")
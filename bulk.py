@@ -0,0 +1,196 @@
+"""Store whole directory trees, or the files a manifest lists, in large batches.
+
+Files go through one StoreBatch (see file_operations.py) until it holds
+BULK_BATCH_FILES files or BULK_BATCH_BYTES bytes. The batch then commits
+with one catalog write and one sync per disk, instead of a journal, a
+catalog append and an fsync of every disk for each file.
+
+Files the catalog already holds unchanged under the same name and method
+are skipped, compared by `skip`:
+    "size"   same size
+    "mtime"  same size and modification time (the default)
+    "hash"   same chunk hashes, the file is read and hashed again
+    "none"   never skip
+
+Progress is checkpointed next to the metadata after every commit, as the
+name, size and modification time of every file the batch committed.
+Running the same ingest again after an interruption passes over those
+files if they have not changed since, whatever `skip` is, and looks at
+every other one, so files added, removed or failed in between are not
+mixed up with them. The copies the interrupted batch wrote are removed by
+journal recovery.
+
+A manifest lists one path per line, optionally followed by a tab and the
+name to store it under. Relative paths are taken from the manifest's
+folder. Blank lines and lines starting with "#" are ignored.
+"""
+import os
+import json
+from metadata_handler import find_file_metadata, logical_chunks, storage_path
+from file_operations import StoreBatch, store_stream
+from chunking import get_chunker
+from hashing import get_hasher, hash_data
+from zero_copy import map_stream
+from durability import fsync_fd
+from progress import ProgressReporter
+
+BULK_BATCH_FILES = 1000         # files committed together
+BULK_BATCH_BYTES = 1024 ** 3    # or fewer files once they hold this many bytes
+SKIP_MODES = ("none", "size", "mtime", "hash")
+
+def _name(prefix, relative):
+    name = relative.replace(os.sep, "/").lstrip("/")
+    while name.startswith("./"):
+        name = name[2:]
+    return f"{prefix.rstrip('/')}/{name}" if prefix else name
+
+def iter_sources(sources=(), manifest=None, prefix=""):
+    """Yield (path, name) for every file to ingest, always in the same order.
+
+    A folder contributes every file below it, named by its path inside the
+    folder. A file is named by its base name. Names get `prefix` and "/" in front.
+    """
+    for source in sources:
+        if os.path.isdir(source):
+            for folder, folders, files in os.walk(source):
+                # Sorted, so a resumed ingest sees the files in the same order
+                folders.sort()
+                for file_name in sorted(files):
+                    path = os.path.join(folder, file_name)
+                    yield path, _name(prefix, os.path.relpath(path, source))
+        else:
+            yield source, _name(prefix, os.path.basename(source))
+    if manifest:
+        base = os.path.dirname(os.path.abspath(manifest))
+        with open(manifest, "r") as file:
+            for line in file:
+                line = line.rstrip("\n")
+                if not line.strip() or line.startswith("#"):
+                    continue
+                path, _, name = line.partition("\t")
+                yield os.path.join(base, path), _name(prefix, name or path)
+
+def _same_chunks(file_metadata, path):
+    """Whether a file cuts into the chunks a stored entry lists, with the entry's chunker and hash."""
+    chunker = get_chunker(file_metadata.get("chunker"))
+    hasher = get_hasher(file_metadata.get("hash_algorithm", "md5"))
+    stored = [chunk_hash for chunk_hash, _ in logical_chunks(file_metadata)]
+    with open(path, "rb") as file:
+        source = map_stream(file)
+        try:
+            hashes = [hasher(chunk) for chunk in chunker.split(source)]
+        finally:
+            if source is not file:
+                source.close()
+    return hashes == stored
+
+def unchanged(file_metadata, path, info, method, skip):
+    """Whether a stored entry already holds a file as it is now, compared by `skip`."""
+    if skip == "none" or file_metadata is None or file_metadata["method"] != method:
+        return False
+    if file_metadata.get("size") != info.st_size:
+        return False
+    if skip == "size":
+        return True
+    if skip == "mtime":
+        return file_metadata.get("source", {}).get("mtime_ns") == info.st_mtime_ns
+    return _same_chunks(file_metadata, path)
+
+def _checkpoint_path(job):
+    return storage_path(f"bulk-{job}.log")
+
+def _load_checkpoint(path):
+    """Return {name: [size, mtime_ns]} of the files earlier runs of a job committed."""
+    committed = {}
+    if os.path.exists(path):
+        with open(path, "r") as file:
+            for line in file:
+                try:
+                    name, size, mtime_ns = json.loads(line)
+                except ValueError:
+                    # Cut short by a crash, those files are looked at again
+                    continue
+                committed[name] = [size, mtime_ns]
+    return committed
+
+def _add_to_checkpoint(path, entries):
+    with open(path, "a") as file:
+        for entry in entries:
+            file.write(json.dumps([entry["name"], entry["size"], entry["source"]["mtime_ns"]]) + "\n")
+        file.flush()
+        fsync_fd(file.fileno())
+
+def bulk_ingest(sources=(), method="stripe", manifest=None, prefix="", parity=1, skip="mtime",
+                batch_files=None, batch_bytes=None, verbose=False):
+    """Store every file of `sources` (folders or files) and `manifest`, and return a report.
+
+    The report counts the files "stored" and "skipped", the "bytes" stored,
+    the "batches" committed and the files "resumed" past, and lists the
+    [path, error] of files that could not be opened. Those are left out
+    and reported rather than stopping the ingest.
+    """
+    if skip not in SKIP_MODES:
+        raise ValueError(f"Unknown skip mode: {skip}")
+    batch_files = batch_files or BULK_BATCH_FILES
+    batch_bytes = batch_bytes or BULK_BATCH_BYTES
+    # The same sources, names and method make the same job, which resumes its checkpoint
+    job_spec = {"sources": [os.path.abspath(source) for source in sources],
+                "manifest": os.path.abspath(manifest) if manifest else None,
+                "prefix": prefix, "method": method, "parity": parity}
+    job = hash_data("md5", json.dumps(job_spec, sort_keys=True).encode())[:16]
+    checkpoint_path = _checkpoint_path(job)
+    committed = _load_checkpoint(checkpoint_path)
+    if committed and verbose:
+        print(f"Resuming ingest, {len(committed)} files were committed before.")
+
+    report = {"stored": 0, "skipped": 0, "bytes": 0, "batches": 0, "resumed": 0, "failed": []}
+    progress = ProgressReporter(None, "Ingesting") if verbose else None
+    batch = None
+    batch_size = 0
+
+    def commit():
+        nonlocal batch, batch_size
+        _add_to_checkpoint(checkpoint_path, batch.commit())
+        batch, batch_size = None, 0
+        report["batches"] += 1
+
+    try:
+        for path, name in iter_sources(sources, manifest, prefix):
+            try:
+                file = open(path, "rb")
+                info = os.fstat(file.fileno())
+            except OSError as error:
+                report["failed"].append([path, str(error)])
+                continue
+            with file:
+                stored = find_file_metadata(name)
+                if stored is not None and committed.get(name) == [info.st_size, info.st_mtime_ns]:
+                    # Stored by the interrupted run and not changed since
+                    report["resumed"] += 1
+                    continue
+                if unchanged(stored, path, info, method, skip):
+                    report["skipped"] += 1
+                    continue
+                if batch is None:
+                    batch = StoreBatch(label="bulk")
+                file_metadata = store_stream(file, name, method, parity=parity, batch=batch)
+            # What the file looked like when stored, for the "mtime" skip of later runs
+            file_metadata["source"] = {"mtime_ns": info.st_mtime_ns}
+            report["stored"] += 1
+            report["bytes"] += file_metadata["size"]
+            batch_size += file_metadata["size"]
+            if progress is not None:
+                progress.update(file_metadata["size"])
+            if len(batch.entries) >= batch_files or batch_size >= batch_bytes:
+                commit()
+        if batch is not None:
+            commit()
+    finally:
+        if batch is not None:
+            batch.abort()
+    if progress is not None:
+        progress.finish()
+    # Finished, a later run with the same sources starts over and skips what is unchanged
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    return report
@@ -0,0 +1,198 @@
+"""In-process cache of chunk data for hot retrieves.
+
+Chunks are cached by hash after decompression, so a chunk shared by many
+files through deduplication is read from disk once. Chunks are named by
+their content, which means a cached chunk never goes stale. The memory
+tier is LRU within a byte budget. Chunks it evicts can drop to an optional
+second tier, a folder on a faster local disk with its own budget, and are
+moved back to memory on their next hit.
+"""
+import os
+import threading
+from collections import OrderedDict
+import metadata_handler
+
+CACHE_BUDGET = 0  # bytes of chunk data kept in memory, 0 disables the cache
+
+class ChunkCache:
+    """Two-tier LRU cache of chunk data keyed by chunk hash."""
+
+    def __init__(self, budget, tier_folder=None, tier_budget=0):
+        self.budget = budget
+        self.tier_folder = tier_folder
+        self.tier_budget = tier_budget if tier_folder else 0
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()  # hash -> data, least recently used first
+        self._memory_bytes = 0
+        self._tier = OrderedDict()    # hash -> size of the file in tier_folder
+        self._tier_bytes = 0
+        self.hits = 0
+        self.tier_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if self.tier_budget:
+            self._load_tier()
+
+    def _tier_path(self, chunk_hash):
+        return os.path.join(self.tier_folder, chunk_hash)
+
+    def _load_tier(self):
+        """Pick up the chunks a previous process left in the tier folder, oldest first."""
+        os.makedirs(self.tier_folder, exist_ok=True)
+        with os.scandir(self.tier_folder) as entries:
+            files = [(entry.stat().st_mtime, entry.name, entry.stat().st_size)
+                     for entry in entries if entry.is_file() and not entry.name.endswith(".tmp")]
+        for _, chunk_hash, size in sorted(files):
+            self._tier[chunk_hash] = size
+            self._tier_bytes += size
+        self._remove_from_tier(self._trim_tier())
+
+    def get(self, chunk_hash):
+        """Return the data of a cached chunk, or None."""
+        with self._lock:
+            data = self._memory.get(chunk_hash)
+            if data is not None:
+                self._memory.move_to_end(chunk_hash)
+                self.hits += 1
+                return data
+            in_tier = chunk_hash in self._tier
+            if not in_tier:
+                self.misses += 1
+                return None
+        try:
+            with open(self._tier_path(chunk_hash), "rb") as file:
+                data = file.read()
+        except FileNotFoundError:
+            with self._lock:
+                self._drop_tier_entry(chunk_hash)
+                self.misses += 1
+            return None
+        with self._lock:
+            self.tier_hits += 1
+        self.put(chunk_hash, data)
+        return data
+
+    def put(self, chunk_hash, data):
+        """Cache a chunk's data, evicting the least recently used chunks past the budget."""
+        if len(data) > self.budget:
+            return
+        with self._lock:
+            if chunk_hash in self._memory:
+                self._memory.move_to_end(chunk_hash)
+                return
+            self._memory[chunk_hash] = data
+            self._memory_bytes += len(data)
+            evicted = []
+            while self._memory_bytes > self.budget:
+                evicted_hash, evicted_data = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted_data)
+                self.evictions += 1
+                if self.tier_budget and evicted_hash not in self._tier and len(evicted_data) <= self.tier_budget:
+                    evicted.append((evicted_hash, evicted_data))
+        # Disk writes happen outside the lock so lookups are not held up
+        for evicted_hash, evicted_data in evicted:
+            self._demote(evicted_hash, evicted_data)
+
+    def _demote(self, chunk_hash, data):
+        tmp_path = self._tier_path(chunk_hash) + ".tmp"
+        try:
+            with open(tmp_path, "wb") as file:
+                file.write(data)
+            os.replace(tmp_path, self._tier_path(chunk_hash))
+        except OSError:
+            # The tier is only a cache, a full or missing folder just means fewer hits
+            return
+        with self._lock:
+            if chunk_hash not in self._tier:
+                self._tier[chunk_hash] = len(data)
+                self._tier_bytes += len(data)
+            removed = self._trim_tier()
+        self._remove_from_tier(removed)
+
+    def _drop_tier_entry(self, chunk_hash):
+        size = self._tier.pop(chunk_hash, None)
+        if size is not None:
+            self._tier_bytes -= size
+
+    def _trim_tier(self):
+        """Forget tier chunks past the tier budget and return their hashes."""
+        removed = []
+        while self._tier_bytes > self.tier_budget:
+            chunk_hash, size = self._tier.popitem(last=False)
+            self._tier_bytes -= size
+            removed.append(chunk_hash)
+        return removed
+
+    def _remove_from_tier(self, chunk_hashes):
+        for chunk_hash in chunk_hashes:
+            try:
+                os.remove(self._tier_path(chunk_hash))
+            except FileNotFoundError:
+                pass
+
+    def discard(self, chunk_hash):
+        """Drop a chunk no file references any more."""
+        with self._lock:
+            data = self._memory.pop(chunk_hash, None)
+            if data is not None:
+                self._memory_bytes -= len(data)
+            in_tier = chunk_hash in self._tier
+            self._drop_tier_entry(chunk_hash)
+        if in_tier:
+            self._remove_from_tier([chunk_hash])
+
+    def clear(self):
+        with self._lock:
+            removed = list(self._tier)
+            self._memory.clear()
+            self._tier.clear()
+            self._memory_bytes = self._tier_bytes = 0
+        self._remove_from_tier(removed)
+
+    def stats(self):
+        """Return hit/miss counters and how full each tier is."""
+        with self._lock:
+            lookups = self.hits + self.tier_hits + self.misses
+            return {"hits": self.hits, "tier_hits": self.tier_hits, "misses": self.misses,
+                    "hit_ratio": (self.hits + self.tier_hits) / lookups if lookups else 0.0,
+                    "evictions": self.evictions,
+                    "memory_bytes": self._memory_bytes, "memory_chunks": len(self._memory),
+                    "budget": self.budget,
+                    "tier_bytes": self._tier_bytes, "tier_chunks": len(self._tier),
+                    "tier_budget": self.tier_budget}
+
+# The process-wide cache, None while it is disabled
+_cache = None
+_cache_root = None
+_cache_settings = (CACHE_BUDGET, None, 0)
+_cache_lock = threading.Lock()
+
+def configure_cache(budget, tier_folder=None, tier_budget=0):
+    """Set the cache budgets in bytes, a budget of 0 turns the cache off.
+
+    Cached chunks are dropped, except those already in the tier folder.
+    """
+    global _cache, _cache_settings
+    with _cache_lock:
+        _cache_settings = (budget, tier_folder, tier_budget)
+        _cache = None
+
+def get_cache():
+    """Return the cache for the current storage root, or None if it is disabled."""
+    global _cache, _cache_root
+    with _cache_lock:
+        budget, tier_folder, tier_budget = _cache_settings
+        if not budget:
+            return None
+        # Fast hashes are only collision free within one volume, another root starts empty
+        if _cache is None or _cache_root != metadata_handler.DISK_FOLDER:
+            if _cache is not None:
+                _cache.clear()
+            _cache_root = metadata_handler.DISK_FOLDER
+            _cache = ChunkCache(budget, tier_folder, tier_budget)
+        return _cache
+
+def cache_stats():
+    """Return the counters of the cache, or None if it is disabled."""
+    cache = get_cache()
+    return cache.stats() if cache else None
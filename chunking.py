@@ -0,0 +1,170 @@
+"""How a stream is cut into chunks.
+
+"fixed" cuts every `size` bytes. "cdc" cuts where the content says so, so
+inserting or removing bytes only changes the chunks around the edit and the
+rest still deduplicate.
+
+The cdc chunker is a Gear hash done a whole piece of data at a time. The
+piece is read as one big integer and multiplied by a fixed CDC_WINDOW byte
+constant, so every byte of the product is the sum of the CDC_WINDOW bytes
+ending there, each times a different part of the constant, plus the carry
+from the bytes before. A cut goes after the first place the product matches
+a fixed pattern worth `bits` bits, `bits // 8` whole bytes then the top
+`bits % 8` bits of the next one, or at `max` bytes if there is none. The
+multiplication, the conversions and bytes.find() run in C, only the few
+places the whole bytes match are looked at in Python. Each block read from
+the stream is hashed once, the cuts are then only searched for.
+
+No byte of the pattern repeats either of the two before it, so runs of one
+byte value, such as indentation or zero padding, or of two alternating
+ones never match it. Cuts are normalized as in FastCDC: from `min` to
+`avg` bytes the pattern is NORMALIZATION bits longer, and from `avg` on it
+is as much shorter. Most chunks then come out near `avg` rather than spread
+from `min` to `max`. The mean is a little above `avg`, as nothing is cut
+before `min`, and somewhat more on text.
+"""
+import math
+import hashlib
+
+CHUNKERS = ("fixed", "cdc")
+FIXED_SIZE = 1024 * 1024  # 1 MiB blocks
+CDC_AVERAGE = 1024 * 1024
+READ_SIZE = 16 * 1024 * 1024  # bytes read from the stream at a time by the cdc chunker
+HASH_BLOCK = 256 * 1024  # bytes hashed at a time
+CDC_WINDOW = 16    # bytes before a position that decide whether the chunk ends there
+NORMALIZATION = 2  # pattern bits added before the average chunk size and dropped after it
+
+# Derived from sha256 and fixed, so the same content is cut the same way in
+# every file and on every run. The multiplier is odd so the byte at a
+# position always counts towards its own product byte.
+_MULTIPLIER = int.from_bytes(hashlib.sha256(b"cdc multiplier").digest()[:CDC_WINDOW], "little") | 1
+
+def _make_pattern():
+    pattern = []
+    for byte in hashlib.sha256(b"cdc pattern").digest():
+        if byte not in pattern[-2:]:
+            pattern.append(byte)
+    return bytes(pattern)
+
+_PATTERN = _make_pattern()
+# Bytes before a position whose carries, but for rare long ones, still reach it
+_LOOKBACK = 2 * CDC_WINDOW
+
+def _project(data, start=0):
+    """Return the Gear hash byte of every byte of data[start:], see the module docstring.
+
+    The bytes before `start` are only there for the first hashes to see.
+    """
+    pieces = []
+    # In blocks that fit the CPU caches, which is faster than one huge integer
+    for position in range(start, len(data), HASH_BLOCK):
+        origin = max(position - _LOOKBACK, 0)
+        block = data[origin:position + HASH_BLOCK]
+        hashed = (int.from_bytes(block, "little") * _MULTIPLIER).to_bytes(len(block) + CDC_WINDOW, "little")
+        pieces.append(memoryview(hashed)[position - origin:len(block)])
+    return b"".join(pieces)
+
+def _pattern(bits):
+    """Return (whole bytes, bits of the next byte, their value) of a pattern worth `bits` bits."""
+    whole, extra = divmod(bits, 8)
+    return _PATTERN[:whole], extra, _PATTERN[whole] >> (8 - extra)
+
+def _find(projected, length, pattern, position):
+    """Return where the first match of a pattern in projected[position:length] ends, or -1."""
+    prefix, extra, value = pattern
+    while True:
+        found = projected.find(prefix, position, length)
+        if found < 0:
+            return -1
+        end = found + len(prefix)
+        if not extra:
+            return end
+        # The few places the whole bytes match are checked for the rest here
+        if end < length and projected[end] >> (8 - extra) == value:
+            return end + 1
+        position = found + 1
+
+class FixedChunker:
+    """Cut a stream into blocks of `size` bytes."""
+
+    def __init__(self, size=FIXED_SIZE):
+        self.size = size
+
+    def spec(self):
+        return {"name": "fixed", "size": self.size}
+
+    def split(self, stream):
+        while chunk := stream.read(self.size):
+            yield chunk
+
+class ContentDefinedChunker:
+    """Cut a stream at content-defined positions, see the module docstring.
+
+    Chunks are between `min_size` and `max_size` bytes, except the last,
+    and most are near `avg_size`, with a mean slightly above it, whatever
+    mix of bytes the data has. Long runs of one byte value are cut at
+    `max_size`.
+    """
+
+    def __init__(self, min_size=None, avg_size=CDC_AVERAGE, max_size=None):
+        self.avg_size = avg_size
+        self.min_size = min_size or avg_size // 4
+        self.max_size = max_size or avg_size * 4
+        if not 0 < self.min_size < self.avg_size < self.max_size:
+            raise ValueError("Chunk sizes must satisfy 0 < min < avg < max")
+        # The pattern matches once every 2^bits positions
+        self.bits = max(NORMALIZATION + 1, round(math.log2(self.avg_size)))
+        if (self.bits + NORMALIZATION) // 8 >= len(_PATTERN):
+            raise ValueError("The average chunk size is too large")
+        if (self.bits + NORMALIZATION) // 8 + 1 + _LOOKBACK > self.min_size:
+            raise ValueError("The minimum chunk size is too small for the average")
+        self._patterns = (_pattern(self.bits + NORMALIZATION), _pattern(self.bits - NORMALIZATION))
+
+    def spec(self):
+        return {"name": "cdc", "min": self.min_size, "avg": self.avg_size, "max": self.max_size}
+
+    def _cut(self, projected, start, end):
+        """Return where the chunk starting at `start` ends, looking no further than `end`."""
+        if end - start <= self.min_size:
+            return end
+        limit = min(start + self.max_size, end)
+        middle = min(start + self.avg_size, limit)
+        strict, loose = self._patterns
+        for pattern, first, last in ((strict, start + self.min_size, middle), (loose, middle, limit)):
+            if first >= last:
+                continue
+            # From where a pattern ending at `first` begins
+            found = _find(projected, last, pattern, first - len(pattern[0]) - (1 if pattern[1] else 0))
+            if found >= 0:
+                return found
+        return limit
+
+    def split(self, stream):
+        # Slices of what the stream returns are yielded, so a mapped file is not copied
+        buffer, projected, start, eof = b"", b"", 0, False
+        while True:
+            if not eof and len(buffer) - start < self.max_size:
+                data = stream.read(max(READ_SIZE, self.max_size))
+                if not data:
+                    eof = True
+                elif start == len(buffer):
+                    buffer, projected, start = data, _project(data), 0
+                else:
+                    # The bytes kept are not hashed again
+                    kept = len(buffer) - start
+                    buffer = bytes(buffer[start:]) + data
+                    projected, start = projected[start:] + _project(buffer, kept), 0
+                continue
+            if start == len(buffer):
+                return
+            cut = self._cut(projected, start, len(buffer))
+            yield buffer[start:cut]
+            start = cut
+
+def get_chunker(spec=None):
+    """Return the chunker for a spec as recorded in metadata, None meaning fixed 1 MiB blocks."""
+    if spec is None or spec["name"] == "fixed":
+        return FixedChunker((spec or {}).get("size", FIXED_SIZE))
+    if spec["name"] == "cdc":
+        return ContentDefinedChunker(spec.get("min"), spec.get("avg", CDC_AVERAGE), spec.get("max"))
+    raise ValueError(f"Unknown chunker: {spec['name']}")
@@ -0,0 +1,206 @@
+import sys
+import argparse
+from virtual_san import VirtualSAN
+from server import serve
+from sharding import FANOUT, parse_fanout
+from metadata_handler import chunk_count
+
+def build_parser():
+    """Build the command line parser."""
+    parser = argparse.ArgumentParser(description="Non-interactive access to the virtual storage system.")
+    parser.add_argument("--root", default=None, help="storage folder (default: virtual_disks)")
+    parser.add_argument("--metrics-file", help="record metrics and write them here when the command ends, "
+                                               "as JSON for a .json file and Prometheus text otherwise")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser("disks", help="list disks")
+    commands.add_parser("df", help="show used and available space per disk")
+
+    fsck = commands.add_parser("fsck", help="recount the disk folders and fix the usage counters")
+    fsck.add_argument("--dry-run", action="store_true", help="only report differences")
+
+    add = commands.add_parser("add-disk", help="create a disk")
+    add.add_argument("name")
+    add.add_argument("size", type=int, help="size in bytes")
+    add.add_argument("--layout", choices=["files", "pack"], default="files",
+                     help="one file per chunk, or chunks packed into segment files")
+    add.add_argument("--fanout", type=parse_fanout, default=FANOUT,
+                     help="hash characters per chunk folder level, e.g. 2,2 (default) or flat")
+
+    migrate = commands.add_parser("migrate-layout", help="move chunk files into another folder fanout")
+    migrate.add_argument("fanout", type=parse_fanout, help="hash characters per folder level, e.g. 2,2 or flat")
+    migrate.add_argument("--disk", action="append", help="only migrate this disk (repeatable)")
+    migrate.add_argument("--workers", type=int, help="files moved in parallel")
+
+    remove = commands.add_parser("remove-disk", help="remove a disk")
+    remove.add_argument("name")
+    remove.add_argument("--bandwidth", type=float, help="limit chunk moves to this many MiB/s")
+
+    put = commands.add_parser("put", help="store a file, '-' reads stdin")
+    put.add_argument("path")
+    put.add_argument("--method", choices=["stripe", "mirror", "parity"], default="stripe")
+    put.add_argument("--parity", type=int, choices=[1, 2], default=1,
+                     help="parity chunks per stripe for --method parity (1 = RAID-5, 2 = RAID-6)")
+    put.add_argument("--name", help="name to store under (required for stdin)")
+
+    ingest = commands.add_parser("ingest", help="store folders and files in batches, skipping unchanged ones")
+    ingest.add_argument("paths", nargs="*", help="folders or files to store")
+    ingest.add_argument("--manifest", help="file listing one path per line, optionally a tab and a name")
+    ingest.add_argument("--method", choices=["stripe", "mirror", "parity"], default="stripe")
+    ingest.add_argument("--parity", type=int, choices=[1, 2], default=1,
+                        help="parity chunks per stripe for --method parity (1 = RAID-5, 2 = RAID-6)")
+    ingest.add_argument("--prefix", default="", help="put this folder in front of every stored name")
+    ingest.add_argument("--skip", choices=["none", "size", "mtime", "hash"], default="mtime",
+                        help="how a stored file is found unchanged (default: size and mtime)")
+    ingest.add_argument("--batch-files", type=int, help="files committed together")
+
+    get = commands.add_parser("get", help="retrieve a file, to stdout unless -o is given")
+    get.add_argument("name")
+    get.add_argument("-o", "--output")
+    get.add_argument("--offset", type=int, help="start at this byte instead of the beginning")
+    get.add_argument("--length", type=int, help="retrieve at most this many bytes")
+    get.add_argument("--verify", action="store_true", help="hash every chunk read, failing over from bad copies")
+
+    commands.add_parser("ls", help="list stored files")
+
+    rm = commands.add_parser("rm", help="delete a stored file")
+    rm.add_argument("name")
+
+    commands.add_parser("dedup", help="show deduplication totals")
+    commands.add_parser("compact", help="reclaim the space of deleted chunks on pack disks")
+
+    scrub = commands.add_parser("scrub", help="re-hash every chunk copy and repair the bad ones")
+    scrub.add_argument("--rate", type=float, help="read at most this many MiB/s")
+    scrub.add_argument("--no-repair", action="store_true", help="only report bad copies")
+    scrub.add_argument("--disk", action="append", help="only scrub this disk (repeatable)")
+
+    chunker = commands.add_parser("chunker", help="show or set how new files are cut into chunks")
+    chunker.add_argument("name", nargs="?", choices=["fixed", "cdc"])
+    chunker.add_argument("--min", type=int, help="smallest cdc chunk in bytes (default avg/4)")
+    chunker.add_argument("--avg", type=int, help="average cdc chunk, or the fixed block size, in bytes")
+    chunker.add_argument("--max", type=int, help="largest cdc chunk in bytes (default avg*4)")
+
+    compression = commands.add_parser("compression", help="show or set the codec new chunks are compressed with")
+    compression.add_argument("codec", nargs="?")
+
+    serve = commands.add_parser("serve", help="serve the volume over a socket, see server.py")
+    serve.add_argument("--socket", help="Unix socket path to listen on")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, help="TCP port to listen on")
+    serve.add_argument("--metrics-port", type=int, help="also answer Prometheus scrapes on this HTTP port")
+
+    hash_cmd = commands.add_parser("hash", help="show or set the volume's chunk hash algorithm")
+    hash_cmd.add_argument("algorithm", nargs="?")
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    san = VirtualSAN(args.root)
+    if args.metrics_file:
+        san.enable_metrics()
+    try:
+        return run_command(san, args) or 0
+    finally:
+        if args.metrics_file:
+            san.export_metrics(args.metrics_file)
+
+def run_command(san, args):
+    """Run the parsed command against the volume."""
+
+    if args.command == "disks":
+        for disk in san.disks():
+            print(f"{disk['name']}\t{disk['size']}")
+    elif args.command == "df":
+        for disk in san.disks():
+            total_size, used_size, available_size = san.disk_usage(disk["name"])
+            print(f"{disk['name']}\t{total_size}\t{used_size}\t{available_size}")
+    elif args.command == "fsck":
+        for disk_name, counts in san.fsck(repair=not args.dry_run).items():
+            matches = (counts["bytes"], counts["chunks"]) == (counts["recorded_bytes"], counts["recorded_chunks"])
+            status = "ok" if matches else "mismatch" if args.dry_run else "fixed"
+            print(f"{disk_name}\t{counts['chunks']} chunks\t{counts['bytes']} bytes\t{status}")
+    elif args.command == "add-disk":
+        san.add_disk(args.name, args.size, args.layout, args.fanout)
+    elif args.command == "migrate-layout":
+        san.migrate_layout(args.fanout, args.disk, args.workers, verbose=True)
+    elif args.command == "remove-disk":
+        bandwidth = args.bandwidth * 1024 * 1024 if args.bandwidth else None
+        san.remove_disk(args.name, bandwidth, verbose=True)
+    elif args.command == "put":
+        source = sys.stdin.buffer if args.path == "-" else args.path
+        file_metadata = san.put(source, args.method, args.name, args.parity)
+        print(f"{file_metadata['name']}\t{file_metadata['size']} bytes\t{chunk_count(file_metadata)} chunks")
+    elif args.command == "ingest":
+        if not args.paths and not args.manifest:
+            raise ValueError("Nothing to ingest: give paths or --manifest")
+        report = san.ingest(args.paths, args.method, args.manifest, args.prefix, args.parity, args.skip,
+                            args.batch_files, verbose=True)
+        print(f"{report['stored']} stored ({report['bytes']} bytes), {report['skipped']} unchanged, "
+              f"{len(report['failed'])} failed, {report['batches']} batches")
+        for path, error in report["failed"]:
+            print(f"failed\t{path}\t{error}")
+        if report["failed"]:
+            return 1
+    elif args.command == "get":
+        if args.verify:
+            san.set_verify_reads()
+        output = open(args.output, "wb") if args.output else sys.stdout.buffer
+        try:
+            if args.offset is not None or args.length is not None:
+                output.write(san.read(args.name, args.offset or 0, args.length))
+            else:
+                san.get_to(args.name, output, missing_ok=False)
+        finally:
+            if args.output:
+                output.close()
+    elif args.command == "ls":
+        for file_metadata in san.files():
+            print(f"{file_metadata['name']}\t{file_metadata['method']}\t{chunk_count(file_metadata)} chunks")
+    elif args.command == "rm":
+        san.delete(args.name)
+    elif args.command == "dedup":
+        for key, value in san.dedup_stats().items():
+            print(f"{key}\t{value}")
+    elif args.command == "compact":
+        for disk_name, reclaimed in san.compact().items():
+            print(f"{disk_name}\t{reclaimed} bytes reclaimed")
+    elif args.command == "scrub":
+        rate = args.rate * 1024 * 1024 if args.rate else None
+        report = san.scrub(rate, repair=not args.no_repair, disks=args.disk)
+        print(f"{report['checked']} copies, {report['bytes']} bytes checked in {report['seconds']:.1f}s")
+        for kind in ("missing", "corrupt", "repaired", "unrepairable"):
+            for chunk_hash, disk_name in report[kind]:
+                print(f"{kind}\t{chunk_hash}\t{disk_name}")
+        if report["unrepairable"] or (args.no_repair and (report["missing"] or report["corrupt"])):
+            return 1
+    elif args.command == "chunker":
+        if args.name:
+            san.set_chunker(args.name, args.min, args.avg, args.max)
+        else:
+            print(" ".join(f"{key}={value}" for key, value in san.chunker().items()))
+    elif args.command == "compression":
+        if args.codec:
+            san.set_compression(args.codec)
+        else:
+            print(f"{san.compression()} (available: {', '.join(san.compression_codecs())})")
+    elif args.command == "serve":
+        if not args.socket and not args.port:
+            raise ValueError("serve needs --socket or --port")
+        if args.metrics_port:
+            san.serve_metrics(args.metrics_port, args.host)
+        try:
+            serve(san, args.socket, args.host, args.port)
+        except KeyboardInterrupt:
+            pass
+    elif args.command == "hash":
+        if args.algorithm:
+            san.set_hash_algorithm(args.algorithm)
+        else:
+            print(f"{san.hash_algorithm()} (available: {', '.join(san.hash_algorithms())})")
+
+if __name__ == "__main__":
+    try:
+        sys.exit(main())
+    except (ValueError, OSError) as error:
+        print(f"error: {error}", file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,83 @@
+import zlib
+import lzma
+from integrity import CorruptChunkError
+
+# zstd is used when the package is installed
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+NO_CODEC = "none"
+SAMPLE_SIZE = 1024       # bytes of a chunk test-compressed before the whole chunk is
+SAMPLE_MIN_SAVING = 0.1  # a sample that shrinks less than this is treated as incompressible
+ZLIB_LEVEL = 6
+LZMA_PRESET = 1
+ZSTD_LEVEL = 3
+
+_COMPRESSORS = {
+    "zlib": lambda data: zlib.compress(data, ZLIB_LEVEL),
+    "lzma": lambda data: lzma.compress(data, preset=LZMA_PRESET),
+}
+_DECOMPRESSORS = {
+    "zlib": zlib.decompress,
+    "lzma": lzma.decompress,
+}
+if zstandard is not None:
+    _COMPRESSORS["zstd"] = lambda data: zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    _DECOMPRESSORS["zstd"] = lambda data: zstandard.ZstdDecompressor().decompress(data)
+
+def available_codecs():
+    """Return the compression codecs usable in this installation."""
+    return [NO_CODEC] + sorted(_COMPRESSORS)
+
+def check_codec(codec):
+    if codec != NO_CODEC and codec not in _COMPRESSORS:
+        raise ValueError(f"Compression codec '{codec}' is not available")
+
+def compress(codec, data):
+    """Compress data with a codec, whatever the result."""
+    if codec == NO_CODEC:
+        return data
+    return _COMPRESSORS[codec](data)
+
+def decompress(codec, data):
+    """Undo compress()."""
+    if codec == NO_CODEC:
+        return data
+    try:
+        decompressor = _DECOMPRESSORS[codec]
+    except KeyError:
+        raise ValueError(f"Compression codec '{codec}' is not available") from None
+    try:
+        return decompressor(data)
+    except Exception as error:
+        # Every codec has its own error type, damaged data is the same problem for all of them
+        raise CorruptChunkError(f"Chunk data does not decode as {codec}: {error}") from error
+
+def compress_chunk(codec, data):
+    """Return (codec used, stored bytes) for a chunk.
+
+    The first SAMPLE_SIZE bytes are compressed with fast zlib first, data
+    that is already compressed or random is stored as it is without paying
+    for a full compression. A chunk that does not get smaller is kept too.
+    """
+    if codec == NO_CODEC or not len(data):
+        return NO_CODEC, data
+    sample = data[:SAMPLE_SIZE]
+    if len(zlib.compress(sample, 1)) > len(sample) * (1 - SAMPLE_MIN_SAVING):
+        return NO_CODEC, data
+    compressed = compress(codec, data)
+    if len(compressed) >= len(data):
+        return NO_CODEC, data
+    return codec, compressed
+
+def prepare_chunk(hash_chunk, codec, data):
+    """Hash and compress a chunk on an ingest worker.
+
+    Returns (hash, codec used, stored bytes), the stored bytes are None when
+    the chunk is written as it is.
+    """
+    chunk_hash = hash_chunk(data)
+    used, payload = compress_chunk(codec, data)
+    return chunk_hash, used, None if used == NO_CODEC else payload
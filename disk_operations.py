@@ -1,160 +1,246 @@
 import os
-from metadata_handler import load_metadata, save_metadata, load_files_metadata, save_file_metadata
-
-DISK_FOLDER = "virtual_disks"
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from metadata_handler import load_metadata, update_metadata, get_disk_names, writable_disk_names
+from metadata_handler import disk_path
+from rebalance import rebalance_disk
+from file_operations import wait_for_batches
+from placement import forget_disk
+from usage import disk_counters, forget_disk_usage
+from pack import init_pack, close_pack, get_pack
+from sharding import FANOUT, check_fanout, disk_entry, get_layout, forget_layout, shard_path, iter_chunk_files
+from sharding import chunk_folders, make_folders, is_shard_folder
+from durability import fsync_dir
+from progress import ProgressReporter
 
 DEFAULT_DISK_SIZE = 100 # 10 MB (You can adjust this value)
+DISK_LAYOUTS = ("files", "pack")
+MIGRATE_WORKERS = 8  # threads moving chunk files, renames mostly wait on the file system
 
-def initialize_disks():
-    """Initialize disks from metadata or create new ones."""
+def get_disks():
+    """Return every disk as a {"name", "size"} entry."""
     metadata = load_metadata()
-    print("Existing disks:")
-    for disk in metadata["disks"]:
-        print(f"- {disk['name']} (Size: {disk['size']} bytes)")
-    
-    print("\nEnter new disk names and sizes to initialize (comma-separated, e.g. 'disk4, 5000000'): ")
-    new_disks = input().strip().split(":")
-    
-    for disk_input in new_disks:
-        disk_input = disk_input.strip()
-        if disk_input:
-            try:
-                name, size = disk_input.split()
-                size = int(size)
-            except ValueError:
-                print(f"Invalid input for disk '{disk_input}', skipping.")
-                continue
-
-            disk_path = os.path.join(DISK_FOLDER, name)
-            if not os.path.exists(disk_path):
-                os.makedirs(disk_path)
-                metadata["disks"].append({"name": name, "size": size})
-                print(f"Initialized new disk: {name} with size {size} bytes.")
-    
-    save_metadata(metadata)
-
-def add_disk():
-    """Add a disk to the system with size validation."""
-    disk_name = input("Enter the name of the new disk to add: ")
-    
-    # Get the disk size (in bytes)
-    disk_size = int(input("Enter the size of the disk in bytes (e.g., 10485760 for 10MB): "))
+    # Disks of old volumes are plain names without a size
+    return [disk if isinstance(disk, dict) else {"name": disk, "size": None} for disk in metadata["disks"]]
+
+def create_disk(disk_name, disk_size=DEFAULT_DISK_SIZE, layout="files", fanout=FANOUT):
+    """Add a disk to the system with size validation.
 
+    With the "pack" layout chunks are appended to segment files instead of
+    getting one file each, see pack.py. Chunk files of the "files" layout
+    are spread over folders by `fanout`, () keeps them flat, see sharding.py.
+    """
     # Check if the disk size is positive
     if disk_size <= 0:
-        print("Invalid disk size. It must be a positive number.")
-        return
-
-    # Load the existing disk metadata
-    metadata = load_metadata()
-    disk_names = [disk["name"] for disk in metadata["disks"]]
+        raise ValueError("Invalid disk size. It must be a positive number.")
+    if layout not in DISK_LAYOUTS:
+        raise ValueError(f"Unknown disk layout: {layout}")
+    fanout = check_fanout(fanout)
 
     # Check if the disk already exists
-    if disk_name in disk_names:
-        print(f"Disk '{disk_name}' already exists!")
-        return
-
-    # Add new disk metadata
-    metadata["disks"].append({"name": disk_name, "size": disk_size})
-
-    # Save the updated metadata
-    save_metadata(metadata)
+    if disk_name in get_disk_names(load_metadata()):
+        raise ValueError(f"Disk '{disk_name}' already exists!")
 
     # Create the new disk directory
-    disk_path = os.path.join(DISK_FOLDER, disk_name)
-    os.makedirs(disk_path, exist_ok=True)
-
-    # Set the disk size (in the virtualized environment, we assume we can add any disk)
-    print(f"Disk '{disk_name}' added with size {disk_size} bytes.")
-
-
-def delete_disk():
-    """Delete a disk and update metadata."""
-    disk_name = input("Enter the name of the disk to delete: ")
-    action = input("Choose action for the data on the disk (delete/mirror/stripe): ").lower()
-
+    os.makedirs(disk_path(disk_name), exist_ok=True)
+    if layout == "pack":
+        init_pack(disk_name)
+
+    # Add new disk metadata to the metadata as it is now, other writers may have changed it
+    disk = {"name": disk_name, "size": disk_size, "layout": layout}
+    if layout == "files" and fanout:
+        disk["fanout"] = list(fanout)
+
+    def add(metadata):
+        if disk_name in get_disk_names(metadata):
+            raise ValueError(f"Disk '{disk_name}' already exists!")
+        metadata["disks"].append(disk)
+    update_metadata(add)
+    forget_layout(disk_name)
+
+def remove_disk(disk_name, bandwidth=None, verbose=False):
+    """Delete a disk after moving its chunks onto the remaining disks.
+
+    The disk is marked "removing" first, so no new chunks are placed on it,
+    and stays marked if the removal is interrupted. The rebalance is
+    resumable, see rebalance.rebalance_disk(). The disk folder is only
+    deleted once the catalog no longer points at it.
+    """
     # Load metadata
     metadata = load_metadata()
-    disk_names = metadata["disks"]
+    disk_names = get_disk_names(metadata)
 
     if disk_name not in disk_names:
-        print(f"Disk '{disk_name}' not found!")
-        return
-
-    print(f"\nDeleting disk '{disk_name}'...")
-
-    # Perform action on data (mirror/stripe)
-    if action in ['mirror', 'stripe']:
-        print(f"Performing {action.upper()} on the data before deleting the disk...")
-
-        # Retrieve the files' metadata
-        files_metadata = load_files_metadata()
-
-        # For each file, stripe or mirror data across the remaining disks
-        for file_metadata in files_metadata:
-            if disk_name in file_metadata['disks']:
-                # Remove the deleted disk from the file's metadata
-                file_metadata['disks'].remove(disk_name)
-
-                # Handle striping or mirroring
-                if action == 'mirror':
-                    print(f"Mirroring chunks for file '{file_metadata['name']}' onto the remaining disks.")
-                    # Mirror data to other disks (duplicate on each remaining disk)
-                    for disk in disk_names:
-                        if disk != disk_name and disk not in file_metadata['disks']:
-                            file_metadata['disks'].append(disk)
-                            print(f"  Chunk mirrored to {disk}")
-                elif action == 'stripe':
-                    print(f"Stripping chunks for file '{file_metadata['name']}' onto the remaining disks.")
-                    # Stripe data across remaining disks (distribute data in chunks)
-                    remaining_disks = [disk for disk in disk_names if disk != disk_name]
-                    file_metadata['disks'] = remaining_disks
-                    print(f"  Data stripped across: {remaining_disks}")
-
-        # Update files metadata
-        save_file_metadata(files_metadata)
-
-    # Remove disk from the metadata
-    disk_names.remove(disk_name)
-    metadata["disks"] = disk_names
-
-    # Save updated metadata
-    save_metadata(metadata)
-    print(f"Disk '{disk_name}' deleted successfully!")
-
-def list_disks():
-    """List all the disks currently available in the system."""
-    metadata = load_metadata()
-    disk_names = metadata.get("disks", [])
-
-    if not disk_names:
-        print("No disks initialized yet.")
-    else:
-        print("\nList of available disks:")
-        for disk in disk_names:
-            print(f"- {disk['name']} (Size: {disk['size']} bytes)")
-
+        raise ValueError(f"Disk '{disk_name}' not found!")
+
+    # New chunks stay off the disk from now on, stores that were already
+    # writing to it finish first so the rebalance sees their chunks
+    _update_disk(disk_name, lambda disk: disk.update(removing=True))
+    wait_for_batches(disk_name)
+    remaining_disks = [name for name in writable_disk_names(load_metadata()) if name != disk_name]
+    copied, copied_bytes = rebalance_disk(disk_name, remaining_disks, bandwidth, verbose=verbose)
+    if verbose:
+        print(f"Moved {copied} chunks ({copied_bytes} bytes) off '{disk_name}'.")
+
+    # Remove disk from the metadata, as it is now rather than before the
+    # rebalance, which may have taken long enough for others to change it
+    def drop(metadata):
+        index, _ = disk_entry(metadata, disk_name)
+        del metadata["disks"][index]
+    update_metadata(drop)
+
+    # Release the disk folder now that nothing refers to it
+    close_pack(disk_name)
+    shutil.rmtree(disk_path(disk_name), ignore_errors=True)
+    forget_disk(disk_name)
+    forget_disk_usage(disk_name)
+    forget_layout(disk_name)
 
 def get_disk_usage(disk_name):
-    """Get the usage details for a given disk."""
-    disk_path = os.path.join(DISK_FOLDER, disk_name)
+    """Return (total, used, available) bytes for a disk, or None if it does not exist.
 
-    if not os.path.exists(disk_path):
+    Used bytes come from the usage counters, so this does not walk the disk.
+    A disk without a size can grow into the free space of the host folder.
+    """
+    disk = next((disk for disk in get_disks() if disk["name"] == disk_name), None)
+    if disk is None or not os.path.exists(disk_path(disk_name)):
         print(f"Disk {disk_name} does not exist.")
         return None
 
-    total_size = 0
-    used_size = 0
+    used_size, _ = disk_counters(disk_name)
+    if disk["size"]:
+        total_size = disk["size"]
+        available_size = max(0, total_size - used_size)
+    else:
+        available_size = shutil.disk_usage(disk_path(disk_name)).free
+        total_size = used_size + available_size
 
-    # Loop through all files in the disk folder to calculate space used
-    for root, dirs, files in os.walk(disk_path):
-        for file in files:
-            file_path = os.path.join(root, file)
-            if os.path.isfile(file_path):
-                total_size += os.path.getsize(file_path)
-                used_size += os.path.getsize(file_path)
+    return total_size, used_size, available_size
 
-    # We assume available size is total disk size minus used size
-    available_size = total_size  # Simplified assumption (no real limit here)
+def compact_disks(disk_names=None):
+    """Compact the segments of every pack disk and return the bytes reclaimed per disk."""
+    if disk_names is None:
+        disk_names = get_disk_names(load_metadata())
+    reclaimed = {}
+    for disk_name in disk_names:
+        pack = get_pack(disk_name)
+        if pack is not None:
+            reclaimed[disk_name] = pack.compact()
+    return reclaimed
+
+def _update_disk(disk_name, update):
+    def change(metadata):
+        index, disk = disk_entry(metadata, disk_name)
+        if not isinstance(disk, dict):
+            disk = {"name": disk, "size": None}
+        update(disk)
+        metadata["disks"][index] = disk
+    update_metadata(change)
+    forget_layout(disk_name)
+
+def _begin_migration(disk_name, fanout):
+    """Send new chunks of a disk to the `fanout` layout, remembering the layout they move from."""
+    if get_pack(disk_name) is not None:
+        raise ValueError(f"Disk '{disk_name}' packs its chunks into segments, it has no chunk files")
+    current, previous = get_layout(disk_name)
+    if previous is not None:
+        if current != fanout:
+            raise ValueError(f"Disk '{disk_name}' is being migrated to fanout {list(current)}, "
+                             "finish that migration first")
+        return
+    if current == fanout:
+        return
 
-    return total_size, used_size, available_size
+    def update(disk):
+        disk["fanout"] = list(fanout)
+        disk["migrating_from"] = list(current)
+    _update_disk(disk_name, update)
+
+def _end_migration(disk_name):
+    def update(disk):
+        disk.pop("migrating_from", None)
+        if not disk.get("fanout"):
+            disk.pop("fanout", None)
+    _update_disk(disk_name, update)
+
+def _move_chunk_file(disk_name, path, target):
+    """Move one chunk file to its new place, returning whether it was still there to move."""
+    try:
+        os.rename(path, target)
+    except FileNotFoundError:
+        if not os.path.exists(path):
+            # Deleted, or saved again in the new place, since the disk was listed
+            return False
+        make_folders(disk_name, target)
+        try:
+            os.rename(path, target)
+        except FileNotFoundError:
+            return False
+    return True
+
+def _remove_old_folders(disk_name, fanout):
+    """Remove the empty shard folders that are not part of the `fanout` layout."""
+    root = disk_path(disk_name)
+    for folder, _, _ in os.walk(root, topdown=False):
+        parts = os.path.relpath(folder, root).split(os.sep)
+        if folder == root or not all(is_shard_folder(part) for part in parts):
+            continue
+        if len(parts) <= len(fanout) and all(len(part) == width for part, width in zip(parts, fanout)):
+            continue
+        try:
+            os.rmdir(folder)
+        except OSError:
+            # Not empty
+            pass
+
+def migrate_disks(disk_names=None, fanout=FANOUT, workers=None, verbose=False):
+    """Move the chunk files of "files" disks into the `fanout` layout and return how many moved per disk.
+
+    The disks stay in use meanwhile, see sharding.py. The files of all disks
+    are renamed on one pool of `workers` threads.
+    """
+    fanout = check_fanout(fanout)
+    if disk_names is None:
+        disk_names = [disk["name"] for disk in get_disks() if disk.get("layout", "files") == "files"]
+    for disk_name in disk_names:
+        _begin_migration(disk_name, fanout)
+
+    moves = {}
+    total = 0
+    for disk_name in disk_names:
+        moves[disk_name] = []
+        for path, size in iter_chunk_files(disk_name):
+            target = shard_path(disk_path(disk_name), os.path.basename(path), fanout)
+            if os.path.normpath(path) != os.path.normpath(target):
+                moves[disk_name].append((path, target))
+                total += size
+
+    progress = ProgressReporter(total, "Migrating chunks") if verbose else None
+
+    def move(disk_name, path, target):
+        if not _move_chunk_file(disk_name, path, target):
+            return False
+        if progress is not None:
+            progress.update(os.path.getsize(target))
+        return True
+
+    moved = {}
+    with ThreadPoolExecutor(max_workers=workers or MIGRATE_WORKERS) as pool:
+        # Every disk's moves are queued at once, so the pool works on all disks together
+        results = {disk_name: [pool.submit(move, disk_name, path, target) for path, target in moves[disk_name]]
+                   for disk_name in disk_names}
+        for disk_name in disk_names:
+            done = [path for (path, _), future in zip(moves[disk_name], results[disk_name]) if future.result()]
+            moved[disk_name] = len(done)
+            # The renames are durable before the old layout is forgotten
+            chunk_hashes = [os.path.basename(path) for path in done]
+            for folder in dict.fromkeys(chunk_folders(disk_name, chunk_hashes) + [disk_path(disk_name)]):
+                fsync_dir(folder)
+            _remove_old_folders(disk_name, fanout)
+            _end_migration(disk_name)
+    if progress is not None:
+        progress.finish()
+    if verbose:
+        for disk_name in disk_names:
+            print(f"Moved {moved[disk_name]} chunk files on '{disk_name}' to fanout {list(fanout)}.")
+    return moved
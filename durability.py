@@ -0,0 +1,97 @@
+import os
+import json
+import threading
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+SYNC_WRITES = True  # False skips every fsync, for scratch volumes where speed matters more than crashes
+
+def fsync_fd(fd):
+    if SYNC_WRITES:
+        os.fsync(fd)
+
+def fsync_path(path):
+    """Flush a file that was written through another descriptor."""
+    if not SYNC_WRITES:
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def fsync_dir(path):
+    """Make files created, renamed or removed in a folder survive a crash."""
+    if not SYNC_WRITES or os.name != "posix":
+        # Folders cannot be opened for syncing everywhere
+        return
+    fsync_path(path)
+
+@contextmanager
+def file_lock(path):
+    """Hold an exclusive lock on a lock file, created if missing, against other processes.
+
+    The lock belongs to the open file, so a thread must not take it again
+    while holding it. Without fcntl, as on Windows, only threads of one
+    process are kept apart, by the locks of the callers.
+    """
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        # Closing the file releases the lock
+        os.close(fd)
+
+def write_json_atomic(path, data, **dump_options):
+    """Replace a JSON file so a crash leaves either the old or the new contents."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(data, file, **dump_options)
+        file.flush()
+        fsync_fd(file.fileno())
+    os.replace(tmp_path, path)
+    fsync_dir(os.path.dirname(path) or ".")
+
+class GroupCommit:
+    """Share fsync calls between threads appending to the same file.
+
+    Every append takes a ticket. wait(ticket, sync) returns once an fsync
+    that started after the append has finished. Threads that arrive while
+    an fsync is running wait for it, then the first of them runs one more
+    for all of them, so N concurrent commits cost about two fsyncs rather
+    than N.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._appended = 0
+        self._synced = 0
+        self._syncing = False
+
+    def ticket(self):
+        """Count an append, call this once the record is written."""
+        with self._condition:
+            self._appended += 1
+            return self._appended
+
+    def wait(self, ticket, sync):
+        with self._condition:
+            while self._synced < ticket:
+                if self._syncing:
+                    self._condition.wait()
+                    continue
+                self._syncing = True
+                covered = self._appended
+                self._condition.release()
+                try:
+                    sync()
+                finally:
+                    self._condition.acquire()
+                    self._syncing = False
+                    self._condition.notify_all()
+                self._synced = max(self._synced, covered)
@@ -1,125 +1,774 @@
 import os
-import hashlib
-from metadata_handler import load_metadata, load_files_metadata, save_file_metadata
+import bisect
+import itertools
+import threading
+from metadata_handler import load_metadata, update_metadata, writable_disk_names
+from metadata_handler import logical_chunks, stored_chunks, find_file_metadata, chunk_offsets
+from metadata_handler import delete_file_metadata, lookup_chunk, add_files_metadata
+from ingest_pipeline import IngestPipeline
+from read_pipeline import ReadPipeline
+from zero_copy import map_stream
+from chunking import FIXED_SIZE, FixedChunker, get_chunker
+from compressors import NO_CODEC, check_codec, compress, decompress
+from pack import get_pack
+from chunk_cache import get_cache
+from balancing import get_balancer
+from parity import compute_parity, reconstruct
+from placement import disk_capacities, choose_disk, reserve_if_room, release, refresh_usage, disk_full_error
+from usage import record_write, record_delete, flush_usage, fsck
+from journal import Transaction, read_transaction, abandoned_transactions, finish_transaction
+from durability import fsync_fd, fsync_dir
+from sharding import chunk_path, old_chunk_path, chunk_paths, chunk_folders, make_folders, reload_layout
+from progress import ProgressReporter
+from integrity import get_read_verifier, report_corrupt
+import metrics
+from hashing import DEFAULT_HASH_ALGORITHM, COLLISION_HASH_ALGORITHM, hash_data, get_hasher, needs_verification
 
-BLOCK_SIZE = 1024 * 1024 # 1 KB blocks
-DISK_FOLDER = "virtual_disks"
+BLOCK_SIZE = FIXED_SIZE  # 1 MiB blocks for the fixed chunker
+STORAGE_METHODS = ("stripe", "mirror", "parity")
 
-def calculate_hash(data):
+# Chunk hashes referenced by stores that have not committed yet
+_pinned_chunks = {}
+_chunk_refs_lock = threading.Lock()
+# StoreBatches that have not finished, they settle the copies deletes hand them
+_open_batches = set()
+# Notified whenever a StoreBatch finishes
+_batches_done = threading.Condition(_chunk_refs_lock)
+
+def calculate_hash(data, algorithm=DEFAULT_HASH_ALGORITHM):
     """Generate a hash for data."""
-    return hashlib.md5(data).hexdigest()
-
-def save_chunk(chunk, disk_path, chunk_hash):
-    """Save a data chunk to a specific disk."""
-    chunk_path = os.path.join(disk_path, chunk_hash)
-    with open(chunk_path, "wb") as chunk_file:
-        chunk_file.write(chunk)
-
-def store_file():
-    """Store a file across virtual disks and save its metadata."""
-    print("\nEnter the path of the file to store:")
-    file_path = input().strip()
-    if not os.path.isfile(file_path):
-        print(f"File not found: {file_path}")
-        return
+    return hash_data(algorithm, data)
+
+def get_hash_algorithm():
+    """Return the hash algorithm new files on this volume are chunked with."""
+    return load_metadata().get("hash_algorithm", DEFAULT_HASH_ALGORITHM)
+
+def set_hash_algorithm(algorithm):
+    """Choose the hash algorithm for files stored on this volume from now on."""
+    get_hasher(algorithm)  # raises ValueError if it is not available
+    update_metadata(lambda metadata: metadata.update(hash_algorithm=algorithm))
+
+def get_chunker_spec():
+    """Return how new files on this volume are cut into chunks, e.g. {"name": "fixed", "size": ...}."""
+    return load_metadata().get("chunker") or FixedChunker(BLOCK_SIZE).spec()
+
+def set_chunker(spec):
+    """Choose how files stored on this volume from now on are cut into chunks."""
+    spec = get_chunker(spec).spec()  # raises ValueError for unknown chunkers or bad sizes
+    update_metadata(lambda metadata: metadata.update(chunker=spec))
+
+def get_compression():
+    """Return the codec new chunks on this volume are compressed with, "none" if they are not."""
+    return load_metadata().get("compression", NO_CODEC)
+
+def set_compression(codec):
+    """Choose the codec for chunks stored on this volume from now on."""
+    check_codec(codec)
+    update_metadata(lambda metadata: metadata.update(compression=codec))
+
+def chunk_codec(chunk_hash):
+    """Return the codec the stored copies of a chunk are compressed with."""
+    chunk = lookup_chunk(chunk_hash)
+    return chunk["codec"] if chunk else NO_CODEC
+
+def entry_codec(entry):
+    """Return the codec a [hash, disk(, codec)] chunk entry names, entries without one are uncompressed."""
+    return entry[2] if len(entry) > 2 else NO_CODEC
 
-    print("Choose storage method (stripe/mirror):")
-    method = input().strip().lower()
+def file_codecs(file_metadata):
+    """Return a codec_of(chunk_hash) for reading a file, taken from its own chunk entries.
 
-    metadata = load_metadata()
-    disk_names = metadata["disks"]
-    if not disk_names:
-        print("No disks are available. Please initialize disks first.")
+    Looking codecs up in the chunk index would build it from every file in
+    the catalog on the first read.
+    """
+    codecs = {entry[0]: entry_codec(entry) for entry in file_metadata["chunks"]}
+    return lambda chunk_hash: codecs.get(chunk_hash) or chunk_codec(chunk_hash)
+
+def _file_size(path):
+    try:
+        return os.stat(path).st_size
+    except FileNotFoundError:
+        return None
+
+def _chunk_file_paths(disk_name, chunk_hash):
+    """Return the paths to try, in order, for the file of a chunk.
+
+    On a disk being migrated the old place comes after the new one, then
+    the new one again, in case the file was moved in between.
+    """
+    paths = chunk_paths(disk_name, chunk_hash)
+    return paths + paths[:1] if len(paths) > 1 else paths
+
+def _open_chunk_file(disk_name, chunk_hash, reload=True):
+    """Open the file of a chunk for reading and return its descriptor."""
+    for path in _chunk_file_paths(disk_name, chunk_hash):
+        try:
+            return os.open(path, os.O_RDONLY)
+        except FileNotFoundError as error:
+            missing = error
+    # Another process may have moved it to another layout
+    if reload and reload_layout(disk_name):
+        return _open_chunk_file(disk_name, chunk_hash, reload=False)
+    raise missing
+
+def save_chunk(chunk, disk_name, chunk_hash):
+    """Save a data chunk to a specific disk and count it in the disk's usage."""
+    pack = get_pack(disk_name)
+    if pack is not None:
+        replaced = pack.size(chunk_hash)
+    else:
+        path = chunk_path(disk_name, chunk_hash)
+        # On a disk being migrated the chunk may still be in the old place, it moves to the new one
+        old_path = old_chunk_path(disk_name, chunk_hash)
+        replaced = _file_size(path)
+        if replaced is None and old_path is not None:
+            replaced = _file_size(old_path)
+    # Counted before writing, a first count of an old disk must not see the file yet
+    record_write(disk_name, len(chunk), replaced)
+    metrics.count("disk_written_bytes", len(chunk), disk=disk_name)
+    with metrics.timer("chunk_write_seconds", disk=disk_name):
+        if pack is not None:
+            pack.put(chunk_hash, chunk)
+            return
+        try:
+            chunk_file = open(path, "wb")
+        except FileNotFoundError:
+            # The first chunk of its shard folder
+            make_folders(disk_name, path)
+            chunk_file = open(path, "wb")
+        with chunk_file:
+            chunk_file.write(chunk)
+        if old_path is not None:
+            try:
+                os.remove(old_path)
+            except FileNotFoundError:
+                pass
+
+def sync_chunks(disk_name, chunk_hashes):
+    """Flush chunks written to a disk to stable storage."""
+    pack = get_pack(disk_name)
+    if pack is not None:
+        pack.sync()
         return
+    for chunk_hash in chunk_hashes:
+        # Opened wherever it is, a migration may have begun since it was written
+        fd = _open_chunk_file(disk_name, chunk_hash)
+        try:
+            fsync_fd(fd)
+        finally:
+            os.close(fd)
+    for folder in chunk_folders(disk_name, chunk_hashes):
+        fsync_dir(folder)
+
+def rewrite_chunk(disk_name, chunk_hash, data):
+    """Replace a damaged or lost copy of a chunk with the stored bytes `data`.
+
+    Nothing is written unless the catalog still places the chunk on the
+    disk, checked under the same lock deletes hold, so a repair never
+    brings back a freed copy. Returns whether the copy was written.
+    """
+    with _chunk_refs_lock:
+        chunk = lookup_chunk(chunk_hash)
+        if chunk is None or disk_name not in chunk["disks"]:
+            return False
+        save_chunk(data, disk_name, chunk_hash)
+        sync_chunks(disk_name, [chunk_hash])
+    flush_usage()
+    return True
+
+def _remove_chunk_file(disk_name, chunk_hash):
+    chunk_size = None
+    # Both places of a disk being migrated, a chunk saved during the move can be in each
+    for path in _chunk_file_paths(disk_name, chunk_hash):
+        try:
+            size = os.stat(path).st_size
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        chunk_size = size
+    return chunk_size
+
+def remove_chunk(disk_name, chunk_hash):
+    """Remove a chunk from a disk and return its size, or None if it was not there."""
+    pack = get_pack(disk_name)
+    if pack is not None:
+        chunk_size = pack.delete(chunk_hash)
+    else:
+        chunk_size = _remove_chunk_file(disk_name, chunk_hash)
+        if chunk_size is None and reload_layout(disk_name):
+            # Moved to another layout by another process
+            chunk_size = _remove_chunk_file(disk_name, chunk_hash)
+    if chunk_size is not None:
+        record_delete(disk_name, chunk_size)
+    return chunk_size
 
-    print(f"\nStoring file '{file_path}' using method: {method.upper()}")
+class StoreBatch:
+    """Stores that share one ingest pipeline and commit together.
+
+    store_stream(..., batch=batch) runs a file through the batch's hash pool
+    and disk writers and logs its copies in the batch's journal transaction,
+    but adds nothing to the catalog. commit() syncs every disk once and
+    saves all the entries with one log write and one fsync. A store that
+    fails aborts the batch: none of its files are committed and the copies
+    it wrote that nothing references are removed.
+
+    The volume's disks, hash algorithm, chunker and compression are read
+    once, every file of the batch is stored with them.
+    """
+
+    def __init__(self, disk_names=None, hash_algorithm=None, chunker=None, compression=None,
+                 hash_queue_size=None, write_queue_size=None, hash_executor=None, label="batch"):
+        metadata = load_metadata()
+        self.disk_names = disk_names or writable_disk_names(metadata)
+        if not self.disk_names:
+            raise ValueError("No disks are available")
+        self.hash_algorithm = hash_algorithm or metadata.get("hash_algorithm", DEFAULT_HASH_ALGORITHM)
+        self.hasher = get_hasher(self.hash_algorithm)
+        self.verify = needs_verification(self.hash_algorithm)
+        self.chunker = get_chunker(chunker or metadata.get("chunker"))
+        self.compression = compression or metadata.get("compression", NO_CODEC)
+        check_codec(self.compression)
+        self.capacities = disk_capacities(metadata)
+        with _chunk_refs_lock:
+            pending = [reservation for batch in _open_batches for reservation in batch.reserved]
+        # Other processes may have written or freed chunks since the last batch
+        refresh_usage(pending)
+        self.entries = []
+        # Copies queued by the batch, so a repeated chunk is written only once
+        self.queued = {}
+        # Codec of every chunk the batch writes, all copies of a hash are stored alike
+        self.written_codecs = {}
+        # Bytes reserved for chunks the batch writes, given back if it fails
+        self.reserved = []
+        # Chunks pinned so a concurrent delete cannot free them before the commit
+        self.pinned = []
+        # (disk, hash, size) copies a delete released while the batch pinned
+        # their chunk, freed when it finishes if nothing uses them then
+        self.released = []
+        self.closed = False
+        self.transaction = Transaction("store", label)
+        self.pipeline = IngestPipeline(
+            self.disk_names,
+            self._write_chunk,
+            self.hasher,
+            hash_queue_size=hash_queue_size,
+            write_queue_size=write_queue_size,
+            hash_executor=hash_executor,
+            codec=self.compression,
+            sync_chunks=sync_chunks,
+        )
+        self.pipeline.start()
+        with _chunk_refs_lock:
+            _open_batches.add(self)
+
+    def _write_chunk(self, chunk, disk_name, chunk_hash):
+        # Logged first, so a crash before the commit can find and remove the copy
+        self.transaction.intend(disk_name, chunk_hash)
+        save_chunk(chunk, disk_name, chunk_hash)
+
+    def commit(self):
+        """Make every file stored in the batch durable and visible, and return their entries."""
+        try:
+            # The chunks are durable, the catalog records commit the stores
+            self.pipeline.close()
+            self.transaction.sync()
+            add_files_metadata(self.entries)
+        except BaseException:
+            self.abort()
+            raise
+        self._finish(committed=True)
+        return self.entries
+
+    def abort(self):
+        """Drop the batch and remove the copies it wrote that nothing references."""
+        if self.closed:
+            return
+        try:
+            self.pipeline.close()
+        except Exception:
+            # A failed write is why the batch is dropped, its copies are settled below
+            pass
+        for target_disk, size in self.reserved:
+            release(target_disk, size)
+        self._finish(committed=False)
+
+    def _finish(self, committed):
+        self.closed = True
+        _unpin_chunks(self.pinned, self)
+        if committed:
+            self.transaction.end()
+        else:
+            self.transaction.close()
+            _settle(self.transaction.path)
+        _free_released(self.released)
+        flush_usage()
+
+def store_stream(stream, name, method, disk_names=None, hash_queue_size=None, write_queue_size=None,
+                 hash_algorithm=None, hash_executor=None, parity=1, chunker=None, compression=None,
+                 verbose=False, batch=None):
+    """Store the contents of a binary stream across the disks and save its metadata.
+
+    The "parity" method keeps `parity` parity chunks per stripe: 1 survives
+    one lost disk (RAID-5), 2 survives two (RAID-6). `chunker` is a chunker
+    spec as returned by get_chunker_spec(), the volume's choice by default.
+    `compression` names the codec chunks are compressed with, by default the
+    volume's, see set_compression().
+
+    Chunk copies are logged in a journal transaction before they are
+    written and the catalog record commits the store, see journal.py. A store
+    that fails removes the copies it wrote.
+
+    With a StoreBatch the file is stored with the batch's settings and only
+    committed by batch.commit(), the other settings are ignored.
+
+    Returns the new file metadata entry, or raises ValueError for a bad method,
+    an unavailable hash algorithm or too few disks.
+    """
+    if method not in STORAGE_METHODS:
+        raise ValueError(f"Unknown storage method: {method}")
+    own_batch = batch is None
+    if own_batch:
+        batch = StoreBatch(disk_names, hash_algorithm, chunker, compression, hash_queue_size, write_queue_size,
+                           hash_executor, label=name)
+    try:
+        file_metadata = _store_in_batch(stream, name, method, parity, batch, verbose)
+        if own_batch:
+            batch.commit()
+    except BaseException:
+        batch.abort()
+        raise
+    return file_metadata
+
+def _store_in_batch(stream, name, method, parity, batch, verbose):
+    """Write a stream's chunks through a batch and add its entry to the batch."""
+    disk_names = batch.disk_names
+    if method == "parity":
+        if parity not in (1, 2):
+            raise ValueError("Parity must be 1 (RAID-5) or 2 (RAID-6)")
+        if len(disk_names) < parity + 2:
+            raise ValueError(f"Parity {parity} needs at least {parity + 2} disks")
+    hasher = batch.hasher
+    verify = batch.verify
+    chunker = batch.chunker
 
     file_metadata = {
-        "name": os.path.basename(file_path),
+        "name": name,
         "chunks": [],
-        "disks": disk_names,
-        "method": method
+        "disks": list(disk_names),
+        "method": method,
+        "hash_algorithm": batch.hash_algorithm,
+        "chunker": chunker.spec()
     }
+    if method == "parity":
+        stripe_width = len(disk_names) - parity
+        file_metadata["parity"] = parity
+        file_metadata["stripe_width"] = stripe_width
+        file_metadata["parity_chunks"] = []
+        stripe_data = []
+        stripe_disks = []
 
-    with open(file_path, "rb") as file:
-        index = 0  # Ensure we start indexing from 0
-        while chunk := file.read(BLOCK_SIZE):
-            chunk_hash = calculate_hash(chunk)
-
-            if method == "stripe":
-                # Ensure chunks are written in a round-robin fashion across disks
-                target_disk = disk_names[index % len(disk_names)]
-                target_path = os.path.join(DISK_FOLDER, target_disk)
-                save_chunk(chunk, target_path, chunk_hash)
-                file_metadata["chunks"].append((chunk_hash, target_disk))
-                index += 1  # Increment to move to the next disk
-
-            elif method == "mirror":
-                # Save the same chunk to all disks
-                for target_disk in disk_names:
-                    target_path = os.path.join(DISK_FOLDER, target_disk)
-                    save_chunk(chunk, target_path, chunk_hash)
-                    file_metadata["chunks"].append((chunk_hash, target_disk))
-
-    # Save the metadata to a JSON file
-    save_file_metadata(file_metadata)
-    print(f"\nFile '{file_path}' stored successfully!")
-import os
+    queued = batch.queued
+    pinned = batch.pinned
 
-def retrieve_file():
-    """Retrieve a stored file based on user selection."""
-    print("\nRetrieving a file:")
+    def held_copies(chunk_hash):
+        with _chunk_refs_lock:
+            # Pin the chunk so a concurrent delete cannot free it before we commit
+            _pinned_chunks[chunk_hash] = _pinned_chunks.get(chunk_hash, 0) + 1
+            pinned.append(chunk_hash)
+            indexed = lookup_chunk(chunk_hash)
+            held = set(indexed["disks"]) if indexed else set()
+        return held | queued.setdefault(chunk_hash, set())
 
-    metadata = load_metadata()
-    files_metadata = load_files_metadata()  # Load all stored files' metadata
+    def resolve(chunk_hash, chunk):
+        """Return the name to store a chunk under and the disks already holding it."""
+        held = held_copies(chunk_hash)
+        if held and verify and not _same_content(chunk_hash, held, chunk, written_codecs.get(chunk_hash)):
+            # The fast hash collided with other content, name this chunk by a cryptographic hash
+            chunk_hash = hash_data(COLLISION_HASH_ALGORITHM, chunk)
+            held = held_copies(chunk_hash)
+        return chunk_hash, held
 
-    if not files_metadata:
-        print("No files are stored. Please store some files first.")
-        return
+    capacities = batch.capacities
+    reserved = batch.reserved
 
-    print("Available files:")
-    for i, file_metadata in enumerate(files_metadata, 1):
-        print(f"{i}. {file_metadata['name']}")
-
-    # Let the user choose which file to retrieve
-    choice = int(input("\nEnter the number of the file you want to retrieve: "))
-    selected_file = files_metadata[choice - 1]
-
-    print(f"\nRetrieving file '{selected_file['name']}' using method: {selected_file['method']}")
-
-    # Set the default output folder
-    output_folder = "output"
-    # Create the output folder if it does not exist
-    os.makedirs(output_folder, exist_ok=True)
-    
-    # Define the path where the retrieved file will be saved
-    file_path_to_save = os.path.join(output_folder, selected_file["name"])
-
-    with open(file_path_to_save, "wb") as output_file:
-        for chunk_hash, disk_name in selected_file["chunks"]:
-            disk_path = os.path.join(DISK_FOLDER, disk_name)
-            chunk_path = os.path.join(disk_path, chunk_hash)
-            
-            if os.path.exists(chunk_path):
-                with open(chunk_path, "rb") as chunk_file:
-                    chunk = chunk_file.read()
-                    output_file.write(chunk)
-                print(f"  Retrieved chunk {chunk_hash[:8]} from {disk_name}")
-            else:
-                print(f"  Chunk {chunk_hash[:8]} not found on {disk_name}, skipping.")
-    
-    print(f"\nFile '{selected_file['name']}' retrieved and saved as: {file_path_to_save}")
-
-def list_files():
-    """List all files stored in the system with metadata."""
-    files_metadata = load_files_metadata()
-    
-    if not files_metadata:
-        print("No files are stored yet.")
-        return
+    def reserve_on(target_disk, size):
+        if not reserve_if_room(target_disk, capacities, size):
+            return False
+        reserved.append((target_disk, size))
+        return True
+
+    def spill(candidates, size):
+        """Reserve room on the least utilized candidate, or fail with ENOSPC."""
+        target_disk = choose_disk(candidates, capacities, size)
+        if target_disk is None:
+            raise disk_full_error(candidates, size)
+        reserved.append((target_disk, size))
+        return target_disk
+
+    written_codecs = batch.written_codecs
+
+    def encode_like_held(chunk_hash, held, chunk, encoded):
+        """Return the (codec, stored bytes or None) to write a chunk with."""
+        codec = written_codecs.get(chunk_hash) or (chunk_codec(chunk_hash) if held else None)
+        if codec is not None and codec != encoded[0]:
+            # Existing copies were stored with another codec, new replicas must match them
+            encoded = (codec, None if codec == NO_CODEC else compress(codec, chunk))
+        written_codecs[chunk_hash] = encoded[0]
+        return encoded
+
+    def place_in_stripe(position, chunk_hash, held, size):
+        """Return the disk for one chunk of a parity stripe."""
+        # Every chunk of a stripe sits on its own disk, the stripe's starting
+        # disk rotates so parity is spread over all of them
+        stripe = len(file_metadata["parity_chunks"])
+        target_disk = disk_names[(stripe + position) % len(disk_names)]
+        if target_disk not in held and not reserve_on(target_disk, size):
+            # The rotation's disk is full, use one no other chunk of the stripe
+            # is or will be on, or the stripe would not survive losing it
+            rotation = {disk_names[(stripe + index) % len(disk_names)] for index in range(stripe_width + parity)}
+            candidates = [disk for disk in disk_names if disk not in rotation and disk not in stripe_disks]
+            if not candidates:
+                raise disk_full_error([target_disk], size)
+            target_disk = spill(candidates, size)
+        stripe_disks.append(target_disk)
+        return target_disk
+
+    def write_parity():
+        """Compute and queue the parity chunks of the stripe collected so far."""
+        entries = []
+        for position, block in enumerate(compute_parity(stripe_data, parity)):
+            chunk_hash, held = resolve(hasher(block), block)
+            # Parity is written uncompressed unless it matches a compressed chunk
+            codec, payload = encode_like_held(chunk_hash, held, block, (NO_CODEC, None))
+            target_disk = place_in_stripe(stripe_width + position, chunk_hash, held,
+                                          len(block) if payload is None else len(payload))
+            if target_disk not in held:
+                pipeline.queue_write(target_disk, block if payload is None else payload, chunk_hash)
+            queued[chunk_hash].add(target_disk)
+            entries.append((chunk_hash, target_disk) if codec == NO_CODEC else (chunk_hash, target_disk, codec))
+        file_metadata["parity_chunks"].append(entries)
+        stripe_data.clear()
+        stripe_disks.clear()
+
+    progress = ProgressReporter(_stream_size(stream), f"Storing {name}") if verbose else None
+
+    def place(index, chunk_hash, chunk, encoded):
+        if progress is not None:
+            progress.update(len(chunk))
+        chunk_hash, held = resolve(chunk_hash, chunk)
+        encoded = encode_like_held(chunk_hash, held, chunk, encoded)
+        # Room is reserved for what is written, which the usage counters count too
+        size = len(chunk) if encoded[1] is None else len(encoded[1])
+
+        if method == "parity":
+            targets = [place_in_stripe(index % stripe_width, chunk_hash, held, size)]
+            stripe_data.append(chunk)
+            if len(stripe_data) == stripe_width:
+                write_parity()
+        elif method == "stripe":
+            # Reuse a disk that already holds this content, otherwise the
+            # least utilized disk with room takes the chunk
+            existing = [disk for disk in disk_names if disk in held]
+            targets = [existing[0] if existing else spill(disk_names, size)]
+        else:
+            # The same chunk goes to every disk
+            targets = disk_names
+            for target_disk in targets:
+                if target_disk not in held and not reserve_on(target_disk, size):
+                    raise disk_full_error([target_disk], size)
+
+        queued[chunk_hash].update(targets)
+        return chunk_hash, encoded, [(target_disk, target_disk not in held) for target_disk in targets]
+
+    pipeline = batch.pipeline
+    # A partial last stripe still gets its parity
+    finish = (lambda: stripe_data and write_parity()) if method == "parity" else None
+    # A regular file is mapped, so chunks are hashed and written straight from the page cache
+    source = map_stream(stream)
+    try:
+        file_metadata["chunks"] = pipeline.run(source, chunker, place, finish)
+    finally:
+        if source is not stream:
+            source.close()
+    file_metadata["sizes"] = pipeline.sizes
+    # Start of every chunk plus the end of the file, for range reads
+    file_metadata["offsets"] = list(itertools.accumulate(pipeline.sizes, initial=0))
+    file_metadata["size"] = pipeline.bytes_read
+    batch.entries.append(file_metadata)
+
+    if verbose:
+        progress.finish()
+        size_mib = pipeline.bytes_read / (1024 * 1024)
+        print(f"  Wrote {size_mib:.1f} MiB in {pipeline.elapsed:.2f}s ({pipeline.throughput():.1f} MiB/s), "
+              f"{pipeline.bytes_deduped / (1024 * 1024):.1f} MiB deduplicated")
+    return file_metadata
+
+def _stream_size(stream):
+    """Return the bytes left in a stream backed by a regular file, or None."""
+    try:
+        return os.fstat(stream.fileno()).st_size - stream.tell()
+    except (AttributeError, OSError, ValueError):
+        return None
+
+def _same_content(chunk_hash, disk_names, chunk, codec=None):
+    """Compare a chunk with a stored copy of the same name."""
+    # A copy that is not written yet or lost counts as different
+    return _read_any(chunk_hash, disk_names, codec) == chunk
+
+def _unpin_chunks(chunk_hashes, batch):
+    with _chunk_refs_lock:
+        # Together with the pins, so no delete hands the batch a copy it would not settle
+        _open_batches.discard(batch)
+        _batches_done.notify_all()
+        for chunk_hash in chunk_hashes:
+            _pinned_chunks[chunk_hash] -= 1
+            if not _pinned_chunks[chunk_hash]:
+                del _pinned_chunks[chunk_hash]
+
+def wait_for_batches(disk_name):
+    """Wait until no store of this process that may write to a disk is still open."""
+    with _batches_done:
+        _batches_done.wait_for(lambda: not any(disk_name in batch.disk_names for batch in _open_batches))
+
+def _hand_over(disk_name, chunk_hash, size):
+    """Leave a released copy of a pinned chunk to the stores pinning it."""
+    for batch in _open_batches:
+        if chunk_hash in batch.queued and (disk_name, chunk_hash, size) not in batch.released:
+            # Journaled, so recovery settles it if the store crashes
+            batch.transaction.intend(disk_name, chunk_hash)
+            batch.released.append((disk_name, chunk_hash, size))
+
+def _release_copy(disk_name, chunk_hash, size):
+    """Remove a copy nothing references and give its space back, returning whether a file was removed."""
+    cache = get_cache()
+    if cache is not None and lookup_chunk(chunk_hash) is None:
+        # Nothing references the chunk any more, give its cache space to live ones
+        cache.discard(chunk_hash)
+    stored = remove_chunk(disk_name, chunk_hash)
+    # A compressed copy gives back less than the chunk's size
+    release(disk_name, (size or 0) if stored is None else stored)
+    return stored is not None
+
+def _free_released(copies):
+    """Free the handed over copies a finished store did not end up referencing."""
+    with _chunk_refs_lock:
+        for disk_name, chunk_hash, size in copies:
+            if chunk_hash in _pinned_chunks:
+                _hand_over(disk_name, chunk_hash, size)
+                continue
+            chunk = lookup_chunk(chunk_hash)
+            if chunk is None or disk_name not in chunk["disks"]:
+                # An aborted store's settling may have removed the file already
+                _release_copy(disk_name, chunk_hash, size)
+
+def delete_stored_file(name):
+    """Remove a stored file and free the chunks no other file references.
+
+    Returns the number of chunk copies removed, or None if the file is unknown.
+    """
+    with _chunk_refs_lock:
+        file_metadata = find_file_metadata(name)
+        if file_metadata is None:
+            return None
+        # Journal every copy the file references, a crash after the commit frees them on recovery
+        transaction = Transaction("delete", name)
+        for chunk_hash, disk_names, _ in stored_chunks(file_metadata):
+            for disk_name in disk_names:
+                transaction.intend(disk_name, chunk_hash)
+        transaction.sync()
+        released = delete_file_metadata(name)
+        removed = 0
+        for chunk_hash, disk_name, size in released:
+            # A store in progress may reference this copy again, it frees it if not
+            if chunk_hash in _pinned_chunks:
+                _hand_over(disk_name, chunk_hash, size)
+                continue
+            if _release_copy(disk_name, chunk_hash, size):
+                removed += 1
+        transaction.end()
+    flush_usage()
+    return removed
+
+def _settle(path):
+    """Remove the copies a transaction logged that nothing references, then drop it.
+
+    Returns the number of copies removed.
+    """
+    removed = 0
+    with _chunk_refs_lock:
+        for disk_name, chunk_hash in read_transaction(path):
+            chunk = lookup_chunk(chunk_hash)
+            if (chunk is not None and disk_name in chunk["disks"]) or chunk_hash in _pinned_chunks:
+                continue
+            if remove_chunk(disk_name, chunk_hash) is not None:
+                removed += 1
+        finish_transaction(path)
+    return removed
+
+def recover_journal():
+    """Roll interrupted stores back and finish interrupted deletes after a crash.
+
+    Only transactions of processes that are no longer running are touched.
+    Returns the number of chunk copies removed.
+    """
+    abandoned = abandoned_transactions()
+    if not abandoned:
+        return 0
+    removed = sum(_settle(path) for path in abandoned)
+    # The crashed process counted writes it never flushed, recount the disks
+    fsck()
+    return removed
+
+def read_chunk(disk_name, chunk_hash):
+    """Read a chunk from a disk, raising FileNotFoundError if it is not there."""
+    pack = get_pack(disk_name)
+    with metrics.timer("chunk_read_seconds", disk=disk_name):
+        if pack is not None:
+            data = pack.read(chunk_hash)
+        else:
+            with open(_open_chunk_file(disk_name, chunk_hash), "rb") as chunk_file:
+                data = chunk_file.read()
+    metrics.count("disk_read_bytes", len(data), disk=disk_name)
+    return data
+
+def open_chunk(disk_name, chunk_hash):
+    """Return (fd, offset, length) of a chunk for reading, the caller closes fd.
+
+    The kernel is asked to start reading the chunk ahead.
+    """
+    pack = get_pack(disk_name)
+    with metrics.timer("chunk_read_seconds", disk=disk_name):
+        if pack is not None:
+            fd, offset, length = pack.open(chunk_hash)
+        else:
+            fd = _open_chunk_file(disk_name, chunk_hash)
+            offset, length = 0, os.fstat(fd).st_size
+    # The kernel copies these bytes later, they are counted as read now
+    metrics.count("disk_read_bytes", length, disk=disk_name)
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_WILLNEED)
+    return fd, offset, length
+
+def _retrieve_progress(file_metadata, verbose):
+    """Return a ProgressReporter for reading a whole file, or None when not verbose."""
+    if not verbose:
+        return None
+    return ProgressReporter(chunk_offsets(file_metadata)[-1], f"Retrieving {file_metadata['name']}")
+
+def _report_chunk(missing_ok=True, progress=None, file_metadata=None):
+    """Return an on_chunk callback that handles missing chunks and feeds `progress`.
+
+    Chunks arrive in file order, so their sizes come from the file's offset table.
+    """
+    if progress is not None:
+        offsets = chunk_offsets(file_metadata)
+        sizes = iter([end - start for start, end in zip(offsets, offsets[1:])])
+
+    def report(chunk_hash, disk_name):
+        if disk_name is None:
+            if not missing_ok:
+                raise IOError(f"Chunk {chunk_hash} is not readable from any disk")
+            print(f"  Chunk {chunk_hash[:8]} not found on any disk, skipping.")
+        if progress is not None:
+            progress.update(next(sizes, 0))
+    return report
+
+def _read_any(chunk_hash, disk_names, codec=None):
+    """Read and decompress a chunk from the first disk that has it, or return None.
+
+    `codec` defaults to the one the chunk index records.
+    """
+    for disk_name in disk_names:
+        try:
+            data = read_chunk(disk_name, chunk_hash)
+        except FileNotFoundError:
+            continue
+        return decompress(codec or chunk_codec(chunk_hash), data)
+    return None
+
+def _read_stripe(file_metadata, stripe, skip_index=None):
+    """Read the data and parity blocks of a stripe, None for unreadable ones."""
+    stripe_width = file_metadata["stripe_width"]
+    first = stripe * stripe_width
+    members = file_metadata["chunks"][first:first + stripe_width]
+    blocks = [None if first + i == skip_index else _read_any(chunk[0], [chunk[1]], entry_codec(chunk))
+              for i, chunk in enumerate(members)]
+    parity_blocks = [_read_any(chunk[0], [chunk[1]], entry_codec(chunk))
+                     for chunk in file_metadata["parity_chunks"][stripe]]
+    return blocks, parity_blocks, file_metadata["sizes"][first:first + stripe_width]
+
+def rebuild_chunk(file_metadata, index):
+    """Rebuild data chunk number `index` of a parity file from the rest of its stripe."""
+    stripe, position = divmod(index, file_metadata["stripe_width"])
+    blocks, parity_blocks, sizes = _read_stripe(file_metadata, stripe, skip_index=index)
+    blocks = reconstruct(blocks, parity_blocks, max(sizes))
+    return blocks[position][:sizes[position]]
+
+def rebuild_parity_chunk(file_metadata, stripe, position):
+    """Recompute parity chunk number `position` of a stripe from its data."""
+    blocks, parity_blocks, sizes = _read_stripe(file_metadata, stripe)
+    parity_blocks[position] = None
+    blocks = reconstruct(blocks, parity_blocks, max(sizes))
+    blocks = [block[:size] for block, size in zip(blocks, sizes)]
+    return compute_parity(blocks, file_metadata["parity"])[position]
+
+def _read_pipeline(file_metadata, read_ahead):
+    recover = None
+    if file_metadata["method"] == "parity":
+        recover = lambda index, chunk_hash: rebuild_chunk(file_metadata, index)
+    return ReadPipeline(read_chunk, read_ahead=read_ahead, recover=recover, open_chunk=open_chunk,
+                        codec_of=file_codecs(file_metadata), cache=get_cache(), balancer=get_balancer(),
+                        verify=get_read_verifier(), on_corrupt=report_corrupt)
+
+def iter_file_data(file_metadata, read_ahead=None, verbose=False, missing_ok=True):
+    """Yield the contents of a stored file block by block, in order.
+
+    With missing_ok False a chunk that no disk can provide raises IOError
+    instead of being skipped.
+    """
+    pipeline = _read_pipeline(file_metadata, read_ahead)
+    progress = _retrieve_progress(file_metadata, verbose)
+    yield from pipeline.iter_chunks(logical_chunks(file_metadata),
+                                    on_chunk=_report_chunk(missing_ok, progress, file_metadata))
+    if progress is not None:
+        progress.finish()
+
+def retrieve_to_stream(file_metadata, output, read_ahead=None, verbose=False, missing_ok=True):
+    """Write a stored file to a binary stream and return the hashes of missing chunks.
+
+    Chunk files are copied by the kernel when `output` is backed by a file
+    descriptor. With missing_ok False a missing chunk raises IOError.
+    """
+    pipeline = _read_pipeline(file_metadata, read_ahead)
+    progress = _retrieve_progress(file_metadata, verbose)
+    missing = pipeline.run(logical_chunks(file_metadata), output,
+                           on_chunk=_report_chunk(missing_ok, progress, file_metadata))
+    if progress is not None:
+        progress.finish()
+    return missing
+
+def read_range(file_metadata, offset, length=None, read_ahead=None):
+    """Return `length` bytes of a stored file starting at `offset`, all the rest without a length.
+
+    Only the chunks the range overlaps are read, found by bisecting the
+    file's offset table. A range reaching past the end of the file returns
+    fewer bytes. A chunk that no disk can provide raises IOError.
+    """
+    if offset < 0 or (length is not None and length < 0):
+        raise ValueError("Offset and length must not be negative")
+    offsets = chunk_offsets(file_metadata)
+    end = offsets[-1] if length is None else min(offset + length, offsets[-1])
+    if offset >= end:
+        return b""
+    first = bisect.bisect_right(offsets, offset) - 1
+    last = bisect.bisect_left(offsets, end)
+    chunks = logical_chunks(file_metadata)[first:last]
 
-    print("\nList of stored files:")
-    for i, file_metadata in enumerate(files_metadata, 1):
-        print(f"{i}. {file_metadata['name']} - Method: {file_metadata['method']}")
-        print(f"   Disks: {', '.join(file_metadata['disks'])}")
-        print(f"   Chunks: {len(file_metadata['chunks'])} chunks")
\ No newline at end of file
+    pipeline = _read_pipeline(file_metadata, read_ahead)
+    pieces = []
+    position = offsets[first]
+    for data in pipeline.iter_chunks(chunks, on_chunk=_report_chunk(missing_ok=False), start=first):
+        # Slices of a view, only the bytes returned are copied
+        pieces.append(memoryview(data)[max(0, offset - position):end - position])
+        position += len(data)
+    return b"".join(pieces)
@@ -0,0 +1,405 @@
+"""Compact in-memory forms of the entries in the files catalog.
+
+As plain JSON data every chunk reference of a file is a list of two or
+three strings, and a large volume holds millions of them. A FileRecord
+keeps a file's chunk lists packed into one bytes object instead: the
+binary digests one after another, then the disk and codec of every entry
+as 16-bit numbers into a table of names shared by the process, then the
+chunk sizes. The lists are unpacked only when they are read, and the
+last DECODED_FILES files read keep theirs unpacked.
+
+A ChunkRecord is one entry of the chunk index, with its disks and files
+held as short flat lists rather than dicts.
+
+Both answer the item lookups of the dicts they replace, so callers read
+file_metadata["chunks"] or chunk["disks"] as before.
+"""
+import sys
+import copy
+import base64
+import struct
+import itertools
+import threading
+from array import array
+from collections import OrderedDict
+
+DECODED_FILES = 64  # files whose unpacked chunk lists are kept
+
+_LIST_KEYS = ("chunks", "parity_chunks", "sizes")
+# Digest width, flags, chunk entries, parity stripes, parity entries, sizes
+_HEADER = struct.Struct("<BBIIII")
+_HAS_PARITY = 1
+_HAS_SIZES = 2
+_NO_CODEC_FIELD = 0xFFFF  # codec id of entries that name no codec
+_MAX_SIZE = 0xFFFFFFFF
+
+# Disk and codec names, a packed entry refers to them by position
+_names = []
+_name_ids = {}
+_names_lock = threading.Lock()
+
+# FileRecord -> its unpacked "chunks", "parity_chunks", "sizes" and "offsets", least recently read first
+_decoded = OrderedDict()
+_decoded_lock = threading.Lock()
+
+def name_table():
+    """Return the shared table of names, which only ever grows."""
+    return _names
+
+def _name_id(name):
+    name_id = _name_ids.get(name)
+    if name_id is None:
+        with _names_lock:
+            name_id = _name_ids.get(name)
+            if name_id is None:
+                name_id = len(_names)
+                _names.append(sys.intern(name))
+                _name_ids[name] = name_id
+    return name_id
+
+def table_for(names):
+    """Return the table to unpack entries packed against `names` with.
+
+    That is the shared table when the names are in it at the same
+    positions, which holds unless another process wrote them.
+    """
+    if [_name_id(name) for name in names] == list(range(len(names))):
+        return _names
+    return [sys.intern(name) for name in names]
+
+def _to_bytes(values):
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values.tobytes()
+
+def _from_bytes(typecode, data):
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+def pack_lists(chunks, parity_chunks=None, sizes=None):
+    """Pack a file's chunk lists, or return None if they do not fit the packed form.
+
+    Every hash must be lowercase hex of one length, and sizes must fit 32 bits.
+    """
+    parity_entries = [entry for entries in parity_chunks for entry in entries] if parity_chunks is not None else []
+    digests, disks, codecs = [], array("H"), array("H")
+    width = None
+    for entry in itertools.chain(chunks, parity_entries):
+        try:
+            digest = bytes.fromhex(entry[0])
+        except (TypeError, ValueError):
+            return None
+        if digest.hex() != entry[0] or (width is not None and len(digest) != width) or len(digest) > 255:
+            return None
+        width = len(digest)
+        digests.append(digest)
+        disk_id = _name_id(entry[1])
+        codec_id = _name_id(entry[2]) if len(entry) > 2 else _NO_CODEC_FIELD
+        if disk_id >= _NO_CODEC_FIELD or codec_id > _NO_CODEC_FIELD:
+            return None
+        disks.append(disk_id)
+        codecs.append(codec_id)
+    if sizes is not None and any(size > _MAX_SIZE or size < 0 for size in sizes):
+        return None
+
+    flags = (_HAS_PARITY if parity_chunks is not None else 0) | (_HAS_SIZES if sizes is not None else 0)
+    stripes = array("H", [len(entries) for entries in parity_chunks or []])
+    header = _HEADER.pack(width or 0, flags, len(chunks), len(stripes), len(parity_entries),
+                          len(sizes) if sizes is not None else 0)
+    return b"".join([header, *digests, _to_bytes(disks), _to_bytes(codecs), _to_bytes(stripes),
+                     _to_bytes(array("I", sizes or []))])
+
+def packed_entries(packed):
+    """Return the number of chunk entries, without parity, in packed lists."""
+    return _HEADER.unpack_from(packed)[2]
+
+def unpack_lists(packed, table):
+    """Return (chunks, parity chunks or None, sizes or None) from packed lists."""
+    width, flags, count, stripe_count, parity_count, size_count = _HEADER.unpack_from(packed)
+    total = count + parity_count
+    position = _HEADER.size
+    digests = packed[position:position + total * width]
+    position += total * width
+    disks = _from_bytes("H", packed[position:position + 2 * total])
+    position += 2 * total
+    codecs = _from_bytes("H", packed[position:position + 2 * total])
+    position += 2 * total
+    stripes = _from_bytes("H", packed[position:position + 2 * stripe_count])
+    position += 2 * stripe_count
+    sizes = _from_bytes("I", packed[position:position + 4 * size_count])
+
+    entries = []
+    for index in range(total):
+        chunk_hash = digests[index * width:(index + 1) * width].hex()
+        codec_id = codecs[index]
+        if codec_id == _NO_CODEC_FIELD:
+            entries.append([chunk_hash, table[disks[index]]])
+        else:
+            entries.append([chunk_hash, table[disks[index]], table[codec_id]])
+
+    parity_chunks = None
+    if flags & _HAS_PARITY:
+        parity_chunks, start = [], count
+        for length in stripes:
+            parity_chunks.append(entries[start:start + length])
+            start += length
+    return entries[:count], parity_chunks, list(sizes) if flags & _HAS_SIZES else None
+
+class FileRecord:
+    """One file of the catalog, read like the dict it was stored as."""
+
+    __slots__ = ("name", "method", "size", "extra", "entries", "_lists", "_table")
+
+    def __init__(self, name, method, size=None, extra=None):
+        self.name = name
+        self.method = method
+        self.size = size
+        self.extra = extra or {}
+        self.entries = 0
+        self._lists = None  # packed bytes, or a dict of the plain lists when they cannot be packed
+        self._table = _names
+
+    @classmethod
+    def from_dict(cls, file_metadata):
+        """Build a record from a plain entry, as stored by store_stream() or read from the log."""
+        extra = {key: value for key, value in file_metadata.items()
+                 if key not in ("name", "method", "size", "offsets") + _LIST_KEYS}
+        record = cls(file_metadata["name"], file_metadata["method"], file_metadata.get("size"), extra)
+        sizes = file_metadata.get("sizes")
+        if sizes is None and file_metadata.get("offsets") is not None:
+            offsets = file_metadata["offsets"]
+            sizes = [end - start for start, end in zip(offsets, offsets[1:])]
+        record._set_lists(file_metadata.get("chunks", []), file_metadata.get("parity_chunks"), sizes)
+        return record
+
+    @classmethod
+    def from_snapshot(cls, entry, table):
+        """Build a record from a snapshot entry holding "packed" lists, whose names are in `table`."""
+        extra = {key: value for key, value in entry.items() if key not in ("name", "method", "size", "packed")}
+        record = cls(entry["name"], entry["method"], entry.get("size"), extra)
+        record._lists = base64.b64decode(entry["packed"])
+        record._table = table
+        record.entries = packed_entries(record._lists)
+        return record
+
+    def _set_lists(self, chunks, parity_chunks, sizes):
+        packed = pack_lists(chunks, parity_chunks, sizes)
+        if packed is None:
+            packed = {"chunks": chunks, "parity_chunks": parity_chunks, "sizes": sizes}
+        with _decoded_lock:
+            self._lists = packed
+            self._table = _names
+            self.entries = len(chunks)
+            _decoded.pop(self, None)
+
+    def unpacked(self):
+        """Return (chunks, parity chunks or None, sizes or None) without keeping them unpacked."""
+        return self._unpack(self._lists)
+
+    def _unpack(self, lists):
+        if isinstance(lists, dict):
+            return lists["chunks"], lists["parity_chunks"], lists["sizes"]
+        return unpack_lists(lists, self._table)
+
+    def _present(self):
+        """Return whether the entry has parity chunks and whether it has chunk sizes."""
+        if isinstance(self._lists, dict):
+            return self._lists["parity_chunks"] is not None, self._lists["sizes"] is not None
+        flags = _HEADER.unpack_from(self._lists)[1]
+        return bool(flags & _HAS_PARITY), bool(flags & _HAS_SIZES)
+
+    def size_count(self):
+        """Return how many chunk sizes the entry keeps, one per logical chunk, or None without unpacking."""
+        if isinstance(self._lists, dict):
+            sizes = self._lists["sizes"]
+            return len(sizes) if sizes is not None else None
+        header = _HEADER.unpack_from(self._lists)
+        return header[5] if header[1] & _HAS_SIZES else None
+
+    def _decode(self):
+        with _decoded_lock:
+            state = _decoded.get(self)
+            if state is not None:
+                _decoded.move_to_end(self)
+                return state
+            lists = self._lists
+        chunks, parity_chunks, sizes = self._unpack(lists)
+        offsets = list(itertools.accumulate(sizes, initial=0)) if sizes is not None else None
+        state = {"chunks": chunks, "parity_chunks": parity_chunks, "sizes": sizes, "offsets": offsets}
+        with _decoded_lock:
+            # Lists replaced while these were unpacked are not kept
+            if self._lists is lists:
+                _decoded[self] = state
+                while len(_decoded) > DECODED_FILES:
+                    _decoded.popitem(last=False)
+        return state
+
+    def __getitem__(self, key):
+        if key == "name":
+            return self.name
+        if key == "method":
+            return self.method
+        if key == "size":
+            if self.size is None:
+                raise KeyError(key)
+            return self.size
+        if key in _LIST_KEYS or key == "offsets":
+            value = self._decode()[key]
+            if value is None:
+                raise KeyError(key)
+            return value
+        return self.extra[key]
+
+    def __setitem__(self, key, value):
+        if key in ("name", "method", "size"):
+            setattr(self, key, value)
+        elif key in _LIST_KEYS or key == "offsets":
+            chunks, parity_chunks, sizes = self.unpacked()
+            if key == "chunks":
+                chunks = value
+            elif key == "parity_chunks":
+                parity_chunks = value
+            elif key == "sizes":
+                sizes = value
+            else:
+                # Offsets are kept as the chunk sizes they are built from
+                sizes = [end - start for start, end in zip(value, value[1:])]
+            self._set_lists(chunks, parity_chunks, sizes)
+        else:
+            self.extra[key] = value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        if key in ("name", "method", "chunks"):
+            return True
+        if key == "size":
+            return self.size is not None
+        if key == "parity_chunks":
+            return self._present()[0]
+        if key in ("sizes", "offsets"):
+            return self._present()[1]
+        return key in self.extra
+
+    def keys(self):
+        has_parity, has_sizes = self._present()
+        keys = ["name", "method"] + (["size"] if self.size is not None else []) + list(self.extra) + ["chunks"]
+        return keys + (["parity_chunks"] if has_parity else []) + (["sizes"] if has_sizes else [])
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def to_dict(self):
+        """Return the entry as plain data, with its chunk lists unpacked."""
+        file_metadata = {"name": self.name, "method": self.method}
+        if self.size is not None:
+            file_metadata["size"] = self.size
+        file_metadata.update(self.extra)
+        chunks, parity_chunks, sizes = self.unpacked()
+        file_metadata["chunks"] = chunks
+        if parity_chunks is not None:
+            file_metadata["parity_chunks"] = parity_chunks
+        if sizes is not None:
+            file_metadata["sizes"] = sizes
+        return file_metadata
+
+    def snapshot_entry(self):
+        """Return the entry as written to a snapshot, its lists packed against the shared table."""
+        if isinstance(self._lists, dict):
+            return self.to_dict()
+        packed = self._lists
+        if self._table is not _names:
+            packed = pack_lists(*self.unpacked())
+        entry = {"name": self.name, "method": self.method}
+        if self.size is not None:
+            entry["size"] = self.size
+        entry.update(self.extra)
+        entry["packed"] = base64.b64encode(packed).decode("ascii")
+        return entry
+
+    def __copy__(self):
+        record = FileRecord(self.name, self.method, self.size, dict(self.extra))
+        record.entries, record._lists, record._table = self.entries, self._lists, self._table
+        return record
+
+    def __deepcopy__(self, memo):
+        record = self.__copy__()
+        record.extra = copy.deepcopy(self.extra, memo)
+        if isinstance(self._lists, dict):
+            record._lists = copy.deepcopy(self._lists, memo)
+        return record
+
+def _add(pairs, key, count):
+    """Add `count` to the value of `key` in a flat [key, value, ...] list and return the new value."""
+    if not pairs:
+        pairs.extend((key, count))
+        return count
+    for index in range(0, len(pairs), 2):
+        if pairs[index] == key:
+            pairs[index + 1] += count
+            if not pairs[index + 1]:
+                del pairs[index:index + 2]
+                return 0
+            return pairs[index + 1]
+    pairs.extend((key, count))
+    return count
+
+class ChunkRecord:
+    """One chunk of the chunk index, read like a {"refcount", "disks", "files", "size", "codec"} dict.
+
+    "disks" maps each disk holding a copy to its references and "files"
+    each entry id using the chunk to its references.
+    """
+
+    __slots__ = ("refcount", "size", "codec", "_disks", "_files")
+
+    def __init__(self):
+        self.refcount = 0
+        self.size = None
+        self.codec = "none"
+        self._disks = []
+        self._files = []
+
+    def add_disk(self, disk_name, count=1):
+        """Count references to the copy on a disk, returning the references left."""
+        return _add(self._disks, disk_name, count)
+
+    def add_file(self, entry_id, count=1):
+        return _add(self._files, entry_id, count)
+
+    def has_disk(self, disk_name):
+        return disk_name in self._disks[::2]
+
+    @property
+    def disks(self):
+        return dict(zip(self._disks[::2], self._disks[1::2]))
+
+    @property
+    def files(self):
+        return dict(zip(self._files[::2], self._files[1::2]))
+
+    def __getitem__(self, key):
+        if key in ("refcount", "size", "codec", "disks", "files"):
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in ("refcount", "size", "codec"):
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
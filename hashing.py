@@ -0,0 +1,61 @@
+import hashlib
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+# Optional faster hashers, used when the packages are installed
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+DEFAULT_HASH_ALGORITHM = "md5"
+COLLISION_HASH_ALGORITHM = "blake2b"  # names chunks whose fast hash collided
+
+# Every algorithm produces a 128-bit digest, so chunk names stay 32 hex characters
+_HASHERS = {
+    "md5": lambda data: hashlib.md5(data).hexdigest(),
+    "blake2b": lambda data: hashlib.blake2b(data, digest_size=16).hexdigest(),
+}
+if blake3 is not None:
+    _HASHERS["blake3"] = lambda data: blake3.blake3(data).hexdigest(length=16)
+if xxhash is not None:
+    _HASHERS["xxh3"] = lambda data: xxhash.xxh3_128_hexdigest(data)
+
+# Non-cryptographic hashes, a dedup hit is only trusted after comparing bytes
+UNVERIFIED_ALGORITHMS = {"xxh3"}
+
+_process_pool = None
+
+def available_algorithms():
+    """Return the hash algorithms usable in this installation."""
+    return sorted(_HASHERS)
+
+def hash_data(algorithm, data):
+    """Return the hex digest of data with the named algorithm."""
+    try:
+        hasher = _HASHERS[algorithm]
+    except KeyError:
+        raise ValueError(f"Hash algorithm '{algorithm}' is not available") from None
+    return hasher(data)
+
+def get_hasher(algorithm):
+    """Return a picklable one-argument hash function for an algorithm."""
+    if algorithm not in _HASHERS:
+        raise ValueError(f"Hash algorithm '{algorithm}' is not available")
+    return partial(hash_data, algorithm)
+
+def needs_verification(algorithm):
+    """Whether dedup hits for this algorithm must be confirmed byte for byte."""
+    return algorithm in UNVERIFIED_ALGORITHMS
+
+def get_process_pool(workers):
+    """Return the shared process pool used to hash off the ingest threads."""
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(max_workers=workers)
+    return _process_pool
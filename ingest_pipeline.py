@@ -0,0 +1,205 @@
+import os
+import time
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from hashing import get_process_pool
+from compressors import NO_CODEC, prepare_chunk
+import metrics
+
+# Pipeline sizing, memory in flight is roughly
+# (HASH_QUEUE_SIZE + WRITE_QUEUE_SIZE * number of disks) * chunk size
+HASH_WORKERS = os.cpu_count() or 2
+HASH_EXECUTOR = "thread"  # or "process" for hashers that hold the GIL
+HASH_QUEUE_SIZE = 8   # blocks read ahead and waiting on the hash pool
+WRITE_QUEUE_SIZE = 4  # chunks waiting on each disk writer
+
+class IngestPipeline:
+    """Read, hash and write chunks of a stream with one writer thread per disk.
+
+    The reader runs on the calling thread and hands blocks to a hash pool.
+    Hashed chunks are placed in file order and queued to the writer of every
+    target disk, so replicas and stripes are persisted concurrently. All
+    queues are bounded, which makes the reader wait when a disk falls behind.
+    Copies the placement reports as already present are referenced but not
+    written again. `stream.read()` may return memoryviews, they are hashed
+    and written without being copied. With a `codec` the hash pool also
+    compresses every chunk, see compressors.compress_chunk().
+    """
+
+    def __init__(self, disk_names, write_chunk, hash_chunk,
+                 hash_workers=None, hash_queue_size=None, write_queue_size=None, hash_executor=None,
+                 codec=None, sync_chunks=None):
+        self.disk_names = disk_names
+        self.write_chunk = write_chunk
+        self.hash_chunk = hash_chunk
+        self.codec = codec or NO_CODEC
+        self.sync_chunks = sync_chunks
+        self.hash_workers = hash_workers or HASH_WORKERS
+        self.hash_queue_size = hash_queue_size or HASH_QUEUE_SIZE
+        self.write_queue_size = write_queue_size or WRITE_QUEUE_SIZE
+        self.hash_executor = hash_executor or HASH_EXECUTOR
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.bytes_deduped = 0
+        self.sizes = []
+        self.codecs = []
+        self.elapsed = 0.0
+        self._errors = []
+        self._writer_queues = {}
+        self._writers = []
+        self._hash_pool = None
+
+    def _writer(self, disk_name, chunks):
+        """Persist queued chunks for one disk until the sentinel arrives."""
+        written = []
+        while True:
+            item = chunks.get()
+            if item is None:
+                chunks.task_done()
+                break
+            if self._errors:
+                # Keep draining so the reader never blocks on a dead writer
+                chunks.task_done()
+                continue
+            chunk, chunk_hash = item
+            try:
+                self.write_chunk(chunk, disk_name, chunk_hash)
+                written.append(chunk_hash)
+            except Exception as error:
+                self._errors.append(error)
+            chunks.task_done()
+        if self.sync_chunks and written and not self._errors:
+            try:
+                self.sync_chunks(disk_name, written)
+            except Exception as error:
+                self._errors.append(error)
+
+    def start(self):
+        """Start the disk writers and the hash pool, to keep them across several run() calls.
+
+        Chunks written by all of those runs are synced once, by close().
+        """
+        self._writer_queues = {
+            name: queue.Queue(maxsize=self.write_queue_size) for name in self.disk_names
+        }
+        self._writers = [
+            threading.Thread(target=self._writer, args=(name, chunks), daemon=True)
+            for name, chunks in self._writer_queues.items()
+        ]
+        for writer in self._writers:
+            writer.start()
+        # The process pool is shared between pipelines, a thread pool lives as long as this one
+        if self.hash_executor == "process":
+            self._hash_pool = get_process_pool(self.hash_workers)
+        else:
+            self._hash_pool = ThreadPoolExecutor(max_workers=self.hash_workers)
+
+    def close(self):
+        """Wait for the queued writes, sync them and stop the writers, raising the first write error."""
+        self._stop_workers()
+        if self._errors:
+            raise self._errors[0]
+
+    def _stop_workers(self):
+        if not self._writers:
+            return
+        for chunks in self._writer_queues.values():
+            chunks.put(None)
+        for writer in self._writers:
+            writer.join()
+        if self.hash_executor != "process":
+            self._hash_pool.shutdown()
+        self._writers = []
+
+    def queue_write(self, disk_name, chunk, chunk_hash):
+        """Queue an extra chunk, such as parity, to a disk writer during run()."""
+        self._writer_queues[disk_name].put((chunk, chunk_hash))
+        self.bytes_written += len(chunk)
+
+    def run(self, stream, chunker, place, finish=None):
+        """Ingest a stream cut by `chunker.split()` and return its (hash, disk[, codec]) chunk list.
+
+        `place(index, chunk_hash, chunk, encoded)` gets the (codec, stored
+        bytes or None) the pool produced. It returns the name to store chunk
+        number `index` under, the (codec, stored bytes or None) to write and
+        the (disk, needs_write) pairs of the disks it goes to. The size and
+        codec of every chunk are collected in `self.sizes` and `self.codecs`.
+        `finish()` runs after the last chunk is placed, while the writers can
+        still take queue_write() calls.
+
+        Without start() the writers and pool live for this run only. After
+        start() the run returns once its chunks are written, as the stream's
+        buffers may go away, and the counters describe this run alone.
+        """
+        started = time.perf_counter()
+        own_workers = not self._writers
+        if own_workers:
+            self.start()
+        self.bytes_read = self.bytes_written = self.bytes_deduped = 0
+        self.sizes = []
+        self.codecs = []
+        chunk_list = []
+
+        # Decided once per run, the pool returns (seconds, result) while metrics are on
+        timed = metrics.ENABLED
+
+        def dispatch(index, chunk, prepared):
+            if timed:
+                seconds, prepared = prepared
+                metrics.observe("hash_seconds", seconds)
+            chunk_hash, codec, payload = prepared
+            self.sizes.append(len(chunk))
+            chunk_hash, (codec, payload), targets = place(index, chunk_hash, chunk, (codec, payload))
+            self.codecs.append(codec)
+            for target_disk, needs_write in targets:
+                if needs_write:
+                    self.queue_write(target_disk, chunk if payload is None else payload, chunk_hash)
+                else:
+                    self.bytes_deduped += len(chunk)
+                # Compressed copies carry their codec in the chunk entry
+                chunk_list.append((chunk_hash, target_disk) if codec == NO_CODEC else (chunk_hash, target_disk, codec))
+
+        try:
+            prepare = partial(prepare_chunk, self.hash_chunk, self.codec)
+            if timed:
+                prepare = partial(metrics.timed_call, prepare)
+            pending = deque()
+            index = 0
+            for chunk in chunker.split(stream):
+                self.bytes_read += len(chunk)
+                # Worker processes need picklable bytes, threads hash memoryviews in place
+                hash_input = bytes(chunk) if self.hash_executor == "process" else chunk
+                pending.append((index, chunk, self._hash_pool.submit(prepare, hash_input)))
+                index += 1
+                # Hashes are consumed in file order once the read-ahead window is full
+                if len(pending) >= self.hash_queue_size:
+                    done_index, done_chunk, future = pending.popleft()
+                    dispatch(done_index, done_chunk, future.result())
+                if self._errors:
+                    break
+            while pending:
+                done_index, done_chunk, future = pending.popleft()
+                dispatch(done_index, done_chunk, future.result())
+            if finish and not self._errors:
+                finish()
+        finally:
+            if own_workers:
+                self._stop_workers()
+            else:
+                # The stream's buffers may be released once this returns
+                for chunks in self._writer_queues.values():
+                    chunks.join()
+            self.elapsed = time.perf_counter() - started
+
+        if self._errors:
+            raise self._errors[0]
+        return chunk_list
+
+    def throughput(self):
+        """Return the ingest rate of the last run in MiB/s."""
+        if not self.elapsed:
+            return 0.0
+        return self.bytes_read / self.elapsed / (1024 * 1024)
@@ -0,0 +1,81 @@
+"""Check chunk data against the hash that names it.
+
+A chunk is named by the hash of its uncompressed bytes, taken with the
+algorithm of the files that store it, or with COLLISION_HASH_ALGORITHM when
+that hash collided. Hashing runs on one pool shared by the scrubber and by
+verified reads, so both together never use more than HASH_WORKERS threads.
+
+With verified reads on, retrieves hash every chunk they read. A copy that
+fails is skipped for the next replica, or rebuilt from parity, and is
+remembered as a suspect for the scrubber to repair, see scrub.py.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from metadata_handler import files_with_chunk
+from hashing import DEFAULT_HASH_ALGORITHM, COLLISION_HASH_ALGORITHM, hash_data
+import metrics
+
+HASH_WORKERS = os.cpu_count() or 2  # threads hashing for the scrubber and verified reads
+VERIFY_READS = False
+
+class CorruptChunkError(IOError):
+    """Stored chunk data that does not decode or does not match its hash."""
+
+_hash_pool = None
+_pool_lock = threading.Lock()
+_suspects = set()  # (hash, disk) copies that failed a verified read
+_suspects_lock = threading.Lock()
+
+def get_hash_pool():
+    global _hash_pool
+    with _pool_lock:
+        if _hash_pool is None:
+            _hash_pool = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="verify")
+        return _hash_pool
+
+def chunk_algorithms(chunk_hash):
+    """Return the hash algorithms a chunk may be named with, most likely first."""
+    algorithms = [entry.get("hash_algorithm", DEFAULT_HASH_ALGORITHM) for entry in files_with_chunk(chunk_hash)]
+    return list(dict.fromkeys(algorithms + [COLLISION_HASH_ALGORITHM]))
+
+def matches(chunk_hash, data):
+    """Return whether data hashes to its chunk's name, or None if no available algorithm can tell."""
+    checked = False
+    for algorithm in chunk_algorithms(chunk_hash):
+        try:
+            if hash_data(algorithm, data) == chunk_hash:
+                return True
+        except ValueError:
+            # Stored with an algorithm this installation lacks
+            continue
+        checked = True
+    return False if checked else None
+
+def verify_chunk(chunk_hash, data):
+    """Hash a chunk on the shared pool, raising CorruptChunkError if it does not match."""
+    if get_hash_pool().submit(matches, chunk_hash, data).result() is False:
+        raise CorruptChunkError(f"Chunk {chunk_hash} does not match its hash")
+
+def report_corrupt(chunk_hash, disk_name):
+    """Remember a copy found bad outside a scrub, so the next scrub repairs it first."""
+    metrics.count("corrupt_copies", disk=disk_name)
+    with _suspects_lock:
+        _suspects.add((chunk_hash, disk_name))
+
+def suspects():
+    with _suspects_lock:
+        return sorted(_suspects)
+
+def clear_suspects(copies):
+    with _suspects_lock:
+        _suspects.difference_update(copies)
+
+def set_verify_reads(enabled):
+    """Hash every chunk retrieves read from now on, or stop with False."""
+    global VERIFY_READS
+    VERIFY_READS = enabled
+
+def get_read_verifier():
+    """Return the check retrieves run on each chunk, or None while verified reads are off."""
+    return verify_chunk if VERIFY_READS else None
@@ -0,0 +1,111 @@
+"""Write-ahead journal that keeps stores and deletes crash consistent.
+
+Each store or delete opens a transaction, a small log file under
+"journal/" in the storage folder named after the process. Before a store
+writes a chunk copy it logs the (disk, hash), and before a delete drops a
+file from the catalog it logs the copies the file references. The catalog
+record is the commit point, once it is durable the transaction file is
+removed.
+
+A transaction file left behind by a process that is gone means it crashed
+mid-operation. Settling it removes the logged copies the catalog does not
+reference: that rolls back a store that never committed, finishes a
+delete that committed but did not free its chunks yet, and keeps
+everything of a store or delete that did not get that far. See
+file_operations.recover_journal().
+"""
+import os
+import json
+import itertools
+import threading
+from metadata_handler import storage_path
+from durability import fsync_fd
+
+JOURNAL_FOLDER = "journal"
+
+_ids = itertools.count(1)
+
+def _journal_folder():
+    return storage_path(JOURNAL_FOLDER)
+
+class Transaction:
+    """The journal of one store or delete."""
+
+    def __init__(self, operation, name):
+        folder = _journal_folder()
+        os.makedirs(folder, exist_ok=True)
+        self.path = os.path.join(folder, f"{os.getpid()}-{next(_ids)}.log")
+        self._lock = threading.Lock()
+        self._file = open(self.path, "w")
+        self._log({"op": operation, "name": name})
+
+    def _log(self, record):
+        with self._lock:
+            self._file.write(json.dumps(record, separators=(",", ":")) + "\n")
+            # Written through to the OS, so a crash of this process cannot lose it
+            self._file.flush()
+
+    def intend(self, disk_name, chunk_hash):
+        """Log a chunk copy before it is written or released."""
+        self._log({"disk": disk_name, "hash": chunk_hash})
+
+    def sync(self):
+        """Make the records logged so far survive a power cut."""
+        with self._lock:
+            fsync_fd(self._file.fileno())
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def end(self):
+        """Close and remove the transaction, the operation is complete."""
+        self.close()
+        finish_transaction(self.path)
+
+def _process_alive(pid):
+    if pid == os.getpid():
+        return True
+    if os.name != "posix":
+        # Without signal 0 there is no cheap check, settling a live store would lose its chunks
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def read_transaction(path):
+    """Return the (disk, hash) copies a transaction file logged."""
+    copies = []
+    with open(path, "r") as file:
+        for line in file.readlines()[1:]:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Torn by the crash, the copy it named was never written
+                break
+            copies.append((record["disk"], record["hash"]))
+    return copies
+
+def abandoned_transactions():
+    """Return the transaction files of processes that no longer run."""
+    folder = _journal_folder()
+    if not os.path.isdir(folder):
+        return []
+    paths = []
+    for name in sorted(os.listdir(folder)):
+        pid = name.split("-", 1)[0]
+        if name.endswith(".log") and pid.isdigit() and not _process_alive(int(pid)):
+            paths.append(os.path.join(folder, name))
+    return paths
+
+def finish_transaction(path):
+    """Remove a settled transaction file.
+
+    Not synced, a transaction that reappears after a crash is settled again
+    without changing anything.
+    """
+    os.remove(path)
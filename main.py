@@ -1,8 +1,167 @@
-from disk_operations import initialize_disks, list_disks, add_disk, delete_disk
-from file_operations import store_file, retrieve_file, list_files
+import os
+from virtual_san import VirtualSAN
+from metadata_handler import chunk_count
+
+# Opened by main_menu(), opening it recovers unfinished stores, so importing this does not
+san = None
+
+def initialize_disks():
+    """Initialize disks from metadata or create new ones."""
+    print("Existing disks:")
+    for disk in san.disks():
+        print(f"- {disk['name']} (Size: {disk['size']} bytes)")
+
+    print("\nEnter new disk names and sizes to initialize (colon-separated, e.g. 'disk4 5000000:disk5 5000000'): ")
+    new_disks = input().strip().split(":")
+
+    for disk_input in new_disks:
+        disk_input = disk_input.strip()
+        if disk_input:
+            try:
+                name, size = disk_input.split()
+                san.add_disk(name, int(size))
+            except ValueError as error:
+                print(f"Invalid input for disk '{disk_input}', skipping. {error}")
+                continue
+            print(f"Initialized new disk: {name} with size {size} bytes.")
+
+def list_disks():
+    """List all the disks currently available in the system."""
+    disks = san.disks()
+    if not disks:
+        print("No disks initialized yet.")
+    else:
+        print("\nList of available disks:")
+        for disk in disks:
+            total_size, used_size, available_size = san.disk_usage(disk["name"])
+            print(f"- {disk['name']} (Size: {total_size} bytes, Used: {used_size} bytes, "
+                  f"Available: {available_size} bytes)")
+
+def add_disk():
+    """Add a disk to the system with size validation."""
+    disk_name = input("Enter the name of the new disk to add: ")
+    try:
+        disk_size = int(input("Enter the size of the disk in bytes (e.g., 10485760 for 10MB): "))
+        san.add_disk(disk_name, disk_size)
+    except ValueError as error:
+        print(error)
+        return
+    print(f"Disk '{disk_name}' added with size {disk_size} bytes.")
+
+def delete_disk():
+    """Delete a disk after moving its data to the remaining disks."""
+    disk_name = input("Enter the name of the disk to delete: ")
+    print(f"\nDeleting disk '{disk_name}'...")
+    try:
+        san.remove_disk(disk_name, verbose=True)
+    except (ValueError, IOError) as error:
+        print(error)
+        return
+    print(f"Disk '{disk_name}' deleted successfully!")
+
+def choose_file(action):
+    """Let the user pick a stored file, returning its metadata or None."""
+    files_metadata = san.files()
+    if not files_metadata:
+        print("No files are stored. Please store some files first.")
+        return None
+
+    print("Available files:")
+    for i, file_metadata in enumerate(files_metadata, 1):
+        print(f"{i}. {file_metadata['name']}")
+
+    choice = int(input(f"\nEnter the number of the file you want to {action}: "))
+    return files_metadata[choice - 1]
+
+def store_file():
+    """Store a file across virtual disks and save its metadata."""
+    print("\nEnter the path of the file to store:")
+    file_path = input().strip()
+    if not os.path.isfile(file_path):
+        print(f"File not found: {file_path}")
+        return
+
+    print("Choose storage method (stripe/mirror/parity):")
+    method = input().strip().lower()
+    parity = 1
+    if method == "parity":
+        parity = int(input("Parity chunks per stripe (1 = RAID-5, 2 = RAID-6): ").strip() or 1)
+
+    print(f"\nStoring file '{file_path}' using method: {method.upper()}")
+    try:
+        san.put(file_path, method, parity=parity, verbose=True)
+    except (ValueError, OSError) as error:
+        print(error)
+        return
+    print(f"\nFile '{file_path}' stored successfully!")
+
+def retrieve_file():
+    """Retrieve a stored file based on user selection."""
+    print("\nRetrieving a file:")
+    selected_file = choose_file("retrieve")
+    if selected_file is None:
+        return
+
+    print(f"\nRetrieving file '{selected_file['name']}' using method: {selected_file['method']}")
+
+    # Set the default output folder
+    output_folder = "output"
+    os.makedirs(output_folder, exist_ok=True)
+    file_path_to_save = os.path.join(output_folder, selected_file["name"])
+
+    try:
+        with open(file_path_to_save, "wb") as output_file:
+            san.get_to(selected_file["name"], output_file, verbose=True, missing_ok=False)
+    except IOError as error:
+        # A file with a chunk left out is worse than no file
+        os.remove(file_path_to_save)
+        print(f"\nCannot retrieve '{selected_file['name']}': {error}")
+        return
+
+    print(f"\nFile '{selected_file['name']}' retrieved and saved as: {file_path_to_save}")
+
+def list_files():
+    """List all files stored in the system with metadata."""
+    files_metadata = san.files()
+    if not files_metadata:
+        print("No files are stored yet.")
+        return
+
+    print("\nList of stored files:")
+    for i, file_metadata in enumerate(files_metadata, 1):
+        print(f"{i}. {file_metadata['name']} - Method: {file_metadata['method']}")
+        print(f"   Disks: {', '.join(file_metadata['disks'])}")
+        print(f"   Chunks: {chunk_count(file_metadata)} chunks")
+
+def delete_file():
+    """Delete a stored file chosen by the user."""
+    selected_file = choose_file("delete")
+    if selected_file is None:
+        return
+    removed = san.delete(selected_file["name"])
+    print(f"File '{selected_file['name']}' deleted, {removed} unreferenced chunks freed.")
+
+def dedup_report():
+    """Show how much space content deduplication is saving."""
+    stats = san.dedup_stats()
+    if not stats["files"]:
+        print("No files are stored yet.")
+        return
+
+    ratio = stats["logical_bytes"] / stats["unique_bytes"] if stats["unique_bytes"] else 1.0
+    print("\nDeduplication report:")
+    print(f"  Files stored:        {stats['files']}")
+    print(f"  Chunk references:    {stats['chunk_references']}")
+    print(f"  Unique chunks:       {stats['unique_chunks']}")
+    print(f"  Logical data:        {stats['logical_bytes']} bytes")
+    print(f"  Unique data:         {stats['unique_bytes']} bytes")
+    print(f"  Stored on disks:     {stats['physical_bytes']} bytes (including replicas)")
+    print(f"  Dedup ratio:         {ratio:.2f}x")
 
 def main_menu():
     """Main menu to interact with the virtual storage system."""
+    global san
+    san = VirtualSAN()
     while True:
         print("\nMenu:")
         print("1. Initialize Disks")
@@ -12,10 +171,12 @@ def main_menu():
         print("5. Store File")
         print("6. Retrieve File")
         print("7. List Stored Files")
-        print("8. Exit")
-        
+        print("8. Delete Stored File")
+        print("9. Dedup Report")
+        print("10. Exit")
+
         choice = input("Enter your choice: ").strip()
-        
+
         if choice == '1':
             initialize_disks()
         elif choice == '2':
@@ -31,6 +192,10 @@ def main_menu():
         elif choice == '7':
             list_files()
         elif choice == '8':
+            delete_file()
+        elif choice == '9':
+            dedup_report()
+        elif choice == '10':
             print("Exiting...")
             break
         else:
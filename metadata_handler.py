@@ -1,9 +1,49 @@
 import os
 import json
+import itertools
+import threading
+from durability import write_json_atomic, fsync_fd, fsync_dir, fsync_path, file_lock, GroupCommit
+from file_records import FileRecord, ChunkRecord, name_table, table_for
+import metrics
 
 # Constants
 METADATA_FILE = "virtual_disks/metadata.json"
 DISK_FOLDER = "virtual_disks/"
+FILES_METADATA_FILE = "virtual_disks/files_metadata.json"  # compacted snapshot
+FILES_METADATA_LOG = "virtual_disks/files_metadata.log"  # append-only records since the snapshot
+COMPACT_THRESHOLD = 1000  # log records that trigger a background compaction
+COMPACT_RATIO = 0.5       # a large catalog compacts once its log has this many records per entry
+
+# In-memory view of the files catalog, shared by every caller in this process
+_catalog = None
+_catalog_lock = threading.RLock()
+# Held while metadata.json is rewritten, so threads never lose each other's changes
+_metadata_lock = threading.RLock()
+_compaction_thread = None
+# Bumped whenever the catalog is replaced as a whole, a compaction that
+# started before then would bring back the entries it replaced
+_catalog_epoch = 0
+# Log appends wait here until an fsync covers them, see durability.GroupCommit
+_log_commits = GroupCommit()
+
+def set_storage_root(root):
+    """Keep disks and metadata under another folder and drop the cached catalog."""
+    global DISK_FOLDER, METADATA_FILE, FILES_METADATA_FILE, FILES_METADATA_LOG, _catalog, _catalog_epoch
+    with _catalog_lock:
+        _catalog_epoch += 1
+        DISK_FOLDER = root
+        METADATA_FILE = os.path.join(root, "metadata.json")
+        FILES_METADATA_FILE = os.path.join(root, "files_metadata.json")
+        FILES_METADATA_LOG = os.path.join(root, "files_metadata.log")
+        _catalog = None
+
+def disk_path(disk_name):
+    """Return the folder that backs a disk."""
+    return os.path.join(DISK_FOLDER, disk_name)
+
+def storage_path(name):
+    """Return the path of a file kept at the top of the storage folder."""
+    return os.path.join(DISK_FOLDER, name)
 
 def load_metadata():
     """Load disk metadata from the JSON file."""
@@ -13,24 +53,598 @@ def load_metadata():
     return {"disks": []}
 
 def save_metadata(metadata):
-    """Save disk metadata to the JSON file."""
-    with open(METADATA_FILE, "w") as file:
-        json.dump(metadata, file, indent=4)
+    """Save disk metadata to the JSON file, replacing it atomically."""
+    with _metadata_lock, metrics.timer("metadata_save_seconds"):
+        write_json_atomic(METADATA_FILE, metadata, indent=4)
+
+def update_metadata(change):
+    """Load the disk metadata, apply change(metadata) to it and save it, with no other thread or process in between."""
+    with _metadata_lock, file_lock(METADATA_FILE + ".lock"):
+        metadata = load_metadata()
+        change(metadata)
+        save_metadata(metadata)
+
+def metadata_signature():
+    """Return a signature of metadata.json that changes whenever it is saved, by any process."""
+    return _file_signature(METADATA_FILE)
+
+def get_disk_names(metadata):
+    """Return disk names, whether disks are stored as names or {"name", "size"} entries."""
+    return [disk["name"] if isinstance(disk, dict) else disk for disk in metadata["disks"]]
+
+def writable_disk_names(metadata):
+    """Return the disks new chunks may go to, every disk but those being emptied for removal."""
+    return [disk["name"] if isinstance(disk, dict) else disk for disk in metadata["disks"]
+            if not (isinstance(disk, dict) and disk.get("removing"))]
+
+def logical_chunks(file_metadata):
+    """Return the file's chunks in order as (hash, [disks holding a replica]) pairs.
+
+    Mirrored files store one (hash, disk) entry per replica, one after another.
+    """
+    chunks = []
+    for chunk in file_metadata["chunks"]:
+        chunk_hash, disk_name = chunk[0], chunk[1]
+        # A repeated disk means the next chunk happens to have the same content
+        if (file_metadata["method"] == "mirror" and chunks and chunks[-1][0] == chunk_hash
+                and disk_name not in chunks[-1][1]):
+            chunks[-1][1].append(disk_name)
+        else:
+            chunks.append((chunk_hash, [disk_name]))
+    return chunks
+
+def chunk_offsets(file_metadata):
+    """Return the byte offset each logical chunk of a file starts at, followed by the file size.
+
+    The table is sorted, so the chunk holding a byte is found with bisect.
+    Files record it when they are stored, it is built from the chunk sizes
+    for older entries.
+    """
+    offsets = file_metadata.get("offsets")
+    if offsets is None:
+        sizes = file_metadata.get("sizes")
+        if sizes is None:
+            by_chunk = _chunk_index(_load_catalog())
+            sizes = []
+            for chunk_hash, disk_names in logical_chunks(file_metadata):
+                chunk = by_chunk[_chunk_key(chunk_hash)]
+                if chunk.size is None:
+                    chunk.size = _chunk_file_size(chunk_hash, disk_names)
+                sizes.append(chunk.size)
+        offsets = file_metadata["offsets"] = list(itertools.accumulate(sizes, initial=0))
+    return offsets
+
+def stored_chunks(file_metadata):
+    """Yield every chunk a file references as (hash, [disks], size or None).
+
+    This covers the data chunks and, for the "parity" method, the parity
+    chunks, which are as large as the biggest data chunk of their stripe.
+    """
+    sizes = file_metadata.get("sizes")
+    for index, (chunk_hash, disk_names) in enumerate(logical_chunks(file_metadata)):
+        yield chunk_hash, disk_names, sizes[index] if sizes else None
+
+    stripe_width = file_metadata.get("stripe_width")
+    for stripe, entries in enumerate(file_metadata.get("parity_chunks", [])):
+        size = max(sizes[stripe * stripe_width:(stripe + 1) * stripe_width])
+        for entry in entries:
+            yield entry[0], [entry[1]], size
+
+def chunk_count(file_metadata):
+    """Return how many chunks a file is cut into, the replicas of a mirrored chunk counted once.
+
+    A catalog record answers without unpacking its lists, unless it is
+    mirrored and was stored before chunk sizes were recorded.
+    """
+    if file_metadata["method"] != "mirror":
+        return file_metadata.entries if isinstance(file_metadata, FileRecord) else len(file_metadata["chunks"])
+    if isinstance(file_metadata, FileRecord) and file_metadata.size_count() is not None:
+        return file_metadata.size_count()
+    return len(logical_chunks(file_metadata))
+
+def _chunk_key(chunk_hash):
+    """Return the chunk index key of a hash, its digest bytes unless it is not lowercase hex."""
+    try:
+        digest = bytes.fromhex(chunk_hash)
+    except ValueError:
+        return chunk_hash
+    return digest if digest.hex() == chunk_hash else chunk_hash
+
+def _chunk_hash(key):
+    return key.hex() if isinstance(key, bytes) else key
+
+def _file_signature(path):
+    """Return a cheap (mtime, size, inode) signature used to notice outside changes."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+def _log_lock():
+    """Hold the lock that orders log appends, compaction and overwrites across processes.
+
+    Take it after _catalog_lock, then reload the catalog, so the records
+    other processes appended are applied before the next seq is picked.
+    """
+    return file_lock(FILES_METADATA_LOG + ".lock")
+
+def _new_catalog():
+    return {
+        "files": {},      # entry id -> FileRecord, in insertion order
+        "by_name": {},    # file name -> ids of the entries with that name, latest last
+        "by_chunk": None, # chunk key -> ChunkRecord, built on first use by _chunk_index()
+        "next_id": 0,
+        "seq": 0,         # sequence number of the last applied record
+        "log_records": 0,
+        "log_size": 0,    # bytes of the log read, up to the end of its last complete record
+        "signature": None,
+    }
+
+def _plain_lists(record):
+    """Return what stored_chunks() reads of a record, unpacked without being cached."""
+    chunks, parity_chunks, sizes = record.unpacked()
+    file_metadata = {"method": record.method, "chunks": chunks, "stripe_width": record.get("stripe_width")}
+    if parity_chunks is not None:
+        file_metadata["parity_chunks"] = parity_chunks
+    if sizes is not None:
+        file_metadata["sizes"] = sizes
+    return file_metadata
+
+def _index_chunks(by_chunk, entry_id, record):
+    """Add the chunks of an entry to the chunk index.
+
+    Every chunk maps to its reference count, the number of references per
+    disk holding a copy, the entries that use it, its size in bytes and the
+    codec its copies are compressed with.
+    """
+    file_metadata = _plain_lists(record)
+    for chunk_hash, disk_names, size in stored_chunks(file_metadata):
+        key = _chunk_key(chunk_hash)
+        chunk = by_chunk.get(key)
+        if chunk is None:
+            chunk = by_chunk[key] = ChunkRecord()
+        chunk.refcount += 1
+        chunk.add_file(entry_id)
+        for disk_name in disk_names:
+            chunk.add_disk(disk_name)
+        if size is not None:
+            chunk.size = size
+
+    # Compressed copies are entries with a third field naming the codec
+    parity_entries = [entry for entries in file_metadata.get("parity_chunks", []) for entry in entries]
+    for entry in file_metadata["chunks"] + parity_entries:
+        if len(entry) > 2:
+            by_chunk[_chunk_key(entry[0])].codec = entry[2]
+
+def _chunk_index(catalog):
+    """Return the chunk index of the catalog, building it from every entry the first time.
+
+    Listing and finding files do not need it, so a process that only does
+    those never unpacks a chunk list.
+    """
+    if catalog["by_chunk"] is None:
+        with _catalog_lock:
+            if catalog["by_chunk"] is None:
+                by_chunk = {}
+                for entry_id, record in catalog["files"].items():
+                    _index_chunks(by_chunk, entry_id, record)
+                catalog["by_chunk"] = by_chunk
+    return catalog["by_chunk"]
+
+def _index_file(catalog, file_metadata):
+    """Add a file entry, plain or a FileRecord, to the catalog and its indexes."""
+    record = file_metadata if isinstance(file_metadata, FileRecord) else FileRecord.from_dict(file_metadata)
+    entry_id = catalog["next_id"]
+    catalog["next_id"] += 1
+    catalog["files"][entry_id] = record
+    catalog["by_name"].setdefault(record.name, []).append(entry_id)
+    if catalog["by_chunk"] is not None:
+        _index_chunks(catalog["by_chunk"], entry_id, record)
+
+def _unindex_file(catalog, entry_id):
+    """Remove a file entry from the catalog.
+
+    Returns the (hash, disk, size) copies that no other entry references
+    any more, which are only known once the chunk index is built.
+    """
+    record = catalog["files"].pop(entry_id)
+    names = catalog["by_name"][record.name]
+    names.remove(entry_id)
+    if not names:
+        del catalog["by_name"][record.name]
+    if catalog["by_chunk"] is None:
+        return []
+    return _unindex_chunks(catalog["by_chunk"], entry_id, record)
+
+def _unindex_chunks(by_chunk, entry_id, record):
+    """Take the chunks of an entry out of the chunk index and return the copies nothing references now."""
+    released = []
+    for chunk_hash, disk_names, _ in stored_chunks(_plain_lists(record)):
+        key = _chunk_key(chunk_hash)
+        chunk = by_chunk[key]
+        chunk.refcount -= 1
+        chunk.add_file(entry_id, -1)
+        for disk_name in disk_names:
+            if not chunk.add_disk(disk_name, -1):
+                released.append((chunk_hash, disk_name, chunk.size))
+        if not chunk.refcount:
+            del by_chunk[key]
+    return released
+
+def _apply_record(catalog, record):
+    """Apply one log record to the catalog and return what it released."""
+    released = []
+    if record["op"] == "put":
+        _index_file(catalog, record["file"])
+    elif record["op"] == "delete":
+        entry_ids = catalog["by_name"].get(record["name"])
+        if entry_ids:
+            released = _unindex_file(catalog, entry_ids[-1])
+    elif record["op"] == "relocate":
+        _relocate(catalog, record["disk"], record["targets"])
+    catalog["seq"] = record["seq"]
+    return released
+
+def _relocate(catalog, disk_name, targets):
+    """Point the entries' copies of chunks on a disk at the disks in `targets` (hash -> disk)."""
+    by_chunk = catalog["by_chunk"]
+    for entry_id, record in catalog["files"].items():
+        disks = record.get("disks")
+        if disks is not None and disk_name not in disks:
+            continue
+        file_metadata = _relocated(record.to_dict(), disk_name, targets)
+        if file_metadata is None:
+            continue
+        relocated = FileRecord.from_dict(file_metadata)
+        if by_chunk is not None:
+            # The copies on the departing disk go with it, nothing frees them one by one
+            _unindex_chunks(by_chunk, entry_id, record)
+            _index_chunks(by_chunk, entry_id, relocated)
+        catalog["files"][entry_id] = relocated
+
+def _relocated(file_metadata, disk_name, targets):
+    """Return a file entry with its copies on a disk moved to their targets, or None if it has none there."""
+    parity_entries = [entry for entries in file_metadata.get("parity_chunks", []) for entry in entries]
+    if not any(entry[1] == disk_name and entry[0] in targets for entry in file_metadata["chunks"] + parity_entries):
+        return None
+
+    # Codecs are kept per hash, every copy of a chunk is stored alike
+    codecs = {entry[0]: entry[2:] for entry in file_metadata["chunks"]}
+    chunks = []
+    for chunk_hash, disk_names in logical_chunks(file_metadata):
+        if disk_name in disk_names and chunk_hash in targets:
+            # A mirror replica whose target already holds the chunk is just dropped
+            disk_names = list(dict.fromkeys(targets[chunk_hash] if name == disk_name else name
+                                            for name in disk_names))
+        chunks.extend([chunk_hash, name, *codecs[chunk_hash]] for name in disk_names)
+    file_metadata["chunks"] = chunks
+
+    if "parity_chunks" in file_metadata:
+        file_metadata["parity_chunks"] = [
+            [[entry[0], targets[entry[0]] if entry[1] == disk_name and entry[0] in targets else entry[1], *entry[2:]]
+             for entry in entries]
+            for entries in file_metadata["parity_chunks"]
+        ]
+
+    used = {entry[1] for entry in file_metadata["chunks"]}
+    used.update(entry[1] for entries in file_metadata.get("parity_chunks", []) for entry in entries)
+    disks = [name for name in file_metadata.get("disks", []) if name != disk_name]
+    file_metadata["disks"] = disks + sorted(used - set(disks))
+    return file_metadata
+
+def _read_catalog():
+    """Build the catalog from the snapshot plus the records logged after it."""
+    catalog = _new_catalog()
+    signature = _catalog_signature()
+
+    if os.path.exists(FILES_METADATA_FILE):
+        with open(FILES_METADATA_FILE, "r") as file:
+            snapshot = json.load(file)
+        # Older installs stored a plain list of file entries
+        if isinstance(snapshot, list):
+            snapshot = {"seq": 0, "files": snapshot}
+        # Entries of older snapshots, and those that cannot be packed, are plain
+        table = table_for(snapshot.get("names", []))
+        for entry in snapshot["files"]:
+            _index_file(catalog, FileRecord.from_snapshot(entry, table) if "packed" in entry else entry)
+        catalog["seq"] = snapshot["seq"]
+
+    _read_log(catalog, signature)
+    return catalog
+
+def _read_log(catalog, signature):
+    """Apply the complete records logged after the part of the log already read.
+
+    A line that is not complete is left for later, it is either still being
+    written by another process or was torn by a crash and is cut off by the
+    next append.
+    """
+    if os.path.exists(FILES_METADATA_LOG):
+        with open(FILES_METADATA_LOG, "rb") as log:
+            if signature[1] is None or os.fstat(log.fileno()).st_ino != signature[1][2]:
+                # Replaced by a compaction since the signature was taken, read it all next time
+                catalog["signature"] = None
+                return
+            log.seek(catalog["log_size"])
+            for line in log:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                catalog["log_size"] += len(line)
+                catalog["log_records"] += 1
+                # Records already folded into the snapshot are skipped
+                if record["seq"] > catalog["seq"]:
+                    _apply_record(catalog, record)
+    catalog["signature"] = signature
+
+def _catalog_signature():
+    return _file_signature(FILES_METADATA_FILE), _file_signature(FILES_METADATA_LOG)
+
+def _load_catalog():
+    """Return the cached catalog, reloading it if the files changed on disk."""
+    global _catalog
+    with _catalog_lock:
+        signature = _catalog_signature()
+        previous = _catalog["signature"] if _catalog is not None else None
+        if previous is None or previous != signature:
+            log_signature = signature[1]
+            if (previous is not None and previous[0] == signature[0]
+                    and log_signature is not None and log_signature[1] >= _catalog["log_size"]):
+                # Only appended to, by another process, since the snapshot is
+                # replaced whenever the log is
+                _read_log(_catalog, signature)
+            else:
+                with metrics.timer("catalog_load_seconds"):
+                    _catalog = _read_catalog()
+        return _catalog
+
+def _write_snapshot(records, seq, path=None):
+    """Atomically replace the snapshot, or write it to `path`, with the given FileRecords packed."""
+    with metrics.timer("catalog_save_seconds", kind="snapshot"):
+        entries = [record.snapshot_entry() for record in records]
+        # Read after packing, which may add names
+        snapshot = {"seq": seq, "names": list(name_table()), "files": entries}
+        write_json_atomic(path or FILES_METADATA_FILE, snapshot, separators=(",", ":"))
+
+def _append_record(catalog, record):
+    """Append a record to the log and apply it to the in-memory catalog.
+
+    Returns what the record released and a ticket for _wait_durable().
+    """
+    return _append_records(catalog, [record])
+
+def _append_records(catalog, records):
+    """Append records to the log with one write and apply them in order.
+
+    Called holding _catalog_lock and _log_lock(), with the catalog loaded
+    under them. Returns what the records released and a ticket for
+    _wait_durable().
+    """
+    if os.path.exists(FILES_METADATA_LOG) and os.path.getsize(FILES_METADATA_LOG) > catalog["log_size"]:
+        # A write torn by a crash never committed, cut it off so new records follow the valid ones
+        with open(FILES_METADATA_LOG, "r+b") as log:
+            log.truncate(catalog["log_size"])
+            fsync_fd(log.fileno())
+    lines = []
+    for seq, record in enumerate(records, catalog["seq"] + 1):
+        record["seq"] = seq
+        if isinstance(record.get("file"), FileRecord):
+            record["file"] = record["file"].to_dict()
+        lines.append(json.dumps(record, separators=(",", ":")) + "\n")
+    data = "".join(lines).encode()
+    with open(FILES_METADATA_LOG, "ab") as log:
+        log.write(data)
+    ticket = _log_commits.ticket()
+    released = []
+    for record in records:
+        released.extend(_apply_record(catalog, record))
+    catalog["log_records"] += len(records)
+    catalog["log_size"] += len(data)
+    catalog["signature"] = _catalog_signature()
+
+    # Rewriting a snapshot of millions of entries every thousand records
+    # would make bulk loads quadratic, the log may grow with the catalog
+    if catalog["log_records"] >= max(COMPACT_THRESHOLD, COMPACT_RATIO * len(catalog["files"])):
+        _start_background_compaction()
+    return released, ticket
+
+def _wait_durable(ticket):
+    """Return once the log record with this ticket is on stable storage.
+
+    Called without the catalog lock, so other writers append while one
+    fsync covers them all. Compaction syncs the log it swaps in, so syncing
+    whichever file is current is enough.
+    """
+    _log_commits.wait(ticket, _sync_log)
+
+def _sync_log():
+    try:
+        fsync_path(FILES_METADATA_LOG)
+    except FileNotFoundError:
+        # Replaced by a snapshot, which was synced before the log went away
+        pass
 
 def load_files_metadata():
-    """Load metadata of stored files."""
-    files_metadata_path = "virtual_disks/files_metadata.json"
-    if os.path.exists(files_metadata_path):
-        with open(files_metadata_path, "r") as file:
-            return json.load(file)
-    return []
+    """Load metadata of stored files.
+
+    The entries are FileRecords, read like dicts, shared with the in-memory
+    catalog. Callers that modify them must write them back with
+    save_file_metadata(..., overwrite=True).
+    """
+    return list(_load_catalog()["files"].values())
 
 def save_file_metadata(file_metadata, overwrite=False):
-    """Save metadata for a stored file."""
-    if not overwrite :
-        files_metadata = load_files_metadata()
-        files_metadata.append(file_metadata)
-    else:
-        files_metadata = file_metadata
-    with open("virtual_disks/files_metadata.json", "w") as file:
-        json.dump(files_metadata, file, indent=4)
+    """Save metadata for a stored file, returning once it is durable."""
+    global _catalog, _catalog_epoch
+    if not overwrite:
+        with metrics.timer("catalog_save_seconds", kind="log"):
+            with _catalog_lock, _log_lock():
+                _, ticket = _append_record(_load_catalog(), {"op": "put", "file": file_metadata})
+            _wait_durable(ticket)
+        return
+
+    with _catalog_lock, _log_lock():
+        catalog = _load_catalog()
+
+        # Overwrite replaces the whole catalog with the given list of entries
+        _catalog_epoch += 1
+        records = [entry if isinstance(entry, FileRecord) else FileRecord.from_dict(entry) for entry in file_metadata]
+        _write_snapshot(records, catalog["seq"])
+        if os.path.exists(FILES_METADATA_LOG):
+            os.remove(FILES_METADATA_LOG)
+        _catalog = _new_catalog()
+        for record in records:
+            _index_file(_catalog, record)
+        _catalog["seq"] = catalog["seq"]
+        _catalog["signature"] = _catalog_signature()
+
+def add_files_metadata(entries):
+    """Save many new file entries with one log write, returning once they are durable."""
+    if not entries:
+        return
+    with metrics.timer("catalog_save_seconds", kind="log"):
+        with _catalog_lock, _log_lock():
+            _, ticket = _append_records(_load_catalog(), [{"op": "put", "file": entry} for entry in entries])
+        _wait_durable(ticket)
+
+def delete_file_metadata(name):
+    """Remove the latest entry stored under a file name.
+
+    Returns the (hash, disk, size) chunk copies that are no longer referenced
+    by any file and can be removed from their disks, or None if the name is
+    unknown.
+    """
+    with metrics.timer("catalog_save_seconds", kind="log"):
+        with _catalog_lock, _log_lock():
+            catalog = _load_catalog()
+            if name not in catalog["by_name"]:
+                return None
+            # The copies the delete releases are counted in the chunk index
+            _chunk_index(catalog)
+            released, ticket = _append_record(catalog, {"op": "delete", "name": name})
+        _wait_durable(ticket)
+    return released
+
+def relocate_chunks(disk_name, targets):
+    """Point every entry's copies of chunks on a disk at the disks now holding them.
+
+    `targets` maps chunk hashes to their new disk. The change is one log
+    record applied to the catalog as it is under the lock, so files stored
+    meanwhile, by any process, are kept. Returns once it is durable.
+    """
+    with metrics.timer("catalog_save_seconds", kind="log"):
+        with _catalog_lock, _log_lock():
+            _, ticket = _append_record(_load_catalog(), {"op": "relocate", "disk": disk_name, "targets": targets})
+        _wait_durable(ticket)
+
+def find_file_metadata(name):
+    """Return the latest entry stored under a file name, or None."""
+    catalog = _load_catalog()
+    entry_ids = catalog["by_name"].get(name)
+    return catalog["files"][entry_ids[-1]] if entry_ids else None
+
+def files_with_chunk(chunk_hash):
+    """Return every file entry that references a chunk hash."""
+    catalog = _load_catalog()
+    chunk = _chunk_index(catalog).get(_chunk_key(chunk_hash))
+    return [catalog["files"][entry_id] for entry_id in chunk.files] if chunk else []
+
+def lookup_chunk(chunk_hash):
+    """Return the chunk index entry for a hash, or None if no file uses it.
+
+    The entry is a ChunkRecord, read like a dict holding "refcount",
+    "disks" (disk name -> references), "size" and "codec".
+    """
+    return _chunk_index(_load_catalog()).get(_chunk_key(chunk_hash))
+
+def chunks_on_disk(disk_name):
+    """Return the hashes of every chunk the catalog places on a disk."""
+    return [_chunk_hash(key) for key, chunk in _chunk_index(_load_catalog()).items() if chunk.has_disk(disk_name)]
+
+def chunk_index_stats():
+    """Summarize the chunk index for dedup reporting."""
+    catalog = _load_catalog()
+    by_chunk = _chunk_index(catalog)
+    stats = {"files": len(catalog["files"]), "unique_chunks": 0, "chunk_references": 0,
+             "logical_bytes": 0, "unique_bytes": 0, "physical_bytes": 0}
+    for key, chunk in by_chunk.items():
+        disk_names = chunk.disks
+        if chunk.size is None:
+            # Entries stored before sizes were recorded, measure one copy
+            chunk.size = _chunk_file_size(_chunk_hash(key), disk_names)
+        stats["unique_chunks"] += 1
+        stats["chunk_references"] += chunk.refcount
+        stats["unique_bytes"] += chunk.size
+        stats["physical_bytes"] += chunk.size * len(disk_names)
+    # Logical data is what the files hold, without replicas or parity
+    for file_metadata in catalog["files"].values():
+        if "size" in file_metadata:
+            stats["logical_bytes"] += file_metadata["size"]
+        else:
+            stats["logical_bytes"] += sum(by_chunk[_chunk_key(chunk_hash)].size
+                                          for chunk_hash, _ in logical_chunks(file_metadata))
+    return stats
+
+def _chunk_file_size(chunk_hash, disk_names):
+    # sharding.py reads disk entries from this module
+    from sharding import chunk_paths
+    for disk_name in disk_names:
+        for chunk_path in chunk_paths(disk_name, chunk_hash):
+            if os.path.exists(chunk_path):
+                return os.path.getsize(chunk_path)
+    return 0
+
+def compact_files_metadata():
+    """Fold the log into a fresh snapshot and drop the records it covers."""
+    with _catalog_lock, _log_lock():
+        catalog = _load_catalog()
+        files = list(catalog["files"].values())
+        seq = catalog["seq"]
+        epoch = _catalog_epoch
+        snapshot_path = FILES_METADATA_FILE
+        snapshot_signature = _file_signature(snapshot_path)
+        log_offset = catalog["log_size"]
+
+    # The snapshot is written aside without holding the locks so stores keep
+    # appending, and only put in place if nothing replaced the catalog
+    # meanwhile, in this process or another
+    compacted_path = f"{snapshot_path}.compact-{os.getpid()}-{threading.get_ident()}"
+    _write_snapshot(files, seq, compacted_path)
+
+    with _catalog_lock, _log_lock():
+        if epoch != _catalog_epoch or _file_signature(snapshot_path) != snapshot_signature:
+            os.remove(compacted_path)
+            return
+        # Take in what other processes appended meanwhile, it stays in the log
+        catalog = _load_catalog()
+        os.replace(compacted_path, FILES_METADATA_FILE)
+        fsync_dir(os.path.dirname(FILES_METADATA_FILE) or ".")
+
+        # Keep only the records that were appended while the snapshot was written
+        tail = b""
+        if os.path.exists(FILES_METADATA_LOG):
+            with open(FILES_METADATA_LOG, "rb") as log:
+                log.seek(log_offset)
+                tail = log.read(catalog["log_size"] - log_offset)
+        tmp_path = FILES_METADATA_LOG + ".tmp"
+        with open(tmp_path, "wb") as log:
+            log.write(tail)
+            log.flush()
+            fsync_fd(log.fileno())
+        os.replace(tmp_path, FILES_METADATA_LOG)
+
+        catalog["log_records"] = tail.count(b"\n")
+        catalog["log_size"] = len(tail)
+        catalog["signature"] = _catalog_signature()
+
+def _start_background_compaction():
+    """Run compact_files_metadata() in a daemon thread unless one is running."""
+    global _compaction_thread
+    if _compaction_thread is not None and _compaction_thread.is_alive():
+        return
+    _compaction_thread = threading.Thread(target=compact_files_metadata, daemon=True)
+    _compaction_thread.start()
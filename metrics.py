@@ -0,0 +1,189 @@
+"""Counters and latency histograms for chunk I/O and the catalog.
+
+Nothing is recorded until enable_metrics() is called. Until then count()
+returns at once and timer() hands back a shared no-op context, so the
+instrumented paths pay about one attribute lookup per call.
+
+Recorded today:
+    disk_read_bytes{disk}          counter    chunk bytes read, or opened for a kernel copy
+    disk_written_bytes{disk}       counter    chunk bytes written
+    chunk_read_seconds{disk}       histogram  per-chunk read, or open, latency
+    chunk_write_seconds{disk}      histogram  per-chunk write latency
+    hash_seconds                   histogram  per-chunk hashing, compression included when a codec is set
+    catalog_load_seconds           histogram  building the files catalog from its snapshot and log
+    catalog_save_seconds{kind}     histogram  appending a log record ("log") or writing a snapshot ("snapshot")
+    metadata_save_seconds          histogram  writing metadata.json
+    scrub_read_bytes{disk}         counter    chunk bytes read by the scrubber
+    corrupt_copies{disk}           counter    chunk copies found missing or damaged
+
+snapshot() returns everything as plain data, export_metrics() writes it as
+JSON or Prometheus text, and serve_metrics() answers HTTP scrapes.
+"""
+import os
+import json
+import time
+import bisect
+import threading
+from contextlib import contextmanager, nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from durability import write_json_atomic
+
+ENABLED = False
+PREFIX = "vsan_"
+# Upper bounds of the histogram buckets in seconds, from a page-cache hit to a stalled disk
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_lock = threading.Lock()
+_counters = {}    # (name, labels) -> value
+_histograms = {}  # (name, labels) -> [count per bucket plus one past the last, sum]
+_disabled = nullcontext()
+
+def enable_metrics(enabled=True):
+    """Start, or with False stop, recording. Values recorded so far are kept."""
+    global ENABLED
+    ENABLED = enabled
+
+def reset_metrics():
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+def count(name, value=1, **labels):
+    """Add `value` to a counter."""
+    if not ENABLED:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def observe(name, seconds, **labels):
+    """Record one duration in a histogram."""
+    if not ENABLED:
+        return
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [[0] * (len(BUCKETS) + 1), 0.0]
+        histogram[0][bisect.bisect_left(BUCKETS, seconds)] += 1
+        histogram[1] += seconds
+
+@contextmanager
+def _timed(name, labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+def timer(name, **labels):
+    """Return a context manager that records how long its block takes."""
+    if not ENABLED:
+        return _disabled
+    return _timed(name, labels)
+
+def timed_call(function, *args):
+    """Call function(*args) and return (seconds taken, result).
+
+    Module level so it can run on a worker process, whose own counters
+    never reach this one.
+    """
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+def snapshot():
+    """Return every counter and histogram as JSON-ready data."""
+    with _lock:
+        counters = [{"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in sorted(_counters.items())]
+        histograms = []
+        for (name, labels), (buckets, total) in sorted(_histograms.items()):
+            cumulative, running = {}, 0
+            for bound, hits in zip(BUCKETS, buckets):
+                running += hits
+                cumulative[str(bound)] = running
+            histograms.append({"name": name, "labels": dict(labels), "count": sum(buckets),
+                               "sum": total, "buckets": cumulative})
+    return {"time": time.time(), "counters": counters, "histograms": histograms}
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels(labels, extra=None):
+    pairs = list(labels.items()) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in pairs) + "}"
+
+def to_prometheus(data=None):
+    """Format a snapshot in the Prometheus text exposition format."""
+    data = data or snapshot()
+    lines = []
+    typed = set()
+    for counter in data["counters"]:
+        name = f"{PREFIX}{counter['name']}_total"
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} counter")
+        lines.append(f"{name}{_labels(counter['labels'])} {counter['value']}")
+    for histogram in data["histograms"]:
+        name = PREFIX + histogram["name"]
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} histogram")
+        labels = histogram["labels"]
+        for bound, hits in histogram["buckets"].items():
+            lines.append(f"{name}_bucket{_labels(labels, ('le', bound))} {hits}")
+        lines.append(f"{name}_bucket{_labels(labels, ('le', '+Inf'))} {histogram['count']}")
+        lines.append(f"{name}_sum{_labels(labels)} {histogram['sum']}")
+        lines.append(f"{name}_count{_labels(labels)} {histogram['count']}")
+    return "\n".join(lines) + "\n"
+
+def export_metrics(path, format=None):
+    """Write a snapshot to a file, as "json" or "prometheus" text (default: by the file's extension).
+
+    The file is replaced atomically, so a collector reading it never sees half a snapshot.
+    """
+    format = format or ("json" if path.endswith(".json") else "prometheus")
+    if format == "json":
+        write_json_atomic(path, snapshot(), indent=2)
+        return
+    if format != "prometheus":
+        raise ValueError(f"Unknown metrics format: {format}")
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as file:
+        file.write(to_prometheus())
+    os.replace(tmp_path, path)
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            body, content_type = to_prometheus().encode(), "text/plain; version=0.0.4"
+        elif self.path == "/metrics.json":
+            body, content_type = json.dumps(snapshot()).encode(), "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes every few seconds would flood the console
+        pass
+
+def serve_metrics(port, host="127.0.0.1"):
+    """Answer GET /metrics (Prometheus text) and /metrics.json from a background thread.
+
+    Returns the HTTP server, call its shutdown() to stop it.
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
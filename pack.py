@@ -0,0 +1,329 @@
+"""Packed chunk storage for disks created with the "pack" layout.
+
+Chunks are appended to large segment files instead of getting one file
+each. An append-only index log next to the segments maps every hash to its
+(segment, offset, length) and is replayed into memory when the disk is first
+used. Deleting a chunk only drops it from the index, compaction copies the
+live chunks out of mostly dead segments and removes them.
+
+Several processes may use a disk at once. Everything that changes the
+segments or the index is done holding a lock file in the pack folder,
+after reading the index records the other processes added since.
+"""
+import os
+import json
+import threading
+from metadata_handler import disk_path
+from durability import fsync_fd, fsync_dir, file_lock
+
+PACK_FOLDER = "pack"            # folder inside a disk that marks the pack layout
+INDEX_FILE = "index.log"
+LOCK_FILE = "pack.lock"
+SEGMENT_SIZE = 256 * 1024 * 1024  # a segment is sealed once it would grow past this
+COMPACT_RATIO = 0.5             # dead share of a sealed segment that makes it worth compacting
+
+# PackStore per pack folder, None for disks with one file per chunk
+_stores = {}
+_stores_lock = threading.Lock()
+
+def _segment_name(segment):
+    return f"segment-{segment:06d}.pack"
+
+class PackStore:
+    """The segments and index of one disk."""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self._lock = threading.RLock()
+        self._index = {}  # hash -> (segment, offset, length)
+        self._dead = {}   # segment -> bytes no longer referenced by the index
+        self._sizes = {}  # segment -> file size
+        self._read_fds = {}
+        self._active = None
+        self._write_fd = None
+        self._compaction_thread = None
+        self._open_index()
+        with self._pack_lock():
+            self._read_index()
+            self._measure()
+
+    def _path(self, name):
+        return os.path.join(self.folder, name)
+
+    def _pack_lock(self):
+        # Taken after self._lock, never the other way round
+        return file_lock(self._path(LOCK_FILE))
+
+    def _open_index(self):
+        self._index_file = open(self._path(INDEX_FILE), "ab")
+        self._index_inode = os.fstat(self._index_file.fileno()).st_ino
+        self._index_size = 0  # bytes of the index log read into self._index
+
+    def _read_index(self):
+        """Apply the index records written after the part of the log already read."""
+        with open(self._path(INDEX_FILE), "rb") as file:
+            file.seek(self._index_size)
+            for line in file:
+                if not line.endswith(b"\n"):
+                    # Being written, or cut short by a crash
+                    break
+                self._index_size += len(line)
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A record cut short by a crash before later ones were added
+                    continue
+                if record[0] == "put":
+                    self._index[record[1]] = tuple(record[2:])
+                else:
+                    self._index.pop(record[1], None)
+
+    def _measure(self):
+        """Work out the segment sizes, dead bytes and active segment from the folder and index."""
+        sizes = {}
+        for name in os.listdir(self.folder):
+            if name.startswith("segment-") and name.endswith(".pack"):
+                sizes[int(name[8:-5])] = os.path.getsize(self._path(name))
+        live = {}
+        for segment, _, length in self._index.values():
+            live[segment] = live.get(segment, 0) + length
+        # Bytes written without reaching the index count as dead too
+        self._dead = {segment: size - live.get(segment, 0) for segment, size in sizes.items()}
+        self._sizes = sizes
+
+        active = max(sizes, default=1)
+        self._sizes.setdefault(active, 0)
+        self._dead.setdefault(active, 0)
+        for segment in [segment for segment in self._read_fds if segment not in sizes]:
+            # Compacted away by another process
+            os.close(self._read_fds.pop(segment))
+        if active != self._active:
+            if self._write_fd is not None:
+                os.close(self._write_fd)
+            self._active = active
+            self._open_active()
+
+    def _catch_up(self):
+        """Take in what other processes did to the pack since this one last looked.
+
+        Called holding the pack lock.
+        """
+        if os.stat(self._path(INDEX_FILE)).st_ino != self._index_inode:
+            # Another process compacted the pack and rewrote the index
+            self._index_file.close()
+            self._index = {}
+            self._open_index()
+        elif (os.fstat(self._index_file.fileno()).st_size == self._index_size
+              and os.fstat(self._write_fd).st_size == self._sizes[self._active]
+              and not os.path.exists(self._path(_segment_name(self._active + 1)))):
+            return
+        self._read_index()
+        self._measure()
+
+    def _open_active(self):
+        self._write_fd = os.open(self._path(_segment_name(self._active)), os.O_WRONLY | os.O_CREAT)
+
+    def _log(self, record):
+        fd = self._index_file.fileno()
+        if os.fstat(fd).st_size != self._index_size:
+            # A record cut short by a crash, the next one must start on its own line
+            os.ftruncate(fd, self._index_size)
+        line = json.dumps(record).encode() + b"\n"
+        self._index_file.write(line)
+        self._index_file.flush()
+        self._index_size += len(line)
+
+    def _append(self, chunk_hash, chunk):
+        """Append a chunk to the active segment and return its location, called holding the pack lock."""
+        if self._sizes[self._active] and self._sizes[self._active] + len(chunk) > SEGMENT_SIZE:
+            self._seal()
+        # Past whatever a crashed writer left behind as well as this process's own chunks
+        offset = os.fstat(self._write_fd).st_size
+        view = memoryview(chunk)
+        written = 0
+        while written < len(view):
+            written += os.pwrite(self._write_fd, view[written:], offset + written)
+        self._sizes[self._active] = offset + len(chunk)
+        return self._active, offset, len(chunk)
+
+    def _seal(self):
+        """Stop appending to the active segment and start the next one."""
+        fsync_fd(self._write_fd)
+        os.close(self._write_fd)
+        self._active += 1
+        self._sizes[self._active] = 0
+        self._dead[self._active] = 0
+        self._open_active()
+
+    def _read_fd(self, segment):
+        fd = self._read_fds.get(segment)
+        if fd is None:
+            fd = self._read_fds[segment] = os.open(self._path(_segment_name(segment)), os.O_RDONLY)
+        return fd
+
+    def put(self, chunk_hash, chunk):
+        """Store a chunk, replacing an older copy under the same hash."""
+        with self._lock, self._pack_lock():
+            self._catch_up()
+            location = self._append(chunk_hash, chunk)
+            self._forget(chunk_hash)
+            self._index[chunk_hash] = location
+            self._log(["put", chunk_hash, *location])
+
+    def sync(self):
+        """Make the chunks put so far and their index records durable."""
+        with self._lock:
+            fsync_fd(self._write_fd)
+            fsync_fd(self._index_file.fileno())
+        fsync_dir(self.folder)
+
+    def size(self, chunk_hash):
+        """Return the length of a stored chunk, or None if it is not here."""
+        with self._lock, self._pack_lock():
+            self._catch_up()
+            location = self._index.get(chunk_hash)
+        return location[2] if location else None
+
+    def open(self, chunk_hash):
+        """Return (fd, offset, length) of a chunk, the caller closes fd.
+
+        The descriptor is a duplicate, so compaction can retire the segment
+        while the caller is still reading from it.
+        """
+        with self._lock:
+            try:
+                return self._open_location(chunk_hash)
+            except FileNotFoundError:
+                # Put, or moved by compaction, in another process since the index was read
+                with self._pack_lock():
+                    self._catch_up()
+                return self._open_location(chunk_hash)
+
+    def _open_location(self, chunk_hash):
+        location = self._index.get(chunk_hash)
+        if location is None:
+            raise FileNotFoundError(f"Chunk {chunk_hash} is not in {self.folder}")
+        segment, offset, length = location
+        return os.dup(self._read_fd(segment)), offset, length
+
+    def read(self, chunk_hash):
+        """Return the data of a chunk, raising FileNotFoundError if it is not here."""
+        fd, offset, length = self.open(chunk_hash)
+        try:
+            return os.pread(fd, length, offset)
+        finally:
+            os.close(fd)
+
+    def _forget(self, chunk_hash):
+        location = self._index.pop(chunk_hash, None)
+        if location is not None:
+            self._dead[location[0]] += location[2]
+        return location
+
+    def delete(self, chunk_hash):
+        """Drop a chunk and return its length, or None if it was not here."""
+        with self._lock, self._pack_lock():
+            self._catch_up()
+            location = self._forget(chunk_hash)
+            if location is None:
+                return None
+            self._log(["delete", chunk_hash])
+            compacting = self._compaction_thread and self._compaction_thread.is_alive()
+            if self._compactable(COMPACT_RATIO) and not compacting:
+                self._compaction_thread = threading.Thread(target=self.compact, daemon=True)
+                self._compaction_thread.start()
+        return location[2]
+
+    def _compactable(self, ratio):
+        return [segment for segment, size in self._sizes.items()
+                if segment != self._active and self._dead[segment] and self._dead[segment] / size >= ratio]
+
+    def stats(self):
+        """Return {"chunks", "live_bytes", "dead_bytes", "segments"}."""
+        with self._lock, self._pack_lock():
+            self._catch_up()
+            return {"chunks": len(self._index),
+                    "live_bytes": sum(length for _, _, length in self._index.values()),
+                    "dead_bytes": sum(self._dead.values()),
+                    "segments": len(self._sizes)}
+
+    def compact(self, ratio=COMPACT_RATIO):
+        """Copy the live chunks out of sealed segments that are at least `ratio` dead.
+
+        Returns the number of bytes given back to the host file system.
+        """
+        reclaimed = 0
+        with self._lock, self._pack_lock():
+            self._catch_up()
+            active_size = self._sizes[self._active]
+            if active_size and self._dead[self._active] and self._dead[self._active] / active_size >= ratio:
+                # The active segment qualifies too, it must stop growing first
+                self._seal()
+            segments = self._compactable(ratio)
+        for segment in segments:
+            # One segment at a time, so reads and writes get the lock in between
+            with self._lock, self._pack_lock():
+                self._catch_up()
+                if segment not in self._sizes or segment == self._active:
+                    continue
+                fd = self._read_fd(segment)
+                for chunk_hash, (chunk_segment, offset, length) in list(self._index.items()):
+                    if chunk_segment == segment:
+                        self._index[chunk_hash] = self._append(chunk_hash, os.pread(fd, length, offset))
+                # The copies and an index pointing at them must be durable before the old segment goes
+                self.sync()
+                reclaimed += self._dead.pop(segment)
+                del self._sizes[segment]
+                self._rewrite_index()
+                os.close(self._read_fds.pop(segment))
+                os.remove(self._path(_segment_name(segment)))
+        return reclaimed
+
+    def _rewrite_index(self):
+        """Replace the index log with one record per live chunk."""
+        index_path = self._path(INDEX_FILE)
+        with open(index_path + ".tmp", "w") as file:
+            for chunk_hash, location in self._index.items():
+                file.write(json.dumps(["put", chunk_hash, *location]) + "\n")
+            file.flush()
+            fsync_fd(file.fileno())
+        self._index_file.close()
+        os.replace(index_path + ".tmp", index_path)
+        fsync_dir(self.folder)
+        self._open_index()
+        self._index_size = os.fstat(self._index_file.fileno()).st_size
+
+    def close(self):
+        with self._lock:
+            os.close(self._write_fd)
+            for fd in self._read_fds.values():
+                os.close(fd)
+            self._read_fds.clear()
+            self._index_file.close()
+
+def init_pack(disk_name):
+    """Give a new disk the pack layout."""
+    folder = os.path.join(disk_path(disk_name), PACK_FOLDER)
+    os.makedirs(folder, exist_ok=True)
+    with _stores_lock:
+        _stores.pop(folder, None)
+
+def get_pack(disk_name):
+    """Return the PackStore of a disk, or None if it stores one file per chunk."""
+    folder = os.path.join(disk_path(disk_name), PACK_FOLDER)
+    store = _stores.get(folder, False)
+    if store is False:
+        with _stores_lock:
+            store = _stores.get(folder, False)
+            if store is False:
+                store = _stores[folder] = PackStore(folder) if os.path.isdir(folder) else None
+    return store
+
+def close_pack(disk_name):
+    """Close a disk's pack before its folder is removed."""
+    with _stores_lock:
+        store = _stores.pop(os.path.join(disk_path(disk_name), PACK_FOLDER), None)
+    if store is not None:
+        store.close()
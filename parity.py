@@ -0,0 +1,94 @@
+"""Parity for the "parity" storage method.
+
+One parity chunk per stripe is the XOR of the data chunks (RAID-5). A second
+one is the Reed-Solomon syndrome sum(g^i * D_i) over GF(2^8) (RAID-6), which
+lets any two chunks of a stripe be rebuilt. XOR runs on whole chunks as Python
+integers and multiplying by a constant uses bytes.translate() with a 256-byte
+table, so neither loops over bytes in Python.
+"""
+
+GF_POLYNOMIAL = 0x11d  # x^8 + x^4 + x^3 + x^2 + 1, generator g = 2
+
+_EXP = [0] * 510
+_LOG = [0] * 256
+_value = 1
+for _power in range(255):
+    _EXP[_power] = _value
+    _LOG[_value] = _power
+    _value <<= 1
+    if _value & 0x100:
+        _value ^= GF_POLYNOMIAL
+for _power in range(255, 510):
+    _EXP[_power] = _EXP[_power - 255]
+
+_mul_tables = {}
+
+def gf_mul(a, b):
+    """Multiply two GF(2^8) elements."""
+    if a == 0 or b == 0:
+        return 0
+    return _EXP[_LOG[a] + _LOG[b]]
+
+def gf_inv(a):
+    """Return the multiplicative inverse of a non-zero GF(2^8) element."""
+    return _EXP[255 - _LOG[a]]
+
+def gf_scale(data, factor):
+    """Multiply every byte of data by a constant."""
+    if factor == 1:
+        return data
+    table = _mul_tables.get(factor)
+    if table is None:
+        table = _mul_tables[factor] = bytes(gf_mul(factor, value) for value in range(256))
+    return bytes(data).translate(table)
+
+def xor_blocks(blocks, length):
+    """XOR blocks together, shorter blocks count as zero padded to length."""
+    accumulator = 0
+    for block in blocks:
+        accumulator ^= int.from_bytes(block, "little")
+    return accumulator.to_bytes(length, "little")
+
+def compute_parity(blocks, level):
+    """Return the `level` (1 or 2) parity blocks of a stripe of data blocks."""
+    length = max(len(block) for block in blocks)
+    parity = [xor_blocks(blocks, length)]
+    if level == 2:
+        parity.append(xor_blocks([gf_scale(block, _EXP[i]) for i, block in enumerate(blocks)], length))
+    return parity
+
+def reconstruct(blocks, parity, length):
+    """Fill in the missing (None) data blocks of a stripe.
+
+    `parity` holds the P and, for RAID-6, Q blocks, None where lost. Rebuilt
+    blocks are `length` bytes long, the caller trims them to their real size.
+    Raises IOError when more blocks are gone than the parity can cover.
+    """
+    missing = [i for i, block in enumerate(blocks) if block is None]
+    if not missing:
+        return blocks
+    present = [(i, block) for i, block in enumerate(blocks) if block is not None]
+    p_block = parity[0]
+    q_block = parity[1] if len(parity) > 1 else None
+    blocks = list(blocks)
+
+    if len(missing) == 1 and p_block is not None:
+        blocks[missing[0]] = xor_blocks([p_block] + [block for _, block in present], length)
+    elif len(missing) == 1 and q_block is not None:
+        x = missing[0]
+        q_x = xor_blocks([q_block] + [gf_scale(block, _EXP[i]) for i, block in present], length)
+        blocks[x] = gf_scale(q_x, gf_inv(_EXP[x]))
+    elif len(missing) == 2 and p_block is not None and q_block is not None:
+        x, y = missing
+        p_xy = xor_blocks([p_block] + [block for _, block in present], length)
+        q_xy = xor_blocks([q_block] + [gf_scale(block, _EXP[i]) for i, block in present], length)
+        # Solve D_x + D_y = p_xy and g^x D_x + g^y D_y = q_xy
+        g_yx = _EXP[(y - x) % 255]
+        denominator = gf_inv(g_yx ^ 1)
+        a = gf_mul(g_yx, denominator)
+        b = gf_mul(gf_inv(_EXP[x]), denominator)
+        blocks[x] = xor_blocks([gf_scale(p_xy, a), gf_scale(q_xy, b)], length)
+        blocks[y] = xor_blocks([p_xy, blocks[x]], length)
+    else:
+        raise IOError(f"{len(missing)} chunks of the stripe are lost, parity cannot rebuild them")
+    return blocks
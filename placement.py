@@ -0,0 +1,100 @@
+import errno
+import threading
+import metadata_handler
+from usage import used_bytes_by_disk
+
+# Used bytes per disk, seeded from the usage counters, which every process
+# writing to the volume adds to, and kept up to date as chunks are placed
+# and freed until refresh_usage() seeds it again
+_used = None
+_used_root = None
+_lock = threading.Lock()
+
+def _usage():
+    global _used, _used_root
+    # A new storage root has different disks, seed again
+    if _used is None or _used_root != metadata_handler.DISK_FOLDER:
+        _used = used_bytes_by_disk()
+        _used_root = metadata_handler.DISK_FOLDER
+    return _used
+
+def refresh_usage(pending=()):
+    """Seed the used bytes again from the usage counters, taking in other processes' writes and deletes.
+
+    `pending` lists the (disk, size) reservations of this process whose
+    chunks may not be written yet, they are counted on top.
+    """
+    global _used, _used_root
+    with _lock:
+        _used = used_bytes_by_disk()
+        _used_root = metadata_handler.DISK_FOLDER
+        for disk_name, size in pending:
+            _used[disk_name] = _used.get(disk_name, 0) + size
+
+def used_bytes(disk_name):
+    """Return the bytes currently placed on a disk."""
+    with _lock:
+        return _usage().get(disk_name, 0)
+
+def reserve(disk_name, size):
+    """Count `size` more bytes on a disk."""
+    with _lock:
+        usage = _usage()
+        usage[disk_name] = usage.get(disk_name, 0) + size
+
+def release(disk_name, size):
+    """Count `size` fewer bytes on a disk."""
+    with _lock:
+        usage = _usage()
+        usage[disk_name] = max(0, usage.get(disk_name, 0) - size)
+
+def forget_disk(disk_name):
+    """Drop the usage of a disk that has been removed."""
+    with _lock:
+        _usage().pop(disk_name, None)
+
+def disk_capacities(metadata):
+    """Map disk names to their size in bytes.
+
+    Disks created without a size are treated like the largest sized disk.
+    """
+    disks = [disk if isinstance(disk, dict) else {"name": disk} for disk in metadata["disks"]]
+    sizes = [disk["size"] for disk in disks if disk.get("size")]
+    default = max(sizes) if sizes else None
+    return {disk["name"]: disk.get("size") or default for disk in disks}
+
+def _utilization(disk_name, capacity, usage):
+    if capacity is None:
+        # No disk has a size, fall back to balancing raw bytes
+        return usage.get(disk_name, 0)
+    return usage.get(disk_name, 0) / capacity
+
+def choose_disk(candidates, capacities, size):
+    """Pick the least utilized candidate with room for `size` bytes and reserve it.
+
+    Picking by utilization instead of turn gives a disk twice as large about
+    twice as many chunks. Returns None when every candidate is full.
+    """
+    with _lock:
+        usage = _usage()
+        roomy = [name for name in candidates if _has_room(name, capacities.get(name), size, usage)]
+        if not roomy:
+            return None
+        target = min(roomy, key=lambda name: _utilization(name, capacities.get(name), usage))
+        usage[target] = usage.get(target, 0) + size
+        return target
+
+def reserve_if_room(disk_name, capacities, size):
+    """Reserve `size` bytes on one disk, returning False if it is full."""
+    with _lock:
+        usage = _usage()
+        if not _has_room(disk_name, capacities.get(disk_name), size, usage):
+            return False
+        usage[disk_name] = usage.get(disk_name, 0) + size
+        return True
+
+def _has_room(disk_name, capacity, size, usage):
+    return capacity is None or usage.get(disk_name, 0) + size <= capacity
+
+def disk_full_error(disk_names, size):
+    return OSError(errno.ENOSPC, f"No room for a {size} byte chunk on {', '.join(disk_names)}")
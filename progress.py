@@ -0,0 +1,56 @@
+import sys
+import time
+import threading
+
+PROGRESS_INTERVAL = 0.5  # seconds between progress lines
+
+class ProgressReporter:
+    """Print how far a transfer has come, at most once per interval.
+
+    On a terminal the line is redrawn in place, elsewhere a new line is
+    printed each time. update() may be called from several threads.
+    """
+
+    def __init__(self, total, label, interval=PROGRESS_INTERVAL, stream=None):
+        self.total = total
+        self.label = label
+        self.interval = interval
+        self.stream = stream or sys.stderr
+        self.done = 0
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self._last = self._start
+        self._shown = False
+        isatty = getattr(self.stream, "isatty", None)
+        self._redraw = bool(isatty and isatty())
+
+    def update(self, size):
+        """Count `size` more bytes done."""
+        with self._lock:
+            self.done += size
+            now = time.monotonic()
+            if now - self._last >= self.interval:
+                self._last = now
+                self._show(now)
+
+    def finish(self):
+        """Print the final line, if the transfer took long enough to report on."""
+        with self._lock:
+            if self._shown or time.monotonic() - self._start >= self.interval:
+                self._show(time.monotonic(), final=True)
+
+    def _show(self, now, final=False):
+        done_mib = self.done / (1024 * 1024)
+        rate = done_mib / (now - self._start) if now > self._start else 0.0
+        line = f"  {self.label}: {done_mib:.1f}"
+        if self.total:
+            line += f"/{self.total / (1024 * 1024):.1f} MiB ({100 * self.done / self.total:.0f}%)"
+        else:
+            line += " MiB"
+        line += f", {rate:.1f} MiB/s"
+        if self._redraw:
+            self.stream.write("\r" + line + ("\n" if final else ""))
+        else:
+            self.stream.write(line + "\n")
+        self.stream.flush()
+        self._shown = True
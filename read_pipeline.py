@@ -0,0 +1,189 @@
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from zero_copy import FdCopier, output_fd
+from compressors import NO_CODEC, decompress
+from integrity import CorruptChunkError
+
+READ_WORKERS = 8  # concurrent chunk reads across all disks
+READ_AHEAD = 16   # chunks requested ahead of the one being written out
+
+class ReadPipeline:
+    """Read chunks concurrently from their disks and write them out in order.
+
+    Up to `read_ahead` chunks are in flight at once, so a striped file keeps
+    every disk it spans busy. Each chunk lists the disks holding a replica.
+    One of them is read, picked by the `balancer` (see balancing.py), and a
+    replica that is missing or fails falls back to the next one. When every
+    replica is gone, `recover(index, chunk_hash)` may rebuild the data, e.g.
+    from parity.
+
+    With `open_chunk(disk, chunk_hash)`, which returns (fd, offset, length),
+    run() opens chunks ahead instead of reading them and copies them into an
+    output with a file descriptor inside the kernel.
+
+    `codec_of(chunk_hash)` names the codec a chunk is stored with. Compressed
+    chunks are decompressed on the read workers and never copied by the kernel.
+
+    With a `cache` (see chunk_cache.py) chunks are looked up there first and
+    what is read or rebuilt is added to it. Cached chunks are reported as
+    coming from disk "cache". Chunks then go through memory for every
+    output, so kernel copies are not used.
+
+    `verify(chunk_hash, data)` checks the data of every chunk read or
+    rebuilt, raising CorruptChunkError when it is bad (see integrity.py),
+    and also keeps chunks out of kernel copies. A copy that fails to decode
+    or verify is handed to `on_corrupt(chunk_hash, disk_name)` and the next
+    replica is tried.
+    """
+
+    def __init__(self, read_chunk, workers=None, read_ahead=None, recover=None, open_chunk=None,
+                 codec_of=None, cache=None, balancer=None, verify=None, on_corrupt=None):
+        self.read_chunk = read_chunk
+        self.verify = verify
+        self.on_corrupt = on_corrupt
+        self.balancer = balancer
+        self.recover = recover
+        self.open_chunk = open_chunk
+        self.codec_of = codec_of
+        self.cache = cache
+        self.workers = workers or READ_WORKERS
+        self.read_ahead = read_ahead or READ_AHEAD
+        self.bytes_written = 0
+        self.missing = []
+
+    def _codec(self, chunk_hash):
+        return self.codec_of(chunk_hash) if self.codec_of else NO_CODEC
+
+    def _fetch(self, index, chunk_hash, disk_names, load=None):
+        """Return (data, disk) from the cache or the first replica that can be read."""
+        if self.cache is not None:
+            data = self.cache.get(chunk_hash)
+            if data is not None:
+                return data, "cache"
+        for disk_name in self.balancer.order(disk_names) if self.balancer else disk_names:
+            try:
+                if self.balancer:
+                    with self.balancer.reading(disk_name):
+                        data = (load or self.read_chunk)(disk_name, chunk_hash)
+                else:
+                    data = (load or self.read_chunk)(disk_name, chunk_hash)
+                if load is None:
+                    data = self._decode(chunk_hash, data)
+            except CorruptChunkError:
+                if self.on_corrupt:
+                    self.on_corrupt(chunk_hash, disk_name)
+                continue
+            except OSError:
+                # Missing or unreadable, try the next replica
+                continue
+            if load is None and self.cache is not None:
+                self.cache.put(chunk_hash, data)
+            return data, disk_name
+        if self.recover:
+            try:
+                data = self.recover(index, chunk_hash)
+                if self.verify:
+                    self.verify(chunk_hash, data)
+            except IOError:
+                return None, None
+            if self.cache is not None:
+                self.cache.put(chunk_hash, data)
+            return data, "rebuilt"
+        return None, None
+
+    def _decode(self, chunk_hash, data):
+        """Decompress the stored bytes of a chunk and verify them."""
+        data = decompress(self._codec(chunk_hash), data)
+        if self.verify:
+            self.verify(chunk_hash, data)
+        return data
+
+    def _open(self, index, chunk_hash, disk_names):
+        """Like _fetch(), but return (fd, offset, length) unless the chunk is compressed or was rebuilt."""
+        if self._codec(chunk_hash) != NO_CODEC:
+            return self._fetch(index, chunk_hash, disk_names)
+        return self._fetch(index, chunk_hash, disk_names, self.open_chunk)
+
+    def _in_order(self, fetch, chunks, on_chunk, start=0):
+        """Yield what fetch() returns for each chunk, in order, keeping the read-ahead window full."""
+        self.missing = []
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            pending = deque()
+            chunks = enumerate(chunks, start)
+
+            def submit_next():
+                for index, (chunk_hash, disk_names) in chunks:
+                    pending.append((chunk_hash, pool.submit(fetch, index, chunk_hash, disk_names)))
+                    return
+
+            for _ in range(self.read_ahead):
+                submit_next()
+
+            try:
+                while pending:
+                    chunk_hash, future = pending.popleft()
+                    result, disk_name = future.result()
+                    # Refill the window before handing data out so the disks stay busy
+                    submit_next()
+                    if on_chunk:
+                        on_chunk(chunk_hash, disk_name)
+                    if result is None:
+                        self.missing.append(chunk_hash)
+                    else:
+                        yield result
+            finally:
+                # The consumer may stop early, drop the reads nobody will use
+                for _, future in pending:
+                    future.cancel()
+                if fetch == self._open:
+                    pool.shutdown(wait=True)
+                    for _, future in pending:
+                        if not future.cancelled() and future.exception() is None:
+                            _close(future.result()[0])
+
+    def iter_chunks(self, chunks, on_chunk=None, start=0):
+        """Yield the data of the (hash, [disks]) chunks in order.
+
+        `start` is the position of the first chunk in its file, for chunks
+        that are a slice of the file's list and may need recovering.
+
+        `on_chunk(chunk_hash, disk_name)` is called for each chunk, with
+        disk_name "rebuilt" for recovered chunks and None when no replica
+        could be read. Missing chunks are recorded in `self.missing` and not
+        yielded.
+        """
+        for data in self._in_order(self._fetch, chunks, on_chunk, start):
+            self.bytes_written += len(data)
+            yield data
+
+    def run(self, chunks, output, on_chunk=None):
+        """Write the (hash, [disks]) chunks to `output` and return the hashes that were missing."""
+        out_fd = output_fd(output) if self.open_chunk and self.cache is None and self.verify is None else None
+        if out_fd is None:
+            for data in self.iter_chunks(chunks, on_chunk):
+                output.write(data)
+            return self.missing
+
+        # Buffered data must reach the descriptor before the kernel appends to it
+        output.flush()
+        copier = FdCopier(out_fd)
+        for result in self._in_order(self._open, chunks, on_chunk):
+            if isinstance(result, tuple):
+                fd, offset, length = result
+                try:
+                    self.bytes_written += copier.copy(fd, offset, length)
+                finally:
+                    os.close(fd)
+            else:
+                output.write(result)
+                output.flush()
+                self.bytes_written += len(result)
+        if output.seekable():
+            # The stream's idea of its position is behind the descriptor's
+            output.seek(os.lseek(out_fd, 0, os.SEEK_CUR))
+        return self.missing
+
+def _close(result):
+    if isinstance(result, tuple):
+        os.close(result[0])
@@ -0,0 +1,209 @@
+import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from metadata_handler import load_metadata, lookup_chunk, files_with_chunk, relocate_chunks
+from metadata_handler import chunks_on_disk, logical_chunks, storage_path
+from file_operations import read_chunk, save_chunk, sync_chunks, rebuild_chunk, rebuild_parity_chunk
+from placement import disk_capacities, choose_disk, disk_full_error
+from usage import flush_usage
+from compressors import compress
+from durability import write_json_atomic
+from progress import ProgressReporter
+
+REBALANCE_WORKERS = 4     # chunk copies running at once
+CHECKPOINT_INTERVAL = 32  # finished copies between checkpoint writes
+
+class Throttle:
+    """Limit the combined rate of all copy threads to `rate` bytes per second."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self._bytes = 0
+
+    def consume(self, size):
+        if not self.rate:
+            return
+        with self._lock:
+            self._bytes += size
+            # Sleep until the bytes moved so far fit within the rate
+            delay = self._bytes / self.rate - (time.monotonic() - self._start)
+        if delay > 0:
+            time.sleep(delay)
+
+def _checkpoint_path(disk_name):
+    return storage_path(f"rebalance-{disk_name}.json")
+
+def _save_checkpoint(checkpoint, copied=()):
+    """Save progress once the (disk, hash) copies it lists as done are durable."""
+    by_disk = {}
+    for disk_name, chunk_hash in copied:
+        by_disk.setdefault(disk_name, []).append(chunk_hash)
+    for disk_name, chunk_hashes in by_disk.items():
+        sync_chunks(disk_name, chunk_hashes)
+    write_json_atomic(_checkpoint_path(checkpoint["disk"]), checkpoint)
+
+def _sibling_disks(file_metadata, chunk_hash, disk_name):
+    """Return the disks holding other pieces of the same redundancy group.
+
+    A moved copy must avoid them, or one disk failure would take out two
+    pieces of a mirrored chunk or of a parity stripe.
+    """
+    siblings = set()
+    if file_metadata["method"] == "mirror":
+        for group_hash, disk_names in logical_chunks(file_metadata):
+            if group_hash == chunk_hash and disk_name in disk_names:
+                siblings.update(disk_names)
+    elif file_metadata["method"] == "parity":
+        stripe_width = file_metadata["stripe_width"]
+        for stripe, parity_entries in enumerate(file_metadata["parity_chunks"]):
+            members = file_metadata["chunks"][stripe * stripe_width:(stripe + 1) * stripe_width] + parity_entries
+            if any(member[0] == chunk_hash and member[1] == disk_name for member in members):
+                siblings.update(member[1] for member in members)
+    siblings.discard(disk_name)
+    return siblings
+
+def plan_rebalance(disk_name, remaining_disks, chunk_hashes=None):
+    """Decide where every chunk on a departing disk, or the given ones, goes.
+
+    Returns {hash: {"target": disk, "copy": bool}}. A chunk that another
+    allowed disk already holds is only re-pointed, otherwise it is copied to
+    the least utilized allowed disk with room, which is reserved for it.
+    """
+    if chunk_hashes is None:
+        chunk_hashes = chunks_on_disk(disk_name)
+    if not remaining_disks and chunk_hashes:
+        raise ValueError(f"Disk '{disk_name}' holds data and no other disk can take it")
+
+    capacities = disk_capacities(load_metadata())
+    plan = {}
+    for chunk_hash in chunk_hashes:
+        chunk = lookup_chunk(chunk_hash)
+        forbidden = set()
+        for file_metadata in files_with_chunk(chunk_hash):
+            forbidden |= _sibling_disks(file_metadata, chunk_hash, disk_name)
+        existing = [name for name in remaining_disks if name in chunk["disks"]]
+        candidates = [name for name in remaining_disks if name not in forbidden]
+
+        size = chunk["size"] or 0
+        if any(name in existing for name in candidates):
+            target, needs_copy = next(name for name in candidates if name in existing), False
+        elif existing and not candidates:
+            # Every allowed disk already has a replica, the departing one is dropped
+            target, needs_copy = existing[0], False
+        else:
+            # With too few disks left to keep the redundancy, keep the data at least
+            target, needs_copy = choose_disk(candidates or remaining_disks, capacities, size), True
+            if target is None:
+                raise disk_full_error(candidates or remaining_disks, size)
+        plan[chunk_hash] = {"target": target, "copy": needs_copy}
+    return plan
+
+def _recover_chunk(chunk_hash, disk_name):
+    """Return the stored bytes of a chunk from the departing disk, another copy or its parity stripe."""
+    chunk = lookup_chunk(chunk_hash)
+    for source in [disk_name] + [name for name in chunk["disks"] if name != disk_name]:
+        try:
+            return read_chunk(source, chunk_hash)
+        except FileNotFoundError:
+            continue
+
+    for file_metadata in files_with_chunk(chunk_hash):
+        if file_metadata["method"] != "parity":
+            continue
+        try:
+            # Rebuilt data is raw, stored copies of a compressed chunk are not
+            for index, entry in enumerate(file_metadata["chunks"]):
+                if entry[0] == chunk_hash:
+                    return compress(chunk["codec"], rebuild_chunk(file_metadata, index))
+            for stripe, entries in enumerate(file_metadata["parity_chunks"]):
+                for position, entry in enumerate(entries):
+                    if entry[0] == chunk_hash:
+                        return compress(chunk["codec"], rebuild_parity_chunk(file_metadata, stripe, position))
+        except IOError:
+            continue
+    raise IOError(f"Chunk {chunk_hash} is lost and cannot be rebuilt")
+
+def _commit(disk_name, plan):
+    """Point every catalog entry away from the departing disk with one log record."""
+    relocate_chunks(disk_name, {chunk_hash: move["target"] for chunk_hash, move in plan.items()})
+
+def rebalance_disk(disk_name, remaining_disks, bandwidth=None, workers=None, verbose=False):
+    """Move every chunk off a disk before it is removed.
+
+    Copies run in parallel, limited to `bandwidth` bytes per second overall.
+    Progress is checkpointed next to the metadata, so running this again
+    after an interruption continues with the chunks that were not copied
+    yet. The catalog is only switched to the new locations once every copy
+    is in place. Chunks stored on the disk while it is being emptied are
+    planned and moved too. Returns (chunks copied, bytes copied).
+    """
+    path = _checkpoint_path(disk_name)
+    if os.path.exists(path):
+        with open(path, "r") as file:
+            checkpoint = json.load(file)
+        if verbose:
+            print(f"Resuming rebalance of '{disk_name}', {len(checkpoint['done'])} chunks already moved.")
+    else:
+        checkpoint = {"disk": disk_name, "plan": plan_rebalance(disk_name, remaining_disks), "done": []}
+        _save_checkpoint(checkpoint)
+
+    plan = checkpoint["plan"]
+    done = set(checkpoint["done"])
+    todo = [chunk_hash for chunk_hash, move in plan.items() if move["copy"] and chunk_hash not in done]
+    throttle = Throttle(bandwidth)
+    lock = threading.Lock()
+    totals = {"chunks": 0, "bytes": 0}
+    # Copies not yet flushed, synced in one batch per checkpoint
+    unsynced = []
+    progress = None
+    if verbose:
+        total = sum((lookup_chunk(chunk_hash) or {}).get("size") or 0 for chunk_hash in todo)
+        progress = ProgressReporter(total, f"Moving chunks off '{disk_name}'")
+
+    def move(chunk_hash):
+        data = _recover_chunk(chunk_hash, disk_name)
+        throttle.consume(len(data))
+        save_chunk(data, plan[chunk_hash]["target"], chunk_hash)
+        with lock:
+            checkpoint["done"].append(chunk_hash)
+            unsynced.append((plan[chunk_hash]["target"], chunk_hash))
+            totals["chunks"] += 1
+            totals["bytes"] += len(data)
+            if totals["chunks"] % CHECKPOINT_INTERVAL == 0:
+                _save_checkpoint(checkpoint, unsynced)
+                unsynced.clear()
+        if progress is not None:
+            progress.update(len(data))
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers or REBALANCE_WORKERS) as pool:
+            while True:
+                # list() re-raises the first failed copy
+                list(pool.map(move, todo))
+                # The disk still takes new chunks until it is removed, and a
+                # resumed run's plan predates the interruption
+                added = [chunk_hash for chunk_hash in chunks_on_disk(disk_name) if chunk_hash not in plan]
+                if not added:
+                    break
+                new_plan = plan_rebalance(disk_name, remaining_disks, added)
+                with lock:
+                    plan.update(new_plan)
+                    _save_checkpoint(checkpoint, unsynced)
+                    unsynced.clear()
+                todo = [chunk_hash for chunk_hash, step in new_plan.items() if step["copy"]]
+                if progress is not None:
+                    progress.total += sum((lookup_chunk(chunk_hash) or {}).get("size") or 0 for chunk_hash in todo)
+        if progress is not None:
+            progress.finish()
+    finally:
+        with lock:
+            _save_checkpoint(checkpoint, unsynced)
+        flush_usage()
+
+    _commit(disk_name, plan)
+    os.remove(path)
+    return totals["chunks"], totals["bytes"]
@@ -0,0 +1,235 @@
+"""Find chunk copies that went missing or rotted on disk and repair them.
+
+A pass walks the chunk index and re-reads every copy the catalog places on
+a disk. Each disk has its own reader thread, so disks are read in parallel,
+while decoding and hashing run on the pool shared with verified reads (see
+integrity.py). All readers together stay under `rate` bytes per second, so
+a background pass leaves the disks to clients.
+
+A copy is bad when it is missing, cannot be read or decoded, or does not
+match its hash. With `repair` each bad copy is rewritten from a replica
+that verifies, or from data rebuilt from its parity stripe and verified,
+and is reported unrepairable when neither exists. The report of the last
+pass is kept next to the metadata as scrub.json.
+"""
+import json
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from metadata_handler import load_metadata, get_disk_names, chunks_on_disk, lookup_chunk, files_with_chunk
+from metadata_handler import storage_path
+from file_operations import read_chunk, rewrite_chunk, chunk_codec, rebuild_chunk, rebuild_parity_chunk
+from integrity import CorruptChunkError, get_hash_pool, matches, suspects, clear_suspects
+from compressors import compress, decompress
+from durability import write_json_atomic
+from rebalance import Throttle
+import metrics
+
+SCRUB_RATE = 32 * 1024 * 1024  # bytes per second a background pass reads
+SCRUB_INTERVAL = 24 * 60 * 60  # seconds from the end of one background pass to the next
+SCRUB_WINDOW = 4               # chunks of one disk hashing while its reader moves on
+
+def _check(chunk_hash, stored):
+    """Return whether stored chunk bytes decode to their hash, None if that cannot be told."""
+    try:
+        data = decompress(chunk_codec(chunk_hash), stored)
+    except CorruptChunkError:
+        return False
+    return matches(chunk_hash, data)
+
+def _still_placed(chunk_hash, disk_name):
+    chunk = lookup_chunk(chunk_hash)
+    return chunk is not None and disk_name in chunk["disks"]
+
+def _rebuild(file_metadata, chunk_hash):
+    """Rebuild a chunk of a parity file from the rest of its stripe."""
+    for index, entry in enumerate(file_metadata["chunks"]):
+        if entry[0] == chunk_hash:
+            return rebuild_chunk(file_metadata, index)
+    for stripe, entries in enumerate(file_metadata["parity_chunks"]):
+        for position, entry in enumerate(entries):
+            if entry[0] == chunk_hash:
+                return rebuild_parity_chunk(file_metadata, stripe, position)
+    return None
+
+def _good_copy(chunk_hash, bad_disk):
+    """Return verified stored bytes for a chunk from another replica or its parity stripe, or None."""
+    chunk = lookup_chunk(chunk_hash)
+    if chunk is None:
+        return None
+    for source in chunk["disks"]:
+        if source == bad_disk:
+            continue
+        try:
+            stored = read_chunk(source, chunk_hash)
+        except OSError:
+            continue
+        if _check(chunk_hash, stored) is not False:
+            return stored
+
+    for file_metadata in files_with_chunk(chunk_hash):
+        if file_metadata["method"] != "parity":
+            continue
+        try:
+            data = _rebuild(file_metadata, chunk_hash)
+        except (IOError, ValueError):
+            # Too many pieces of the stripe are gone as well
+            continue
+        # A stripe with another bad member rebuilds wrong data, which must not be written back
+        if data is not None and matches(chunk_hash, data) is not False:
+            return compress(chunk["codec"], data)
+    return None
+
+class Scrubber:
+    """Verify every chunk copy, and repair the bad ones, once or in the background."""
+
+    def __init__(self, rate=None, repair=True):
+        self.rate = rate
+        self.repair = repair
+        self.last_report = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _scrub_disk(self, disk_name, chunk_hashes, throttle, report, lock):
+        """Read every listed copy on one disk and record the bad ones."""
+        hash_pool = get_hash_pool()
+        pending = deque()
+
+        def settle():
+            chunk_hash, future = pending.popleft()
+            result = future.result()
+            with lock:
+                if result is False:
+                    report["corrupt"].append([chunk_hash, disk_name])
+                elif result is None:
+                    report["unverified"] += 1
+
+        for chunk_hash in chunk_hashes:
+            if self._stop.is_set():
+                break
+            try:
+                stored = read_chunk(disk_name, chunk_hash)
+            except FileNotFoundError:
+                with lock:
+                    report["checked"] += 1
+                    report["missing"].append([chunk_hash, disk_name])
+                continue
+            except OSError:
+                with lock:
+                    report["checked"] += 1
+                    report["corrupt"].append([chunk_hash, disk_name])
+                continue
+            throttle.consume(len(stored))
+            metrics.count("scrub_read_bytes", len(stored), disk=disk_name)
+            with lock:
+                report["checked"] += 1
+                report["bytes"] += len(stored)
+            pending.append((chunk_hash, hash_pool.submit(_check, chunk_hash, stored)))
+            if len(pending) >= SCRUB_WINDOW:
+                settle()
+        while pending:
+            settle()
+
+    def scrub(self, disk_names=None):
+        """Verify the copies on the given disks, all by default, and return the report.
+
+        The report counts the copies "checked", the "bytes" read and the
+        copies that could not be hashed ("unverified"), and lists the
+        [hash, disk] copies found "missing" or "corrupt", and which of those
+        were "repaired" or are "unrepairable".
+        """
+        start = time.monotonic()
+        disk_names = disk_names or get_disk_names(load_metadata())
+        report = {"started": time.time(), "disks": list(disk_names), "checked": 0, "bytes": 0, "unverified": 0,
+                  "missing": [], "corrupt": [], "repaired": [], "unrepairable": []}
+        # Copies verified reads found bad are checked first, then every copy of every disk
+        queued = {disk_name: [] for disk_name in disk_names}
+        for chunk_hash, disk_name in suspects():
+            if disk_name in queued:
+                queued[disk_name].append(chunk_hash)
+        for disk_name in disk_names:
+            queued[disk_name] = list(dict.fromkeys(queued[disk_name] + chunks_on_disk(disk_name)))
+
+        throttle = Throttle(self.rate)
+        lock = threading.Lock()
+        if queued:
+            with ThreadPoolExecutor(max_workers=len(queued)) as readers:
+                # list() re-raises the first failed reader
+                list(readers.map(lambda disk_name: self._scrub_disk(disk_name, queued[disk_name], throttle,
+                                                                     report, lock), queued))
+
+        # Copies freed by deletes during the pass are not bad, just gone
+        for kind in ("missing", "corrupt"):
+            report[kind] = [copy for copy in report[kind] if _still_placed(*copy)]
+        for chunk_hash, disk_name in report["missing"] + report["corrupt"]:
+            metrics.count("corrupt_copies", disk=disk_name)
+            if not self.repair or self._stop.is_set():
+                continue
+            stored = _good_copy(chunk_hash, disk_name)
+            try:
+                repaired = stored is not None and rewrite_chunk(disk_name, chunk_hash, stored)
+            except OSError as error:
+                # The disk itself is gone or failing, the copy waits for a disk removal
+                print(f"Cannot repair chunk {chunk_hash[:8]} on {disk_name}: {error}")
+                repaired = False
+            if repaired:
+                report["repaired"].append([chunk_hash, disk_name])
+            elif _still_placed(chunk_hash, disk_name):
+                report["unrepairable"].append([chunk_hash, disk_name])
+
+        if not self._stop.is_set():
+            clear_suspects([(chunk_hash, disk_name) for disk_name in queued for chunk_hash in queued[disk_name]])
+        report["seconds"] = time.monotonic() - start
+        write_json_atomic(storage_path("scrub.json"), report, indent=2)
+        self.last_report = report
+        return report
+
+    def start(self, interval=SCRUB_INTERVAL):
+        """Run a pass now and then every `interval` seconds on a background thread until stop()."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+
+        def loop():
+            while not self._stop.is_set():
+                try:
+                    self.scrub()
+                except OSError as error:
+                    print(f"Scrub failed: {error}")
+                self._stop.wait(interval)
+
+        self._thread = threading.Thread(target=loop, name="scrubber", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Ask a running pass to finish early and wait for the background thread."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+def last_scrub_report():
+    """Return the report of the last pass on this volume, or None."""
+    try:
+        with open(storage_path("scrub.json"), "r") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+# The background scrubber of this process, None until one is started
+_background = None
+
+def start_scrubber(rate=SCRUB_RATE, interval=SCRUB_INTERVAL, repair=True):
+    """Start scrubbing in the background, replacing a scrubber started before."""
+    global _background
+    stop_scrubber()
+    _background = Scrubber(rate, repair)
+    _background.start(interval)
+    return _background
+
+def stop_scrubber():
+    global _background
+    if _background is not None:
+        _background.stop()
+        _background = None
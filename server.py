@@ -0,0 +1,227 @@
+"""Serve a volume over a Unix or TCP socket.
+
+The protocol is a simple length-prefixed one. A request is a 16-byte
+header, struct ">QII": a handle chosen by the client, the length of a
+JSON object and the length of a binary payload, followed by both. A
+response echoes the handle in the same framing, with {"ok": true, ...}
+or {"ok": false, "error": "..."} as its JSON object.
+
+Requests ("op" in the JSON object):
+    read    name, offset, length (optional)  -> payload with the bytes
+    put     name, method, parity (optional), payload holds the file
+    stat    name                             -> "size", "method", "chunks"
+    list                                     -> "files": [[name, size], ...]
+    delete  name                             -> "removed": copies freed
+
+A client may send many requests without waiting. They are queued per
+client and up to CLIENT_DEPTH of them run at once on the shared thread
+pool, so responses can come back in any order and are matched by handle.
+A client that needs one request to see another's result, such as a read
+after a put, waits for the first response.
+"""
+import io
+import json
+import socket
+import struct
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+FRAME = struct.Struct(">QII")
+MAX_HEADER = 64 * 1024              # bytes of JSON in one frame
+MAX_PAYLOAD = 256 * 1024 * 1024     # bytes of data in one frame
+SERVER_WORKERS = 16  # threads running chunk I/O for all clients
+CLIENT_DEPTH = 8     # requests of one client running at once
+CLIENT_QUEUE = 64    # requests of one client read ahead, then the socket is left unread
+
+class ProtocolError(Exception):
+    pass
+
+def _handle_request(san, request, payload):
+    """Run one request on a worker thread and return the (response, payload)."""
+    op = request.get("op")
+    if op == "read":
+        length = request.get("length")
+        size = san.stat(request["name"])["size"]
+        if (size - request["offset"] if length is None else length) > MAX_PAYLOAD:
+            raise ValueError(f"Reads are limited to {MAX_PAYLOAD} bytes per request")
+        return {"ok": True}, san.read(request["name"], request["offset"], length)
+    if op == "put":
+        file_metadata = san.put(io.BytesIO(payload), request.get("method", "stripe"), request["name"],
+                                request.get("parity", 1))
+        return {"ok": True, "size": file_metadata["size"]}, b""
+    if op == "stat":
+        return {"ok": True, **san.stat(request["name"])}, b""
+    if op == "list":
+        return {"ok": True, "files": [[entry["name"], entry.get("size")] for entry in san.files()]}, b""
+    if op == "delete":
+        return {"ok": True, "removed": san.delete(request["name"])}, b""
+    raise ValueError(f"Unknown request: {op}")
+
+class VolumeServer:
+    """Answer requests from many clients, each with its own queue."""
+
+    def __init__(self, san, workers=None):
+        self.san = san
+        self.executor = ThreadPoolExecutor(max_workers=workers or SERVER_WORKERS)
+        self.clients = 0
+        self.requests = 0
+
+    async def _read_frame(self, reader):
+        try:
+            handle, header_length, payload_length = FRAME.unpack(await reader.readexactly(FRAME.size))
+        except asyncio.IncompleteReadError as error:
+            if error.partial:
+                raise ProtocolError("Connection closed inside a frame")
+            return None
+        if header_length > MAX_HEADER or payload_length > MAX_PAYLOAD:
+            raise ProtocolError("Frame too large")
+        header = await reader.readexactly(header_length)
+        payload = await reader.readexactly(payload_length)
+        try:
+            request = json.loads(header)
+        except ValueError:
+            raise ProtocolError("Request is not JSON") from None
+        if not isinstance(request, dict):
+            raise ProtocolError("Request is not a JSON object")
+        return handle, request, payload
+
+    async def _respond(self, writer, lock, handle, response, payload):
+        header = json.dumps(response).encode()
+        async with lock:
+            writer.write(FRAME.pack(handle, len(header), len(payload)))
+            writer.write(header)
+            if payload:
+                writer.write(payload)
+            await writer.drain()
+
+    async def _worker(self, requests, writer, lock):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await requests.get()
+            if item is None:
+                return
+            handle, request, payload = item
+            try:
+                response, data = await loop.run_in_executor(
+                    self.executor, _handle_request, self.san, request, payload)
+            except Exception as error:
+                # Whatever a request runs into is its answer, the worker goes on with the next one
+                response, data = {"ok": False, "error": str(error) or type(error).__name__}, b""
+            self.requests += 1
+            try:
+                await self._respond(writer, lock, handle, response, data)
+            except ConnectionError:
+                # The client went away, drain the queue without answering
+                pass
+
+    async def handle_client(self, reader, writer):
+        self.clients += 1
+        requests = asyncio.Queue(maxsize=CLIENT_QUEUE)
+        lock = asyncio.Lock()
+        workers = [asyncio.create_task(self._worker(requests, writer, lock)) for _ in range(CLIENT_DEPTH)]
+        try:
+            while True:
+                frame = await self._read_frame(reader)
+                if frame is None:
+                    break
+                await requests.put(frame)
+        except (ProtocolError, ConnectionError, asyncio.IncompleteReadError) as error:
+            print(f"Dropping client: {error}")
+        finally:
+            try:
+                for _ in workers:
+                    await requests.put(None)
+                await asyncio.gather(*workers)
+            finally:
+                self.clients -= 1
+                writer.close()
+
+    async def serve(self, unix_path=None, host="127.0.0.1", port=None):
+        """Listen on a Unix socket or a TCP port until cancelled."""
+        if unix_path:
+            server = await asyncio.start_unix_server(self.handle_client, path=unix_path)
+        else:
+            server = await asyncio.start_server(self.handle_client, host, port)
+        async with server:
+            await server.serve_forever()
+
+def serve(san, unix_path=None, host="127.0.0.1", port=None, workers=None):
+    """Serve a VirtualSAN until interrupted."""
+    server = VolumeServer(san, workers)
+    try:
+        asyncio.run(server.serve(unix_path, host, port))
+    finally:
+        server.executor.shutdown()
+
+class Client:
+    """Blocking client for the protocol, for scripts and load tests.
+
+    call() sends one request and waits for its answer. pipeline() sends a
+    batch of requests before reading any response.
+    """
+
+    def __init__(self, unix_path=None, host="127.0.0.1", port=None):
+        if unix_path:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(unix_path)
+        else:
+            self.sock = socket.create_connection((host, port))
+        self.file = self.sock.makefile("rwb")
+        self._next_handle = 0
+
+    def _send(self, request, payload=b""):
+        self._next_handle += 1
+        header = json.dumps(request).encode()
+        self.file.write(FRAME.pack(self._next_handle, len(header), len(payload)))
+        self.file.write(header)
+        self.file.write(payload)
+        return self._next_handle
+
+    def _receive(self):
+        frame = self.file.read(FRAME.size)
+        if len(frame) < FRAME.size:
+            raise ConnectionError("Server closed the connection")
+        handle, header_length, payload_length = FRAME.unpack(frame)
+        response = json.loads(self.file.read(header_length))
+        return handle, response, self.file.read(payload_length)
+
+    def pipeline(self, requests):
+        """Send (request, payload) pairs at once and return their (response, payload) in order."""
+        requests = list(requests)
+        first = self._next_handle + 1
+        handles = range(first, first + len(requests))
+
+        def send_all():
+            for request, payload in requests:
+                self._send(request, payload)
+            self.file.flush()
+
+        # Responses are read while sending, or both sides could block on full socket buffers
+        sender = threading.Thread(target=send_all, daemon=True)
+        sender.start()
+        results = {}
+        try:
+            while len(results) < len(handles):
+                handle, response, payload = self._receive()
+                results[handle] = (response, payload)
+        finally:
+            sender.join()
+        return [results[handle] for handle in handles]
+
+    def call(self, request, payload=b""):
+        """Send one request and return (response, payload), raising OSError when it failed."""
+        response, data = self.pipeline([(request, payload)])[0]
+        if not response["ok"]:
+            raise OSError(response["error"])
+        return response, data
+
+    def read(self, name, offset, length=None):
+        return self.call({"op": "read", "name": name, "offset": offset, "length": length})[1]
+
+    def put(self, name, data, method="stripe", parity=1):
+        return self.call({"op": "put", "name": name, "method": method, "parity": parity}, data)[0]
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
@@ -0,0 +1,180 @@
+"""Where the chunk files of a "files" disk live inside its folder.
+
+A flat disk keeps every chunk directly in its folder, which gets slow to
+create, look up and list in once it holds millions of files. A sharded
+disk puts each chunk in folders named by the first characters of its
+hash: with a fanout of (2, 2) chunk "abcd..." is stored as "ab/cd/abcd...".
+The fanout of a disk is kept in its metadata.json entry, a disk without
+one is flat, as are the disks of volumes from before sharding.
+
+disk_operations.migrate_disks() converts disks while they are in use.
+Until it finishes a disk records the fanout it is leaving, and reads,
+deletes and rewrites that miss a chunk in the new place look in the old
+one. New chunks always go to the new place. An interrupted migration is finished by running it
+again with the same fanout.
+
+The layout of each disk is cached per process until metadata.json
+changes, so a long running process such as the server follows a
+migration run by another one.
+"""
+import os
+import string
+import threading
+from metadata_handler import load_metadata, metadata_signature, disk_path
+from durability import fsync_dir
+
+FANOUT = (2, 2)       # hex characters per folder level of new "files" disks
+MAX_FANOUT_CHARS = 8  # characters of the hash all levels together may use
+
+_HEX = set(string.hexdigits.lower())
+
+# (metadata.json signature, (fanout, fanout being migrated from or None)) per disk folder
+_layouts = {}
+_layouts_lock = threading.Lock()
+
+def check_fanout(fanout):
+    """Return a fanout as a tuple, raising ValueError if it cannot be used."""
+    fanout = tuple(fanout)
+    if any(not isinstance(width, int) or width < 1 for width in fanout) or sum(fanout) > MAX_FANOUT_CHARS:
+        raise ValueError(f"Invalid fanout {list(fanout)}: give levels of at least 1 character, "
+                         f"{MAX_FANOUT_CHARS} in total")
+    return fanout
+
+def parse_fanout(text):
+    """Parse a fanout written as "2,2", or "flat" for none."""
+    if text.strip().lower() in ("flat", "0", ""):
+        return ()
+    return check_fanout(int(width) for width in text.split(","))
+
+def disk_entry(metadata, disk_name):
+    """Return (position, entry) of a disk in the metadata, raising ValueError if it is not there."""
+    for index, disk in enumerate(metadata["disks"]):
+        if (disk["name"] if isinstance(disk, dict) else disk) == disk_name:
+            return index, disk
+    raise ValueError(f"Disk '{disk_name}' not found!")
+
+def _load_layout(disk_name):
+    try:
+        _, disk = disk_entry(load_metadata(), disk_name)
+    except ValueError:
+        # A disk being created or removed, its chunks are where the flat layout puts them
+        return (), None
+    if not isinstance(disk, dict):
+        return (), None
+    previous = disk.get("migrating_from")
+    return tuple(disk.get("fanout", ())), None if previous is None else tuple(previous)
+
+def _layout(disk_name):
+    folder = disk_path(disk_name)
+    signature = metadata_signature()
+    cached = _layouts.get(folder)
+    if cached is None or cached[0] != signature:
+        with _layouts_lock:
+            cached = _layouts.get(folder)
+            if cached is None or cached[0] != signature:
+                # Another process may have migrated the disk
+                cached = _layouts[folder] = (signature, _load_layout(disk_name))
+    return cached[1]
+
+def forget_layout(disk_name):
+    """Drop the cached layout of a disk after its metadata entry changed."""
+    with _layouts_lock:
+        _layouts.pop(disk_path(disk_name), None)
+
+def reload_layout(disk_name):
+    """Load the layout of a disk again, returning whether it changed.
+
+    For reads that miss, in case metadata.json changed without its
+    signature showing it.
+    """
+    with _layouts_lock:
+        cached = _layouts.pop(disk_path(disk_name), None)
+    return cached is None or cached[1] != _layout(disk_name)
+
+def get_layout(disk_name):
+    """Return (fanout, fanout being migrated from or None) of a disk, a flat disk's fanout is ()."""
+    return _layout(disk_name)
+
+def shard_path(folder, chunk_hash, fanout):
+    """Return where a chunk goes inside a folder with the given fanout."""
+    parts, start = [], 0
+    for width in fanout:
+        parts.append(chunk_hash[start:start + width])
+        start += width
+    return os.path.join(folder, *parts, chunk_hash)
+
+def chunk_path(disk_name, chunk_hash):
+    """Return the path a chunk is written to on a disk."""
+    return shard_path(disk_path(disk_name), chunk_hash, _layout(disk_name)[0])
+
+def old_chunk_path(disk_name, chunk_hash):
+    """Return where a chunk may still be while its disk is migrated, or None."""
+    previous = _layout(disk_name)[1]
+    if previous is None:
+        return None
+    return shard_path(disk_path(disk_name), chunk_hash, previous)
+
+def chunk_paths(disk_name, chunk_hash):
+    """Return every path a chunk may be at on a disk, the current one first."""
+    old_path = old_chunk_path(disk_name, chunk_hash)
+    current = chunk_path(disk_name, chunk_hash)
+    return [current] if old_path is None else [current, old_path]
+
+def chunk_folders(disk_name, chunk_hashes):
+    """Return the existing folders that may hold the given chunks, to fsync after writing them."""
+    folders = set()
+    for chunk_hash in chunk_hashes:
+        folders.update(os.path.dirname(path) for path in chunk_paths(disk_name, chunk_hash))
+    # Folders of the layout a disk is migrated from may be gone already
+    return sorted(folder for folder in folders if os.path.isdir(folder))
+
+def make_folders(disk_name, path):
+    """Create the missing shard folders above a chunk path.
+
+    Each new folder is synced into its parent here, as sync_chunks() only
+    syncs the folders the chunks are in.
+    """
+    root = os.path.normpath(disk_path(disk_name))
+    folder = os.path.dirname(os.path.normpath(path))
+    missing = []
+    while folder != root and not os.path.isdir(folder):
+        missing.append(folder)
+        folder = os.path.dirname(folder)
+    for folder in reversed(missing):
+        try:
+            os.mkdir(folder)
+        except FileExistsError:
+            # Another writer created it first
+            continue
+        fsync_dir(os.path.dirname(folder))
+
+def is_shard_folder(name):
+    """Whether a folder inside a disk is named like a shard."""
+    return len(name) <= MAX_FANOUT_CHARS and set(name) <= _HEX
+
+def iter_chunk_files(disk_name):
+    """Yield (path, size) of every chunk file of a "files" disk, in any layout.
+
+    Files deleted or moved while the disk is listed are left out.
+    """
+    folders = [disk_path(disk_name)]
+    while folders:
+        folder = folders.pop()
+        try:
+            entries = os.scandir(folder)
+        except FileNotFoundError:
+            # Emptied and removed by a migration since it was listed
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    # Shard folders have short hex names, the pack folder and others are skipped
+                    if is_shard_folder(entry.name):
+                        folders.append(entry.path)
+                    continue
+                try:
+                    if entry.is_file(follow_symlinks=False):
+                        yield entry.path, entry.stat(follow_symlinks=False).st_size
+                except FileNotFoundError:
+                    # Deleted, or moved by a migration, while the disk is in use
+                    continue
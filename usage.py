@@ -0,0 +1,154 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import metadata_handler
+from metadata_handler import load_metadata, update_metadata, metadata_signature, get_disk_names, disk_path
+from pack import get_pack
+from sharding import iter_chunk_files
+
+FSCK_WORKERS = 4  # disks scanned at once
+
+# Bytes and chunk files on each disk as {"bytes", "chunks"}: the "usage"
+# entry of the disk metadata as last read, and the changes this process made
+# since, which flush_usage() adds to the entry as it is then. Processes
+# sharing a volume each add their own changes, none overwrites another's.
+_saved = None
+_saved_signature = None
+_counters_root = None
+_changes = {}
+_lock = threading.Lock()
+
+def _load():
+    """Return the saved counters, read again whenever another writer saved the disk metadata."""
+    global _saved, _saved_signature, _counters_root, _changes
+    # A new storage root has its own counters
+    if _counters_root != metadata_handler.DISK_FOLDER:
+        _saved, _counters_root, _changes = None, metadata_handler.DISK_FOLDER, {}
+    signature = metadata_signature()
+    if _saved is None or signature != _saved_signature:
+        metadata = load_metadata()
+        if "usage" not in metadata and metadata["disks"]:
+            # Disks from before the counters existed are counted once
+            scanned = _scan_disks(get_disk_names(metadata))
+            usage = {name: {"bytes": total, "chunks": chunks} for name, (total, chunks) in scanned.items()}
+            update_metadata(lambda metadata: metadata.setdefault("usage", usage))
+            metadata = load_metadata()
+            signature = metadata_signature()
+        _saved = {name: dict(counts) for name, counts in metadata.get("usage", {}).items()}
+        _saved_signature = signature
+    return _saved
+
+def _counts(disk_name):
+    """Return the (bytes, chunk files) of a disk, saved plus this process's changes."""
+    saved = _load().get(disk_name, {"bytes": 0, "chunks": 0})
+    change = _changes.get(disk_name, {"bytes": 0, "chunks": 0})
+    return max(0, saved["bytes"] + change["bytes"]), max(0, saved["chunks"] + change["chunks"])
+
+def _add(disk_name, size, chunks):
+    with _lock:
+        if _counters_root != metadata_handler.DISK_FOLDER:
+            _load()
+        change = _changes.setdefault(disk_name, {"bytes": 0, "chunks": 0})
+        change["bytes"] += size
+        change["chunks"] += chunks
+
+def record_write(disk_name, size, replaced=None):
+    """Count a chunk file written to a disk.
+
+    `replaced` is the size of the file it overwrote, if there was one.
+    """
+    if replaced is None:
+        _add(disk_name, size, 1)
+    else:
+        _add(disk_name, size - replaced, 0)
+
+def record_delete(disk_name, size):
+    """Count a chunk file removed from a disk."""
+    _add(disk_name, -size, -1)
+
+def disk_counters(disk_name):
+    """Return the recorded (bytes, chunk files) of a disk."""
+    with _lock:
+        return _counts(disk_name)
+
+def used_bytes_by_disk():
+    """Return the recorded bytes of every disk."""
+    with _lock:
+        return {disk_name: _counts(disk_name)[0] for disk_name in set(_load()) | set(_changes)}
+
+def flush_usage():
+    """Add the changes this process made to the counters in the disk metadata.
+
+    Writers call this once per operation rather than once per chunk, a crash
+    in between leaves counters that fsck() corrects.
+    """
+    global _saved, _changes
+    with _lock:
+        if not _changes:
+            return
+        _load()
+        changes = _changes
+
+        def add(metadata):
+            usage = metadata.setdefault("usage", {})
+            disk_names = set(get_disk_names(metadata))
+            for disk_name, change in changes.items():
+                # A removed disk keeps no counters, whatever was still pending for it
+                if disk_name not in disk_names:
+                    usage.pop(disk_name, None)
+                    continue
+                counts = usage.setdefault(disk_name, {"bytes": 0, "chunks": 0})
+                counts["bytes"] = max(0, counts["bytes"] + change["bytes"])
+                counts["chunks"] = max(0, counts["chunks"] + change["chunks"])
+        update_metadata(add)
+        # Read again on next use, with what other processes added
+        _saved, _changes = None, {}
+
+def forget_disk_usage(disk_name):
+    """Drop the counters of a removed disk."""
+    with _lock:
+        _load()
+        _changes[disk_name] = {"bytes": 0, "chunks": 0}
+    flush_usage()
+
+def _scan_disk(disk_name):
+    """Add up the chunks of one disk."""
+    pack = get_pack(disk_name)
+    if pack is not None:
+        stats = pack.stats()
+        return stats["live_bytes"], stats["chunks"]
+    total, chunks = 0, 0
+    for _, size in iter_chunk_files(disk_name):
+        total += size
+        chunks += 1
+    return total, chunks
+
+def _scan_disks(disk_names, workers=None):
+    disk_names = [name for name in disk_names if os.path.isdir(disk_path(name))]
+    with ThreadPoolExecutor(max_workers=workers or FSCK_WORKERS) as pool:
+        return dict(zip(disk_names, pool.map(_scan_disk, disk_names)))
+
+def fsck(disk_names=None, workers=None, repair=True):
+    """Scan the disk folders in parallel and compare them with the counters.
+
+    Returns {disk: {"bytes", "chunks", "recorded_bytes", "recorded_chunks"}}.
+    With `repair` the counters are replaced by what was found on disk.
+    """
+    if disk_names is None:
+        disk_names = get_disk_names(load_metadata())
+    scanned = _scan_disks(disk_names, workers)
+
+    report = {}
+    with _lock:
+        for disk_name, (total, chunks) in scanned.items():
+            recorded_bytes, recorded_chunks = _counts(disk_name)
+            report[disk_name] = {"bytes": total, "chunks": chunks,
+                                 "recorded_bytes": recorded_bytes, "recorded_chunks": recorded_chunks}
+            if repair and (total, chunks) != (recorded_bytes, recorded_chunks):
+                # Counted as a change, so the counters end up at what was found
+                change = _changes.setdefault(disk_name, {"bytes": 0, "chunks": 0})
+                change["bytes"] += total - recorded_bytes
+                change["chunks"] += chunks - recorded_chunks
+    if repair:
+        flush_usage()
+    return report
@@ -0,0 +1,244 @@
+import os
+from metadata_handler import set_storage_root, load_files_metadata, find_file_metadata, chunk_index_stats
+from metadata_handler import chunk_offsets
+from disk_operations import get_disks, create_disk, remove_disk, get_disk_usage, compact_disks, migrate_disks
+from file_operations import store_stream, iter_file_data, retrieve_to_stream, delete_stored_file, read_range
+from file_operations import get_hash_algorithm, set_hash_algorithm, get_chunker_spec, set_chunker, BLOCK_SIZE
+from file_operations import get_compression, set_compression, recover_journal
+from chunking import CDC_AVERAGE
+from sharding import FANOUT
+from compressors import available_codecs
+from hashing import available_algorithms
+from usage import fsck
+from chunk_cache import configure_cache, cache_stats
+from balancing import READ_POLICIES, get_balancer, set_read_policy
+from metrics import enable_metrics, snapshot, export_metrics, serve_metrics
+from integrity import set_verify_reads, suspects
+from bulk import bulk_ingest
+from scrub import SCRUB_RATE, SCRUB_INTERVAL, Scrubber, start_scrubber, stop_scrubber, last_scrub_report
+
+class VirtualSAN:
+    """Programmatic access to the virtual storage system.
+
+    Every method takes its arguments directly and reads or writes file-like
+    objects, so the system can be scripted or embedded without prompts. The
+    storage root is process-wide: creating a VirtualSAN with a root points
+    every module at that folder. Opening it settles stores and deletes a
+    crashed process left unfinished, see journal.py.
+    """
+
+    def __init__(self, root=None):
+        if root is not None:
+            set_storage_root(root)
+            os.makedirs(root, exist_ok=True)
+        recover_journal()
+
+    def disks(self):
+        """Return every disk as a {"name", "size"} entry."""
+        return get_disks()
+
+    def add_disk(self, name, size, layout="files", fanout=FANOUT):
+        """Create a disk of `size` bytes, storing one file per chunk or packed segments ("pack").
+
+        Chunk files go into folders named by `fanout` hash characters per level, () keeps them flat.
+        """
+        create_disk(name, size, layout, fanout)
+
+    def remove_disk(self, name, bandwidth=None, verbose=False):
+        """Move a disk's chunks to the other disks, at most `bandwidth` bytes/s, and remove it."""
+        remove_disk(name, bandwidth, verbose)
+
+    def disk_usage(self, name):
+        """Return (total, used, available) bytes for a disk, or None if it does not exist."""
+        return get_disk_usage(name)
+
+    def migrate_layout(self, fanout=FANOUT, disks=None, workers=None, verbose=False):
+        """Move the chunk files of the disks, all "files" disks by default, into the `fanout` layout.
+
+        Returns the files moved per disk. The disks stay in use meanwhile.
+        """
+        return migrate_disks(disks, fanout, workers, verbose)
+
+    def compact(self):
+        """Reclaim deleted chunk space on pack disks, returning bytes freed per disk."""
+        return compact_disks()
+
+    def fsck(self, repair=True):
+        """Recount every disk folder and fix the usage counters, see usage.fsck()."""
+        return fsck(repair=repair)
+
+    def hash_algorithm(self):
+        """Return the hash algorithm new files are chunked with."""
+        return get_hash_algorithm()
+
+    def set_hash_algorithm(self, algorithm):
+        """Choose the hash algorithm for files stored from now on."""
+        set_hash_algorithm(algorithm)
+
+    def chunker(self):
+        """Return the chunker spec new files are cut with."""
+        return get_chunker_spec()
+
+    def set_chunker(self, name, min_size=None, avg_size=None, max_size=None):
+        """Cut files stored from now on with the "fixed" or content-defined ("cdc") chunker.
+
+        For "fixed" `avg_size` is the block size.
+        """
+        if name == "fixed":
+            spec = {"name": "fixed", "size": avg_size or BLOCK_SIZE}
+        else:
+            spec = {"name": name, "min": min_size, "avg": avg_size or CDC_AVERAGE, "max": max_size}
+        set_chunker(spec)
+
+    def compression(self):
+        """Return the codec new chunks are compressed with, "none" if they are not."""
+        return get_compression()
+
+    def set_compression(self, codec):
+        """Compress chunks stored from now on with a codec from compression_codecs()."""
+        set_compression(codec)
+
+    def compression_codecs(self):
+        """Return the compression codecs available in this installation."""
+        return available_codecs()
+
+    def hash_algorithms(self):
+        """Return the hash algorithms available in this installation."""
+        return available_algorithms()
+
+    def put(self, source, method="stripe", name=None, parity=1, verbose=False):
+        """Store a path or a readable binary stream and return its metadata entry.
+
+        `parity` is the number of parity chunks per stripe for the "parity" method.
+        """
+        if isinstance(source, (str, os.PathLike)):
+            with open(source, "rb") as stream:
+                return store_stream(stream, name or os.path.basename(source), method, parity=parity,
+                                    verbose=verbose)
+        if name is None:
+            raise ValueError("A name is required when storing from a stream")
+        return store_stream(source, name, method, parity=parity, verbose=verbose)
+
+    def ingest(self, sources=(), method="stripe", manifest=None, prefix="", parity=1, skip="mtime",
+               batch_files=None, verbose=False):
+        """Store folders, files and the files a manifest lists in committed batches, and return the report.
+
+        Unchanged files are skipped and an interrupted ingest resumes, see bulk.py.
+        """
+        return bulk_ingest(sources, method, manifest, prefix, parity, skip, batch_files, verbose=verbose)
+
+    def get(self, name):
+        """Return an iterator over the contents of a stored file."""
+        return iter_file_data(self._file(name), missing_ok=False)
+
+    def get_to(self, name, output, verbose=False, missing_ok=True):
+        """Write a stored file to a binary stream, returning the hashes of missing chunks.
+
+        With missing_ok False a chunk no disk can provide raises IOError.
+        """
+        return retrieve_to_stream(self._file(name), output, verbose=verbose, missing_ok=missing_ok)
+
+    def read(self, name, offset, length=None):
+        """Return `length` bytes of a stored file from `offset`, reading only the chunks they span.
+
+        Without a length the rest of the file is returned. Fewer bytes come
+        back when the range reaches past the end of the file.
+        """
+        return read_range(self._file(name), offset, length)
+
+    def stat(self, name):
+        """Return the "size", "method" and number of "chunks" of a stored file."""
+        file_metadata = self._file(name)
+        offsets = chunk_offsets(file_metadata)
+        return {"size": offsets[-1], "method": file_metadata["method"], "chunks": len(offsets) - 1}
+
+    def files(self):
+        """Return the metadata entries of every stored file."""
+        return load_files_metadata()
+
+    def delete(self, name):
+        """Delete a stored file and return the number of chunk copies freed."""
+        removed = delete_stored_file(name)
+        if removed is None:
+            raise FileNotFoundError(f"No stored file named '{name}'")
+        return removed
+
+    def dedup_stats(self):
+        """Return chunk index totals, see metadata_handler.chunk_index_stats()."""
+        return chunk_index_stats()
+
+    def set_cache(self, budget, tier_folder=None, tier_budget=0):
+        """Cache up to `budget` bytes of hot chunks in memory, 0 turns the cache off.
+
+        Chunks evicted from memory can spill into `tier_folder`, up to
+        `tier_budget` bytes, see chunk_cache.py.
+        """
+        configure_cache(budget, tier_folder, tier_budget)
+
+    def cache_stats(self):
+        """Return the chunk cache hit/miss counters and sizes, or None if it is off."""
+        return cache_stats()
+
+    def read_policy(self):
+        """Return how the replica of a mirrored chunk to read is chosen."""
+        return get_balancer().policy
+
+    def set_read_policy(self, policy):
+        """Pick replicas by "least_outstanding" reads, "round_robin" or lowest "latency"."""
+        set_read_policy(policy)
+
+    def read_policies(self):
+        return list(READ_POLICIES)
+
+    def replica_stats(self):
+        """Return reads, reads in flight, average latency and errors per disk."""
+        return get_balancer().stats()
+
+    def scrub(self, rate=None, repair=True, disks=None):
+        """Verify every chunk copy, at most `rate` bytes/s, repair the bad ones and return the report.
+
+        See scrub.Scrubber.scrub() for the report's fields.
+        """
+        return Scrubber(rate, repair).scrub(disks)
+
+    def start_scrubber(self, rate=SCRUB_RATE, interval=SCRUB_INTERVAL, repair=True):
+        """Scrub in a background thread now and every `interval` seconds after a pass ends."""
+        start_scrubber(rate, interval, repair)
+
+    def stop_scrubber(self):
+        stop_scrubber()
+
+    def scrub_report(self):
+        """Return the report of the last scrub of this volume, or None."""
+        return last_scrub_report()
+
+    def set_verify_reads(self, enabled=True):
+        """Hash every chunk retrieves read, failing over from copies that do not match."""
+        set_verify_reads(enabled)
+
+    def suspect_copies(self):
+        """Return the [hash, disk] copies verified reads found bad since the last scrub."""
+        return [list(copy) for copy in suspects()]
+
+    def enable_metrics(self, enabled=True):
+        """Start, or with False stop, recording chunk I/O and catalog metrics, see metrics.py."""
+        enable_metrics(enabled)
+
+    def metrics(self):
+        """Return the recorded counters and histograms."""
+        return snapshot()
+
+    def export_metrics(self, path, format=None):
+        """Write the metrics to a file as "json" or "prometheus" text, chosen by extension by default."""
+        export_metrics(path, format)
+
+    def serve_metrics(self, port, host="127.0.0.1"):
+        """Answer Prometheus scrapes of /metrics over HTTP from a background thread."""
+        enable_metrics()
+        return serve_metrics(port, host)
+
+    def _file(self, name):
+        file_metadata = find_file_metadata(name)
+        if file_metadata is None:
+            raise FileNotFoundError(f"No stored file named '{name}'")
+        return file_metadata
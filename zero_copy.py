@@ -0,0 +1,100 @@
+import os
+import mmap
+import stat
+import errno
+
+COPY_BLOCK = 1024 * 1024  # read/write size when the kernel cannot copy for us
+
+# Errors meaning a copy call does not work for this pair of files, as opposed to a failed copy
+_UNSUPPORTED = {errno.EINVAL, errno.ENOSYS, errno.EXDEV, errno.EOPNOTSUPP, errno.EBADF, errno.ESPIPE}
+
+class MappedReader:
+    """Read a regular file through mmap, returning memoryview slices instead of new bytes.
+
+    Reading starts at the stream's current position and close() moves the
+    stream to where the reads stopped. The file must not be truncated while
+    it is mapped.
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._position = stream.tell()
+        self._map = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(self._map, "madvise"):
+            self._map.madvise(mmap.MADV_SEQUENTIAL)
+        self._view = memoryview(self._map)
+
+    def read(self, size):
+        chunk = self._view[self._position:self._position + size]
+        self._position += len(chunk)
+        return chunk
+
+    def close(self):
+        self._stream.seek(self._position)
+        try:
+            self._view.release()
+            self._map.close()
+        except BufferError:
+            # Slices are still referenced somewhere, the map closes once they are freed
+            pass
+
+def map_stream(stream):
+    """Return a MappedReader for a regular file, or the stream itself when it cannot be mapped."""
+    try:
+        info = os.fstat(stream.fileno())
+        if stat.S_ISREG(info.st_mode) and info.st_size > stream.tell():
+            return MappedReader(stream)
+    except (AttributeError, OSError, ValueError):
+        # No file descriptor, as with BytesIO, or a pipe
+        pass
+    return stream
+
+def output_fd(output):
+    """Return the file descriptor behind a binary stream, or None if there is none."""
+    try:
+        return output.fileno()
+    except (AttributeError, OSError, ValueError):
+        return None
+
+class FdCopier:
+    """Copy files, or ranges of them, into one output descriptor inside the kernel.
+
+    copy_file_range() is tried first, then sendfile(), then plain reads and
+    writes. A call that is not supported for this output is not tried again.
+    """
+
+    def __init__(self, out_fd):
+        self.out_fd = out_fd
+        self.methods = [name for name in ("copy_file_range", "sendfile") if hasattr(os, name)]
+
+    def _copy_once(self, in_fd, offset, count):
+        while self.methods:
+            try:
+                if self.methods[0] == "copy_file_range":
+                    return os.copy_file_range(in_fd, self.out_fd, count, offset)
+                return os.sendfile(self.out_fd, in_fd, offset, count)
+            except OSError as error:
+                if error.errno not in _UNSUPPORTED:
+                    raise
+                self.methods.pop(0)
+        data = os.pread(in_fd, min(count, COPY_BLOCK), offset)
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self.out_fd, view):]
+        return len(data)
+
+    def copy(self, in_fd, offset=0, length=None):
+        """Append `length` bytes of `in_fd` from `offset` to the output and return the bytes copied.
+
+        Without a length the rest of the file is copied.
+        """
+        if length is None:
+            length = os.fstat(in_fd).st_size - offset
+        end = offset + length
+        while offset < end:
+            copied = self._copy_once(in_fd, offset, end - offset)
+            if not copied:
+                # The file got shorter while copying
+                break
+            offset += copied
+        return length - (end - offset)